@@ -0,0 +1,161 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2020 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+"""Compares patch engines on a pair of archives
+
+Usage:
+
+    python dev/patch_benchmark.py OLD_ARCHIVE NEW_ARCHIVE
+    python dev/patch_benchmark.py --size 50
+
+Without archives, random data of --size MB with scattered edits is used.
+Each engine runs in its own process so peak memory is measured per
+engine.
+"""
+from __future__ import division, print_function
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on windows
+    resource = None
+
+sys.path.append(os.getcwd())
+
+from pyupdater.utils.patch_engines import get_engine, get_engine_names  # noqa: E402
+
+
+def get_peak_memory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on mac & kilobytes everywhere else
+    if sys.platform != "darwin":
+        peak *= 1024
+    return peak
+
+
+def run_engine(name, src_path, dst_path):
+    engine = get_engine(name)
+    with open(src_path, "rb") as f:
+        src = f.read()
+    with open(dst_path, "rb") as f:
+        dst = f.read()
+    baseline = get_peak_memory()
+
+    start = time.perf_counter()
+    patch = engine.diff(src, dst)
+    diff_time = time.perf_counter() - start
+    diff_memory = get_peak_memory()
+
+    start = time.perf_counter()
+    result = engine.patch(src, patch)
+    apply_time = time.perf_counter() - start
+    assert result == dst, "{} produced a bad patch".format(name)
+
+    memory = None
+    if baseline is not None:
+        memory = diff_memory - baseline
+    return len(patch), diff_time, apply_time, memory
+
+
+def make_archives(size, directory):
+    src = bytearray(os.urandom(size))
+    dst = bytearray(src)
+    # Edits spread across the archive like a typical rebuild
+    for _ in range(max(1, size // (64 * 1024))):
+        start = random.randrange(size)
+        dst[start : start + 256] = os.urandom(256)
+
+    paths = []
+    for name, data in [("old", src), ("new", dst)]:
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def format_size(size):
+    if size is None:
+        return "n/a"
+    if size < 1024 * 1024:
+        return "{:.1f} KB".format(size / 1024)
+    return "{:.1f} MB".format(size / 1024 / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare patch engines")
+    parser.add_argument("old", nargs="?")
+    parser.add_argument("new", nargs="?")
+    parser.add_argument(
+        "--size", type=int, default=20, help="MB of random data without archives"
+    )
+    parser.add_argument(
+        "--engine", action="append", help="Engine to run. Default all available"
+    )
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    if args.old and args.new:
+        src_path, dst_path = args.old, args.new
+    else:
+        src_path, dst_path = make_archives(args.size * 1024 * 1024, temp_dir)
+
+    dst_size = os.path.getsize(dst_path)
+    print("Source: {}".format(format_size(os.path.getsize(src_path))))
+    print("Destination: {}".format(format_size(dst_size)))
+    print()
+    row = "{:<12} {:>12} {:>8} {:>10} {:>10} {:>12}"
+    print(row.format("engine", "patch", "ratio", "diff", "apply", "diff memory"))
+
+    for name in args.engine or get_engine_names():
+        if get_engine(name) is None:
+            print("{:<12} not available".format(name))
+            continue
+        # A new process each time so peak memory isn't shared
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(run_engine, name, src_path, dst_path)
+            size, diff_time, apply_time, memory = future.result()
+        print(
+            row.format(
+                name,
+                format_size(size),
+                "{:.2%}".format(size / dst_size),
+                "{:.2f}s".format(diff_time),
+                "{:.2f}s".format(apply_time),
+                format_size(memory),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
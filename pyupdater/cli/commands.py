@@ -308,7 +308,7 @@ def _cmd_pkg(*args):
     # Sign the update meta-data with the repo private key.
     if ns.sign is True:
         log.info("Signing packages...")
-        pyu.sign_update(ns.split_version)
+        pyu.sign_update(ns.split_version, ns.shard, ns.compact, ns.keep)
         log.info("Signing packages complete")
 
 
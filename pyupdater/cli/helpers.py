@@ -30,6 +30,11 @@ from dsdev_utils import terminal
 
 from pyupdater import settings
 from pyupdater.utils import PluginManager
+from pyupdater.utils.patch_engines import (
+    DEFAULT_ENGINE,
+    get_engine_names,
+    load_plugins,
+)
 
 log = logging.getLevelName(__name__)
 
@@ -130,6 +135,54 @@ def setup_http_timeout(config):  # pragma: no cover
 def setup_patches(config):  # pragma: no cover
     question = "Would you like to enable patch updates?"
     config.UPDATE_PATCHES = terminal.ask_yes_no(question, default="yes")
+    if config.UPDATE_PATCHES is False:
+        return
+
+    load_plugins()
+    engines = get_engine_names()
+    if len(engines) > 1:
+        while 1:
+            temp = terminal.get_correct_answer(
+                "Patch engine ({})".format(", ".join(engines)),
+                required=True,
+                default=config.get("PATCH_ENGINE") or DEFAULT_ENGINE,
+            )
+            if temp in engines:
+                break
+            log.error("Unknown patch engine: {}".format(temp))
+        config.PATCH_ENGINE = temp
+
+    question = (
+        "Diff the uncompressed payload of archives? Much smaller patches "
+        "but older clients can't apply them"
+    )
+    config.PAYLOAD_PATCHES = terminal.ask_yes_no(question, default="no")
+
+    default = config.get("CUMULATIVE_PATCHES", 0)
+    while 1:
+        temp = terminal.get_correct_answer(
+            "Number of older versions to patch straight to the newest from",
+            required=True,
+            default=str(default),
+        )
+        try:
+            temp = int(temp)
+        except Exception as err:
+            log.error(err)
+            continue
+
+        if temp < 0:
+            log.error("Number of versions has to be >= 0")
+            continue
+        break
+
+    config.CUMULATIVE_PATCHES = temp
+    if temp == 0:
+        return
+
+    question = "Space them out geometrically? (2, 4, 8... versions back)"
+    geometric = terminal.ask_yes_no(question, default="no")
+    config.CUMULATIVE_PATCH_SPACING = "geometric" if geometric else "linear"
 
 
 def setup_plugin(name, config):  # pragma: no cover
@@ -187,6 +187,27 @@ def add_package_parser(subparsers):
         help="Creates a version manifest for the current platform only. For CI/CD",
     )
 
+    package_parser.add_argument(
+        "--shard",
+        action="store_true",
+        dest="shard",
+        help="Also creates a signed index & a version manifest per app & channel",
+    )
+
+    package_parser.add_argument(
+        "--compact",
+        action="store_true",
+        dest="compact",
+        help="Removes versions clients can no longer patch from the version manifest",
+    )
+
+    package_parser.add_argument(
+        "--keep",
+        type=int,
+        dest="keep",
+        help="With --compact also keeps the last N versions per channel & platform",
+    )
+
     package_parser.add_argument(
         "-v",
         "--verbose",
@@ -43,7 +43,14 @@ from dsdev_utils.system import get_system as _get_system
 from nacl.signing import VerifyKey
 
 from pyupdater import settings, __version__
-from pyupdater.client.downloader import FileDownloader
+from pyupdater.client.downloader import (
+    DownloadWindow,
+    FileDownloader,
+    get_hash,
+    get_http_pool,
+    RateLimiter,
+)
+from pyupdater.client.manifest import CompiledManifest
 from pyupdater.client.updates import (
     AppUpdate,
     get_highest_version,
@@ -52,7 +59,8 @@ from pyupdater.client.updates import (
 )
 from pyupdater.utils.config import Config as _Config
 from pyupdater.utils.encoding import UnpaddedBase64Encoder
-from pyupdater.utils.exceptions import ClientError
+from pyupdater.utils.exceptions import ClientError, UtilsError
+from pyupdater.utils.manifest import is_manifest_container, unpack_manifest
 
 
 warnings.simplefilter("always", DeprecationWarning)
@@ -73,6 +81,25 @@ class DefaultClientConfig(object):
     DATA_DIR = tempfile.gettempdir()
 
 
+# Digests of data verified by clients with CACHE_VERIFIED_MANIFEST set.
+# Only kept in memory. A copy on disk could be forged by anyone able to
+# write to the data dir.
+_shared_verified_digests = set()
+
+
+# (update urls, filename) of manifests a repo doesn't have. Found when
+# a file later in the list of preferred files downloads fine. Skipped
+# for the rest of the process to save a request & its retries.
+_missing_manifests = set()
+
+
+def _get_verified_digest(key, data):
+    # Ties data to the key it was verified with
+    if not isinstance(key, bytes):
+        key = bytes(key, encoding="utf-8")
+    return get_hash(key + b"\n" + data)
+
+
 class Client(object):
     """Used to check for updates & returns an updateobject if there
     is an update.
@@ -124,12 +151,25 @@ class Client(object):
         # String: Update manifest as json string - set in _get_update_manifest
         self.json_data = None
 
+        # CompiledManifest: json_data compiled into lookup tables
+        self.manifest = CompiledManifest()
+
         # Boolean: Version file verification
         self.verified = False
 
+        # Set: Hashes of key & manifest data already verified by this
+        # client. Used to skip verifying unchanged data again.
+        self._verified_digests = set()
+
         # Boolean: Json being loaded to dict
         self.ready = False
 
+        # Dict: Verified index of manifest shards - set in _get_manifest_index
+        self.manifest_index = None
+
+        # Dict: Manifest shards loaded since the last refresh
+        self._manifest_shards = {}
+
         # LIst: Progress hooks to be called
         self.progress_hooks = []
         if progress_hooks is not None:
@@ -190,6 +230,40 @@ class Client(object):
         # HTTP Timeout
         self.http_timeout = config.get("HTTP_TIMEOUT", 30)
 
+        # Number of concurrent ranged requests used for large downloads
+        self.download_connections = config.get("DOWNLOAD_CONNECTIONS", 1)
+
+        # Race all update urls on first use to find the fastest mirror
+        self.race_mirrors = config.get("RACE_MIRRORS", False)
+
+        # Number of patches downloaded at the same time
+        self.max_patch_downloads = config.get("MAX_PATCH_DOWNLOADS", 4)
+
+        # Apply patches while the remaining ones are still downloading
+        self.pipeline_patches = config.get("PIPELINE_PATCHES", False)
+
+        # Apply patches file to file to keep memory usage down
+        self.low_memory_patches = config.get("LOW_MEMORY_PATCHES", False)
+
+        # Max bytes per second used by background downloads
+        self.background_download_rate = config.get("BACKGROUND_DOWNLOAD_RATE")
+
+        # Daily ("HH:MM", "HH:MM") window in which background downloads start
+        self.background_download_window = config.get("BACKGROUND_DOWNLOAD_WINDOW")
+
+        # Max number of open connections kept per host
+        self.http_max_connections = config.get("HTTP_MAX_CONNECTIONS", 4)
+
+        # Ask the server to keep connections open between downloads
+        self.http_keep_alive = config.get("HTTP_KEEP_ALIVE", True)
+
+        # Share verified key & version file data with other clients
+        # in this process
+        self.cache_verified_manifest = config.get("CACHE_VERIFIED_MANIFEST", False)
+
+        # Only download the manifest shard of the name being checked
+        self.manifest_shards = config.get("MANIFEST_SHARDS", False)
+
         # The name of the version file to download
         self.version_file = settings.VERSION_FILE_FILENAME
 
@@ -197,15 +271,51 @@ class Client(object):
         # Basically the version.gz vs vesion-<platform>.gz
         self.version_file_compat = settings.VERSION_FILE_FILENAME_COMPAT
 
+        # Signed manifest containers. Preferred over the version files
+        # above since they're verified without re-serializing the data.
+        self.version_file_v2 = settings.VERSION_FILE_FILENAME_V2
+        self.version_file_v2_compat = settings.VERSION_FILE_FILENAME_V2_COMPAT
+
+        # Signed index of manifest shards
+        self.manifest_index_file = settings.MANIFEST_INDEX_FILENAME
+        self.manifest_index_file_compat = settings.MANIFEST_INDEX_FILENAME_COMPAT
+
         # The name of the key file to download
         self.key_file = settings.KEY_FILE_FILENAME
 
         # headers
         self.headers = headers
 
+        # One connection pool for every download this client makes.
+        # Reusing connections saves a tcp & tls handshake per file.
+        self.http_pool = get_http_pool(
+            secure=self.verify is True,
+            headers=self.headers,
+            http_timeout=self.http_timeout,
+            maxsize=max(
+                self.http_max_connections,
+                self.download_connections,
+                self.max_patch_downloads,
+            ),
+            keep_alive=self.http_keep_alive,
+        )
+
+        # Shared by all background downloads so the cap holds when
+        # patches are downloaded at the same time
+        self.rate_limiter = None
+        if self.background_download_rate:
+            self.rate_limiter = RateLimiter(self.background_download_rate)
+
+        self.download_window = None
+        if self.background_download_window:
+            self.download_window = DownloadWindow(*self.background_download_window)
+
         # Creating data & update directories
         self._setup()
 
+        if self.cache_verified_manifest is True:
+            self._verified_digests = _shared_verified_digests
+
         # The update strategy to use
         self.strategy = kwargs.get("strategy", UpdateStrategy.DEFAULT)
 
@@ -215,6 +325,10 @@ class Client(object):
     def refresh(self):
         """Will download and verify the version manifest."""
         self._get_signing_key()
+
+        # Repos without an index still publish the whole manifest
+        if self.manifest_shards is True and self._get_manifest_index() is True:
+            return
         self._get_update_manifest()
 
     def update_check(self, name, version, channel="stable", strict=True):
@@ -247,6 +361,14 @@ class Client(object):
     def _gen_file_downloader_options(self):
         return {
             "http_timeout": self.http_timeout,
+            "download_connections": self.download_connections,
+            "race_mirrors": self.race_mirrors,
+            "http_pool": self.http_pool,
+            "max_patch_downloads": self.max_patch_downloads,
+            "pipeline_patches": self.pipeline_patches,
+            "low_memory": self.low_memory_patches,
+            "rate_limiter": self.rate_limiter,
+            "download_window": self.download_window,
             "max_download_retries": self.max_download_retries,
             "progress_hooks": self.progress_hooks,
             "headers": self.headers,
@@ -286,10 +408,17 @@ class Client(object):
         if self.FROZEN is True and self.name == self.app_name:
             app = True
 
+        json_data = self.json_data
+        manifest = self.manifest
+        if self.manifest_index is not None:
+            shard = self._get_manifest_shard(name, channel, strict)
+            if shard is None:
+                log.debug("No verified manifest shard for %s", name)
+                return None
+            json_data, manifest = shard
+
         log.debug("Checking for %s updates...", name)
-        latest = get_highest_version(
-            name, self.platform, channel, self.easy_data, strict
-        )
+        latest = get_highest_version(name, self.platform, channel, manifest, strict)
         if latest is None:
             # If None is returned get_highest_version could
             # not find the supplied name in the version file
@@ -313,8 +442,9 @@ class Client(object):
             "update_urls": self.update_urls,
             "name": self.name,
             "version": self.version,
-            "easy_data": self.easy_data,
-            "json_data": self.json_data,
+            "easy_data": _EAD(json_data),
+            "json_data": json_data,
+            "manifest": manifest,
             "data_dir": self.data_dir,
             "platform": self.platform,
             "channel": channel,
@@ -374,6 +504,12 @@ class Client(object):
         if not isinstance(pub_key, bytes):
             pub_key = bytes(pub_key, encoding="utf-8")
 
+        digest = _get_verified_digest(self.root_key, key_data_str)
+        if digest in self._verified_digests:
+            log.debug("Key file already verified")
+            self.app_key = pub_key
+            return
+
         # The signature that we'll validate
         sig = key_data["signature"]
 
@@ -392,75 +528,82 @@ class Client(object):
             # Everything checks out
             log.debug("Key file verified")
             self.app_key = pub_key
+            self._verified_digests.add(digest)
 
     # Here we attempt to read the manifest from the filesystem
     # in case of no Internet connection. Useful when an update
     # needs to be installed without an network connection
-    def _get_manifest_from_disk(self):
+    def _get_manifest_from_disk(self, filenames=None):
+        if filenames is None:
+            filenames = self._get_version_files()
+
         with _ChDir(self.data_dir):
             # This could be the first run or an accidental deletion of the
             # cached version manifest.
-            if os.path.exists(self.version_file):
-                filename = self.version_file
-            elif os.path.exists(self.version_file_compat):
-                filename = self.version_file_compat
+            for filename in filenames:
+                if os.path.exists(filename):
+                    break
             else:
                 return None
 
             log.debug("Found version file on file system")
-            # Attempt to open the cached version file
-            try:
-                with open(filename, "rb") as f:
-                    data = f.read()
-                log.debug("Loaded version file from file system")
-            except Exception as err:
-                log.debug("Failed to load version file from file " "system")
-                log.debug(err, exc_info=True)
-                return None
+            return self._read_manifest_from_filesystem(filename)
+
+    # Version files in order of preference
+    def _get_version_files(self):
+        return [
+            self.version_file_v2,
+            self.version_file,
+            self.version_file_v2_compat,
+            self.version_file_compat,
+        ]
+
+    # Must be called from the data directory
+    def _read_manifest_from_filesystem(self, filename):
+        # Attempt to open the cached version file
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            log.debug("Loaded %s from file system", filename)
+        except Exception as err:
+            log.debug("Failed to load %s from file system", filename)
+            log.debug(err, exc_info=True)
+            return None
 
-            # Attempt the decompress
-            try:
-                decompressed_data = _gzip_decompress(data)
-            except Exception as err:
-                log.debug(err)
-                return None
+        # Attempt the decompress
+        try:
+            decompressed_data = _gzip_decompress(data)
+        except Exception as err:
+            log.debug(err)
+            return None
 
-            return decompressed_data
+        return decompressed_data
 
     # Downloading the manifest. If successful also writes it to file-system
-    def _get_manifest_from_http(self):
+    def _get_manifest_from_http(self, filenames=None):
         log.debug("Downloading online version file")
-        version_files = [self.version_file, self.version_file_compat]
-
-        for vf in version_files:
+        if filenames is None:
+            filenames = self._get_version_files()
+
+        urls = tuple(self.update_urls)
+        failed = []
+        for vf in filenames:
+            if (urls, vf) in _missing_manifests:
+                log.debug("Skipping %s. Not on the server", vf)
+                continue
             try:
-                if self.downloader:
-                    fd = self.downloader(vf, self.update_urls)
-                else:
-                    fd = FileDownloader(
-                        vf,
-                        self.update_urls,
-                        verify=self.verify,
-                        max_download_retries=self.max_download_retries,
-                        headers=self.headers,
-                        http_timeout=self.http_timeout,
-                    )
-                data = fd.download_verify_return()
-                try:
-                    decompressed_data = _gzip_decompress(data)
-                except IOError:
-                    log.debug("Failed to decompress gzip file")
-                    # Will be caught down below.
-                    # Just logging the error
-                    raise
+                decompressed_data = self._download_manifest(vf)
                 log.debug("Version file download successful")
-                # Writing version file to application data directory
-                self._write_manifest_to_filesystem(decompressed_data, vf)
-                return decompressed_data
             except Exception as err:
                 log.debug(err, exc_info=True)
+                failed.append(vf)
                 continue
 
+            # The server is reachable so the files before this one
+            # aren't published
+            _missing_manifests.update((urls, f) for f in failed)
+            return decompressed_data
+
         log.debug("Version file download failed")
         return None
 
@@ -468,40 +611,93 @@ class Client(object):
     def _get_key_data(self):
         log.debug("Downloading key file")
         try:
-            if self.downloader:
-                fd = self.downloader(self.key_file, self.update_urls)
-            else:
-                fd = FileDownloader(
-                    self.key_file,
-                    self.update_urls,
-                    verify=self.verify,
-                    max_download_retries=self.max_download_retries,
-                    headers=self.headers,
-                    http_timeout=self.http_timeout,
-                )
-            data = fd.download_verify_return()
-            try:
-                decompressed_data = _gzip_decompress(data)
-            except IOError:
-                log.debug("Failed to decompress gzip file")
-                raise
+            decompressed_data = self._download_manifest(self.key_file)
             log.debug("Key file download successful")
-            # Writing version file to application data directory
-            self._write_manifest_to_filesystem(decompressed_data, self.key_file)
             return decompressed_data
         except Exception as err:
             log.debug("Version file download failed")
             log.debug(err, exc_info=True)
             return None
 
+    # Downloads a gzipped manifest & writes it to the file-system.
+    # If our cached copy is still current it's loaded from disk instead.
+    def _download_manifest(self, filename):
+        validators = self._get_manifest_validators(filename)
+        fd = self._get_manifest_downloader(filename, validators)
+        data = fd.download_verify_return()
+        if getattr(fd, "not_modified", False) is True:
+            log.debug("%s not modified since last download", filename)
+            with _ChDir(self.data_dir):
+                decompressed_data = self._read_manifest_from_filesystem(filename)
+            if decompressed_data is not None:
+                return decompressed_data
+            # Our cached copy is unreadable. Get a fresh one.
+            fd = self._get_manifest_downloader(filename, None)
+            data = fd.download_verify_return()
+
+        if data is None:
+            raise ClientError("Failed to download {}".format(filename), expected=True)
+
+        try:
+            decompressed_data = _gzip_decompress(data)
+        except IOError:
+            log.debug("Failed to decompress gzip file")
+            # Will be caught by the caller.
+            # Just logging the error
+            raise
+        # Writing version file to application data directory
+        validators = {
+            "etag": getattr(fd, "etag", None),
+            "last_modified": getattr(fd, "last_modified", None),
+        }
+        self._write_manifest_to_filesystem(decompressed_data, filename, validators)
+        return decompressed_data
+
+    def _get_manifest_downloader(self, filename, validators):
+        if self.downloader:
+            return self.downloader(filename, self.update_urls)
+        return FileDownloader(
+            filename,
+            self.update_urls,
+            verify=self.verify,
+            max_download_retries=self.max_download_retries,
+            headers=self.headers,
+            http_timeout=self.http_timeout,
+            race_mirrors=self.race_mirrors,
+            http_pool=self.http_pool,
+            validators=validators,
+        )
+
+    # Returns the ETag & Last-Modified of the cached copy of filename
+    def _get_manifest_validators(self, filename):
+        with _ChDir(self.data_dir):
+            validators_file = filename + ".json"
+            if not os.path.exists(filename) or not os.path.exists(validators_file):
+                return None
+            try:
+                with open(validators_file, "r") as f:
+                    return json.load(f)
+            except Exception as err:
+                log.debug(err, exc_info=True)
+                return None
+
     # Adds the ability to apply updates when there isn't an
     # Internet connection.
-    def _write_manifest_to_filesystem(self, data, filename):
+    def _write_manifest_to_filesystem(self, data, filename, validators=None):
         with _ChDir(self.data_dir):
             log.debug("Writing %s file to disk", filename)
             with gzip.open(filename, "wb") as f:
                 f.write(data)
 
+            # Kept next to the cached copy to make the next
+            # download of this file conditional
+            validators_file = filename + ".json"
+            if validators and any(validators.values()):
+                with open(validators_file, "w") as f:
+                    json.dump(validators, f)
+            elif os.path.exists(validators_file):
+                os.remove(validators_file)
+
     # We first attempt to download the version manifest. If that fails
     # we try to load a cached version manifest from disk. Once we have
     # the data in memory we'll verify it's signature.
@@ -512,12 +708,22 @@ class Client(object):
         if data is None:
             data = self._get_manifest_from_disk()
 
+        # Manifest containers keep the signature in a header so the
+        # payload can be verified as is
+        header = None
+        payload = data
+        if data is not None and is_manifest_container(data):
+            try:
+                header, payload = unpack_manifest(data)
+            except UtilsError as err:
+                log.debug(err, exc_info=True)
+
         if data is not None:
             try:
                 log.debug("Data type: %s", type(data))
                 # If json fails to load self.ready will stay false
                 # which will cause _update_check to exit early
-                self.json_data = json.loads(data.decode("utf-8"))
+                self.json_data = json.loads(payload.decode("utf-8"))
 
                 # Ready to check for updates.
                 self.ready = True
@@ -536,16 +742,113 @@ class Client(object):
             )
             self.json_data = {}
 
-        # If verified we set self.verified to True.
-        self._verify_sig(self.json_data)
+        digest = None
+        if data is not None and self.app_key is not None:
+            digest = _get_verified_digest(self.app_key, data)
+
+        if digest is not None and digest in self._verified_digests:
+            # Same manifest we verified on an earlier refresh
+            log.debug("Version file already verified")
+            self.json_data.pop("signature", None)
+            self.verified = True
+        else:
+            # If verified we set self.verified to True.
+            if header is not None:
+                verified = self._verify_payload_sig(payload, header.get("signature"))
+            else:
+                verified = self._verify_sig(self.json_data)
+            if verified is True and digest is not None:
+                self._verified_digests.add(digest)
 
         self.easy_data = _EAD(self.json_data)
+        self.manifest = CompiledManifest(self.json_data)
+
+    # Loads the signed index of manifest shards in place of the
+    # whole manifest. The shards are loaded in _update_check.
+    def _get_manifest_index(self):
+        log.debug("Loading manifest index...")
+        self.manifest_index = None
+        self._manifest_shards = {}
+
+        filenames = [self.manifest_index_file, self.manifest_index_file_compat]
+        data = self._get_manifest_from_http(filenames)
+        if data is None:
+            data = self._get_manifest_from_disk(filenames)
+
+        if data is None:
+            log.debug("No manifest index found")
+            return False
+
+        try:
+            header, payload = unpack_manifest(data)
+            index = json.loads(payload.decode("utf-8"))
+        except (UtilsError, ValueError) as err:
+            log.debug(err, exc_info=True)
+            return False
+
+        digest = None
+        if self.app_key is not None:
+            digest = _get_verified_digest(self.app_key, data)
+
+        if digest is not None and digest in self._verified_digests:
+            log.debug("Manifest index already verified")
+        elif self._verify_payload_sig(payload, header.get("signature")) is True:
+            if digest is not None:
+                self._verified_digests.add(digest)
+        else:
+            log.debug("Manifest index not verified")
+            return False
+
+        self.manifest_index = index.get("shards", {})
+        self.json_data = {}
+        self.easy_data = _EAD(self.json_data)
+        self.manifest = CompiledManifest(self.json_data)
+        self.verified = True
+        self.ready = True
+        return True
+
+    # Returns the manifest shard for name & its compiled manifest. Non
+    # strict checks look at every channel so they need the shard holding
+    # all of them.
+    def _get_manifest_shard(self, name, channel, strict):
+        info = self.manifest_index.get(name)
+        if info is None:
+            return None
+
+        if strict is True:
+            info = info.get("channels", {}).get(channel, info)
+
+        filename = info.get("filename")
+        if filename is None:
+            return None
+
+        if filename in self._manifest_shards:
+            return self._manifest_shards[filename]
+
+        # Shards are verified with the hash from the signed index
+        data = self._get_manifest_from_http([filename])
+        if data is None or get_hash(data) != info.get("file_hash"):
+            log.debug("Trying cached copy of %s", filename)
+            data = self._get_manifest_from_disk([filename])
+
+        if data is None or get_hash(data) != info.get("file_hash"):
+            log.debug("Manifest shard %s not verified", filename)
+            return None
+
+        try:
+            shard = json.loads(data.decode("utf-8"))
+        except ValueError as err:
+            log.debug(err, exc_info=True)
+            return None
+
+        self._manifest_shards[filename] = (shard, CompiledManifest(shard))
+        return self._manifest_shards[filename]
 
     # Verify the signature of the version manifest.
     def _verify_sig(self, data):
         if self.app_key is None:
             log.debug("App key is None")
-            return
+            return False
 
         # Checking to see if there is a signature key in the version file.
         if "signature" in data.keys():
@@ -557,22 +860,37 @@ class Client(object):
 
             update_data = json.dumps(data, sort_keys=True)
 
-            pub_key = VerifyKey(self.app_key, UnpaddedBase64Encoder)
-
             if not isinstance(update_data, bytes):
                 update_data = bytes(update_data, encoding="utf-8")
 
-            try:
-                signature = UnpaddedBase64Encoder.decode(signature)
-                pub_key.verify(update_data, signature)
-            except Exception as err:
-                log.debug("Version file not verified")
-                log.debug(err, exc_info=True)
-            else:
-                log.debug("Version file verified")
-                self.verified = True
+            return self._verify_payload_sig(update_data, signature)
         else:
             log.debug("Signature not in update data")
+        return False
+
+    # Verify the signature over the exact bytes that were signed.
+    def _verify_payload_sig(self, payload, signature):
+        if self.app_key is None:
+            log.debug("App key is None")
+            return False
+
+        if signature is None:
+            log.debug("Signature not in update data")
+            return False
+
+        pub_key = VerifyKey(self.app_key, UnpaddedBase64Encoder)
+
+        try:
+            signature = UnpaddedBase64Encoder.decode(signature)
+            pub_key.verify(payload, signature)
+        except Exception as err:
+            log.debug("Version file not verified")
+            log.debug(err, exc_info=True)
+        else:
+            log.debug("Version file verified")
+            self.verified = True
+            return True
+        return False
 
     def _setup(self):
         # Create required directories on end-users computer
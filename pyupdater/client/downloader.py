@@ -23,15 +23,22 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import datetime
 import hashlib
 import inspect
+import io
+import json
 import logging
 import os
+import threading
 import time
 from urllib.parse import quote as url_quote
 
 import certifi
 import urllib3
+from urllib3.poolmanager import SSL_KEYWORDS
+
 from pyupdater.utils.exceptions import FileDownloaderError
 
 log = logging.getLogger(__name__)
@@ -55,6 +62,383 @@ def get_hash(data):
     return hash_
 
 
+# Path -> ((size, mtime, inode), hash) of files already hashed
+_file_hash_cache = {}
+_file_hash_lock = threading.Lock()
+
+
+def get_file_hash(filename, block_size=1024 * 1024):
+    """Get hash of a file without reading all of it into memory
+
+    The hash is cached until the file's size, modification time or
+    inode changes, so checking an unchanged file again is cheap.
+
+    Args:
+
+        filename (str): Path of the file you want hash of.
+
+    Kwargs:
+
+        block_size (int): Number of bytes to read at a time
+
+    Returns:
+
+        (str): sha256 hash
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    with _file_hash_lock:
+        cached = _file_hash_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    hash_ = _hash_file(path, block_size)
+    log.debug("Hash for %s: %s", filename, hash_)
+    with _file_hash_lock:
+        _file_hash_cache[path] = (key, hash_)
+    return hash_
+
+
+def _hash_file(path, block_size):
+    hash_ = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            hash_.update(block)
+    return hash_.hexdigest()
+
+
+def _get_buffer(size):
+    # Returns a BytesIO with room for size bytes allocated up front.
+    # Once it has been filled, getvalue returns the underlying buffer
+    # without copying it.
+    buffer = io.BytesIO()
+    if size:
+        buffer.seek(size - 1)
+        buffer.write(b"\0")
+        buffer.seek(0)
+    return buffer
+
+
+def get_http_pool(
+    secure=True, headers=None, http_timeout=None, maxsize=1, keep_alive=False
+):
+    """Creates a connection pool for downloads
+
+    Kwargs:
+
+        secure (bool): Verify https connections
+
+        headers (dict): urllib3 and/or generic headers sent with every request
+
+        http_timeout (int): HTTP timeout or None
+
+        maxsize (int): Max number of connections kept open per host
+
+        keep_alive (bool): Ask servers to keep connections open. Open
+        connections are reused. TLS sessions aren't resumed when a new
+        connection has to be opened.
+
+    Returns:
+
+        (HttpPool): Connection pool
+    """
+    if secure:
+        _http = HttpPool(
+            cert_reqs=str("CERT_REQUIRED"),
+            ca_certs=certifi.where(),
+            timeout=http_timeout,
+            maxsize=maxsize,
+        )
+    else:
+        _http = HttpPool(timeout=http_timeout, maxsize=maxsize)
+
+    if keep_alive:
+        _http.headers.update(urllib3.util.make_headers(keep_alive=True))
+
+    if headers:
+        urllib_keys = inspect.getfullargspec(urllib3.util.make_headers).args
+        urllib_headers = {
+            header: value for header, value in headers.items() if header in urllib_keys
+        }
+        other_headers = {
+            header: value
+            for header, value in headers.items()
+            if header not in urllib_keys
+        }
+        _headers = urllib3.util.make_headers(**urllib_headers)
+        _headers.update(other_headers)
+        _http.headers.update(_headers)
+    log.debug("HTTP Timeout is " + str(http_timeout))
+    return _http
+
+
+class _CountingPoolMixin(object):
+    # Counts requests & the ones that had to open a new socket with the
+    # HttpPool that created the pool. Includes connections urllib3
+    # transparently reopened after the server closed them, which
+    # num_connections doesn't track. Counting in the manager keeps the
+    # counts after a host pool is evicted.
+    manager = None
+
+    def _make_request(self, conn, *args, **kwargs):
+        if self.manager is not None:
+            self.manager._add_request(getattr(conn, "sock", None) is None)
+        return super(_CountingPoolMixin, self)._make_request(conn, *args, **kwargs)
+
+
+class _HTTPConnectionPool(_CountingPoolMixin, urllib3.HTTPConnectionPool):
+    pass
+
+
+class _HTTPSConnectionPool(_CountingPoolMixin, urllib3.HTTPSConnectionPool):
+    pass
+
+
+class HttpPool(urllib3.PoolManager):
+    """A PoolManager that keeps count of how many connections
+    were opened & how many requests reused an open connection.
+
+    Only open connections are reused. TLS sessions aren't resumed
+    when a new connection has to be opened.
+    """
+
+    _counting_pools = {"http": _HTTPConnectionPool, "https": _HTTPSConnectionPool}
+
+    def __init__(self, *args, **kwargs):
+        super(HttpPool, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._requests = 0
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        # Same as PoolManager._new_pool but with pools that count
+        # connections
+        pool_cls = self._counting_pools[scheme]
+        if request_context is None:
+            request_context = self.connection_pool_kw.copy()
+        else:
+            request_context = request_context.copy()
+        for key in ("scheme", "host", "port"):
+            request_context.pop(key, None)
+        if scheme == "http":
+            for kw in SSL_KEYWORDS:
+                request_context.pop(kw, None)
+        pool = pool_cls(host, port, **request_context)
+        pool.manager = self
+        return pool
+
+    def _add_request(self, opened):
+        # Called from download threads
+        with self._lock:
+            self._requests += 1
+            if opened:
+                self._opened += 1
+
+    @property
+    def stats(self):
+        """Connection counters for all hosts
+
+        Returns:
+
+            (dict): opened - New connections. reused - Requests sent
+            over an already open connection. requests - All requests
+        """
+        with self._lock:
+            opened = self._opened
+            requests = self._requests
+        return {
+            "opened": opened,
+            "reused": max(requests - opened, 0),
+            "requests": requests,
+        }
+
+
+class MirrorStats(object):
+    """Keeps a per process latency & error score for each update url.
+    Used to route requests to the fastest healthy mirror.
+    """
+
+    # Weight given to the newest latency sample
+    ALPHA = 0.3
+
+    # Smaller downloads are mostly latency so they don't count
+    # towards the throughput
+    THROUGHPUT_MIN_SIZE = 256 * 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # url -> {"latency": float or None, "failures": int}
+        self._stats = {}
+        # Download speed in bytes per second across all urls
+        self._throughput = None
+
+    def add_latency(self, url, latency):
+        with self._lock:
+            stats = self._stats.setdefault(url, {"latency": None, "failures": 0})
+            if stats["latency"] is None:
+                stats["latency"] = latency
+            else:
+                stats["latency"] = (
+                    MirrorStats.ALPHA * latency
+                    + (1 - MirrorStats.ALPHA) * stats["latency"]
+                )
+            stats["failures"] = 0
+        log.debug("Mirror latency for %s: %.3fs", url, latency)
+
+    def add_throughput(self, size, elapsed):
+        if size < MirrorStats.THROUGHPUT_MIN_SIZE or elapsed <= 0:
+            return
+        rate = size / elapsed
+        with self._lock:
+            if self._throughput is None:
+                self._throughput = rate
+            else:
+                self._throughput = (
+                    MirrorStats.ALPHA * rate
+                    + (1 - MirrorStats.ALPHA) * self._throughput
+                )
+        log.debug("Download throughput: %.0f bytes/s", rate)
+
+    def get_throughput(self):
+        """Returns the average download speed in bytes per second or
+        None if nothing large enough has been downloaded yet"""
+        with self._lock:
+            return self._throughput
+
+    def add_failure(self, url):
+        with self._lock:
+            stats = self._stats.setdefault(url, {"latency": None, "failures": 0})
+            stats["failures"] += 1
+        log.debug("Mirror failure for %s", url)
+
+    def has_stats(self, urls):
+        with self._lock:
+            return all(u in self._stats for u in urls)
+
+    def sort_urls(self, urls):
+        """Returns urls ordered by health then latency. Mirrors we
+        know nothing about are tried after known healthy mirrors
+        and before failing mirrors.
+        """
+
+        def _key(item):
+            index, url = item
+            stats = self._stats.get(url)
+            if stats is None:
+                return (0, 1, 0, index)
+            if stats["failures"] > 0:
+                return (1, stats["failures"], 0, index)
+            return (0, 0, stats["latency"], index)
+
+        with self._lock:
+            ordered = sorted(enumerate(urls), key=_key)
+        return [u for _, u in ordered]
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._throughput = None
+
+
+# Shared by all downloaders in this process
+mirror_stats = MirrorStats()
+
+
+class RateLimiter(object):
+    """Token bucket used to cap download speed. A single limiter can be
+    shared by downloads running at the same time to keep their combined
+    speed under the cap.
+
+    Args:
+
+        rate (int): Max bytes per second
+
+    Kwargs:
+
+        burst (int): Max bytes that can be read at once after being idle.
+        Defaults to rate
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Takes amount bytes from the bucket, sleeping until the bucket
+        has refilled enough to pay for them. Returns seconds slept."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            # Going into debt lets reads larger than the bucket through
+            self._tokens -= amount
+            wait = 0
+            if self._tokens < 0:
+                wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class DownloadWindow(object):
+    """Daily time window, in local time, in which downloads may start.
+    Downloads already running when the window closes are finished.
+
+    Args:
+
+        start (str): Start of the window. "HH:MM"
+
+        end (str): End of the window. "HH:MM". If before start the
+        window spans midnight
+    """
+
+    def __init__(self, start, end):
+        self.start = DownloadWindow._parse(start)
+        self.end = DownloadWindow._parse(end)
+
+    @staticmethod
+    def _parse(value):
+        try:
+            hour, minute = value.split(":")
+            return datetime.time(int(hour), int(minute))
+        except Exception:
+            raise FileDownloaderError(
+                "Invalid download window time: {}".format(value), expected=True
+            )
+
+    def is_open(self, now=None):
+        now = (now or datetime.datetime.now()).time()
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+    def seconds_until_open(self, now=None):
+        now = now or datetime.datetime.now()
+        if self.is_open(now):
+            return 0
+        start = datetime.datetime.combine(now.date(), self.start)
+        if start <= now:
+            start += datetime.timedelta(days=1)
+        return (start - now).total_seconds()
+
+    def wait(self):
+        """Blocks until the window is open"""
+        delay = self.seconds_until_open()
+        if delay > 0:
+            log.debug("Waiting %s seconds for the download window", int(delay))
+            time.sleep(delay)
+
+
 class FileDownloader(object):
     """The FileDownloader object downloads files to memory and
     verifies their hash.  If hash is verified data is either
@@ -80,6 +464,28 @@ class FileDownloader(object):
 
         False: Do not verify https connection
 
+    download_connections (int): Number of concurrent ranged requests used
+    for large downloads. Only used when the server advertises
+    "Accept-Ranges: bytes". Default 1
+
+    race_mirrors (bool): Request from all urls at once the first time
+    they are used and keep the first to respond. Default False
+
+    http_pool (HttpPool): Connection pool shared with other downloads.
+    If given, verify & headers are taken from the pool.
+
+    rate_limiter (RateLimiter): Caps the download speed. Default None
+
+    download_window (DownloadWindow): Only start the download inside
+    this time window. Default None
+
+    validators (dict): "etag" and/or "last_modified" of a copy we already
+    have. If the server answers 304 not_modified is set to True and no
+    data is returned. Default None
+
+    download_dir (str): Folder the file & its partial download are
+    written to. Default None, the current working directory
+
     """
 
     def __init__(self, *args, **kwargs):
@@ -113,6 +519,24 @@ class FileDownloader(object):
         # Progress hooks to be called
         self.progress_hooks = kwargs.get("progress_hooks", [])
 
+        # Number of concurrent connections used for segmented downloads.
+        # A value of 1 disables segmented downloads.
+        self.download_connections = kwargs.get("download_connections") or 1
+
+        # Race all urls when we have no latency info for them yet
+        self.race_mirrors = kwargs.get("race_mirrors", False)
+
+        # Used to throttle & schedule background downloads
+        self.rate_limiter = kwargs.get("rate_limiter")
+        self.download_window = kwargs.get("download_window")
+
+        # Where the file is written on disk. The url still uses filename
+        self.download_dir = kwargs.get("download_dir")
+        if self.download_dir:
+            self.file_path = os.path.join(self.download_dir, self.filename)
+        else:
+            self.file_path = self.filename
+
         # Initial block size for each read
         self.block_size = 4096 * 4
 
@@ -121,50 +545,50 @@ class FileDownloader(object):
         # Max size of download to memory, larger file will be stored to file
         self.download_max_size = 16 * 1024 * 1024
         # Hold all binary data once file has been downloaded
-        self.file_binary_data = []
+        self.file_binary_data = None
         # Temporary file to hold large download data
-        self.file_binary_path = self.filename + ".part"
+        self.file_binary_path = self.file_path + ".part"
+        # Progress of a partial download. Used to resume the download
+        self.resume_path = self.file_binary_path + ".json"
+        # Amount of data to download between saving resume progress
+        self.resume_checkpoint_size = 1024 * 1024
 
         # Total length of data to download.
         self.content_length = None
 
+        # Full url of the resource once a mirror has responded
+        self.file_url = None
+
+        # ETag & Last-Modified of a copy we already have. Used to make
+        # a conditional request. not_modified is set if the server
+        # answers 304, in which case nothing is downloaded.
+        self.validators = kwargs.get("validators")
+        self.not_modified = False
+
+        # Validators sent by the server for this download
+        self.etag = None
+        self.last_modified = None
+
         # Extra headers
         self.headers = kwargs.get("headers")
 
         self.http_timeout = kwargs.get("http_timeout")
 
-        if self.verify is True:
-            self.http_pool = self._get_http_pool()
-        else:
-            self.http_pool = self._get_http_pool(secure=False)
+        # A pool shared with other downloaders lets us reuse connections
+        self.http_pool = kwargs.get("http_pool")
+        if self.http_pool is None:
+            if self.verify is True:
+                self.http_pool = self._get_http_pool()
+            else:
+                self.http_pool = self._get_http_pool(secure=False)
 
     def _get_http_pool(self, secure=True):
-        if secure:
-            _http = urllib3.PoolManager(
-                cert_reqs=str("CERT_REQUIRED"),
-                ca_certs=certifi.where(),
-                timeout=self.http_timeout,
-            )
-        else:
-            _http = urllib3.PoolManager(timeout=self.http_timeout)
-
-        if self.headers:
-            urllib_keys = inspect.getfullargspec(urllib3.util.make_headers).args
-            urllib_headers = {
-                header: value
-                for header, value in self.headers.items()
-                if header in urllib_keys
-            }
-            other_headers = {
-                header: value
-                for header, value in self.headers.items()
-                if header not in urllib_keys
-            }
-            _headers = urllib3.util.make_headers(**urllib_headers)
-            _headers.update(other_headers)
-            _http.headers.update(_headers)
-        log.debug("HTTP Timeout is " + str(self.http_timeout))
-        return _http
+        return get_http_pool(
+            secure=secure,
+            headers=self.headers,
+            http_timeout=self.http_timeout,
+            maxsize=self.download_connections,
+        )
 
     def download_verify_write(self):
         """
@@ -180,8 +604,8 @@ class FileDownloader(object):
                  False - Hashes don't match
         """
 
-        # Downloading data internally
-        check = self._download_to_storage(check_hash=True)
+        # Stream straight to disk so the data is never buffered
+        check = self._download_to_storage(check_hash=True, storage="file")
         # If no hash is passed just write the file
         if check is True or check is None:
             self._write_to_file()
@@ -207,8 +631,8 @@ class FileDownloader(object):
         check = self._download_to_storage(check_hash=True)
         if check is True or check is None:
             if self.file_binary_type == "memory":
-                if self.file_binary_data:
-                    return b"".join(self.file_binary_data)
+                if self.file_binary_data is not None:
+                    return self.file_binary_data.getvalue()
                 else:
                     return None
             else:
@@ -220,6 +644,29 @@ class FileDownloader(object):
         else:
             return None
 
+    def download_verify_stream(self, sink):
+        """
+        Downloads file, writing each block to sink as it arrives while
+        hashing it. Nothing is buffered, so the sink must discard what
+        it was given if verification fails.
+
+        Args:
+
+            sink (object): Any object with a write method. E.g. an open
+            file or socket.
+
+        Returns:
+
+             (bool):
+
+                 True - Hashes match or no hash was given during initialization.
+
+                 False - Hashes don't match or the download failed
+        """
+        check = self._download_to_storage(check_hash=True, sink=sink)
+        # None: Data was received but there was no hash to check
+        return check is True or check is None
+
     @staticmethod
     def _best_block_size(elapsed_time, _bytes):
         # Returns best block size for current Internet connection speed
@@ -234,88 +681,190 @@ class FileDownloader(object):
             return int(new_min)
         return int(rate)
 
-    def _download_to_storage(self, check_hash=True):
-        data = self._create_response()
+    def _download_to_storage(self, check_hash=True, storage=None, sink=None):
+        # storage forces "memory" or "file" storage. Chosen by size if None.
+        # Blocks are written to sink instead, if one is given.
+        if self.download_window is not None:
+            self.download_window.wait()
+
+        # A previous download of this file may have been interrupted.
+        # If so we'll try to continue where it stopped.
+        if sink is None:
+            resume_state = self._load_resume_state()
+        else:
+            resume_state = None
+        if resume_state is not None:
+            data = self._create_response(headers=self._get_resume_headers(resume_state))
+            if data is None or not self._is_valid_resume(data, resume_state):
+                log.debug("Cannot resume download. Starting over")
+                resume_state = None
+                self._remove_resume_state()
+                if data is not None:
+                    data.release_conn()
+                data = self._create_response()
+        else:
+            data = self._create_response(headers=self._get_conditional_headers())
 
+        # Every url failed. None is reserved for data received
+        # without a hash to check it against.
         if data is None:
-            return None
-        hash_ = hashlib.sha256()
+            return False
 
-        # Getting length of file to show progress
-        self.content_length = FileDownloader._get_content_length(data)
-        if self.content_length is None:
-            log.debug("Content-Length not in headers")
-            log.debug("Callbacks will not show time left " "or percent downloaded.")
-        if self.content_length is None or self.content_length > self.download_max_size:
+        # Used to make the next request for this file conditional
+        self.etag = data.headers.get("ETag")
+        self.last_modified = data.headers.get("Last-Modified")
+        if data.status == 304:
+            log.debug("Not modified since last download")
+            self.not_modified = True
+            data.release_conn()
+            return False
+
+        offset = 0
+        if resume_state is not None:
+            offset = resume_state["offset"]
+            self.content_length = resume_state["content_length"]
+            log.debug("Resuming download at byte %s", offset)
+            # Hash the data we already have on disk so the final
+            # hash covers the whole file
+            hash_ = self._update_hash_from_file(hashlib.sha256(), 0, offset)
+        else:
+            hash_ = hashlib.sha256()
+
+            # Getting length of file to show progress
+            self.content_length = FileDownloader._get_content_length(data)
+            if self.content_length is None:
+                log.debug("Content-Length not in headers")
+                log.debug("Callbacks will not show time left " "or percent downloaded.")
+        if sink is not None:
+            self.file_binary_type = "stream"
+        elif offset > 0 or storage == "file":
+            self.file_binary_type = "file"
+        elif storage != "memory" and (
+            self.content_length is None or self.content_length > self.download_max_size
+        ):
             log.debug("Using file as storage since the file is too large")
             self.file_binary_type = "file"
         else:
             self.file_binary_type = "memory"
 
+        if offset == 0 and self._can_download_segmented(data):
+            # We only needed the headers from this response
+            data.close()
+            data.release_conn()
+            file_hash = self._download_segmented()
+            if file_hash is not None:
+                if check_hash:
+                    return self._check_file_hash(file_hash)
+                return None
+
+            log.debug("Segmented download failed. Using a single connection")
+            data = self._create_response()
+            if data is None:
+                return False
+
         # Setting start point to show progress
-        received_data = 0
+        received_data = offset
+        percent = FileDownloader._calc_progress_percent(
+            received_data, self.content_length
+        )
 
-        start_download = time.time()
-        block = data.read(1)
-        received_data += len(block)
         if self.file_binary_type == "memory":
-            self.file_binary_data = [block]
+            self.file_binary_data = _get_buffer(self.content_length)
+            write = self.file_binary_data.write
+        elif self.file_binary_type == "stream":
+            write = sink.write
         else:
-            binary_file = open(self.file_binary_path, "wb")
-            binary_file.write(block)
-        hash_.update(block)
-        while 1:
-            # Grabbing start time for use with best block size
-            start_block = time.time()
-
-            # Get data from connection
-            block = data.read(self.block_size)
-
-            # Grabbing end time for use with best block size
-            end_block = time.time()
-
-            if len(block) == 0:
-                # No more data, get out of this never ending loop!
-                if self.file_binary_type == "file":
-                    binary_file.close()
-                break
-
-            # Calculating the best block size for the
-            # current connection speed
-            self.block_size = self._best_block_size(end_block - start_block, len(block))
-            log.debug("Block size: %s", self.block_size)
-            if self.file_binary_type == "memory":
-                self.file_binary_data.append(block)
+            if offset > 0:
+                binary_file = open(self.file_binary_path, "r+b")
+                binary_file.seek(offset)
+                binary_file.truncate()
             else:
-                binary_file.write(block)
+                binary_file = open(self.file_binary_path, "wb")
+                resume_state = self._get_resume_state(data)
+            self._save_resume_state(resume_state, offset)
+            last_checkpoint = offset
+            write = binary_file.write
+
+        start_download = time.time()
+        try:
+            block = data.read(1)
+            received_data += len(block)
+            write(block)
             hash_.update(block)
+            self._throttle(len(block))
+            while 1:
+                # Grabbing start time for use with best block size
+                start_block = time.time()
 
-            # Total data we've received so far
+                # Get data from connection
+                block = data.read(self.block_size)
 
-            received_data += len(block)
+                # Grabbing end time for use with best block size
+                end_block = time.time()
 
-            # If content length is None we will return a static percent
-            # -.-%
-            percent = FileDownloader._calc_progress_percent(
-                received_data, self.content_length
-            )
+                if len(block) == 0:
+                    # No more data, get out of this never ending loop!
+                    if self.file_binary_type == "file":
+                        binary_file.close()
+                    break
 
-            # If content length is None we will return a static time remaining
-            # --:--
-            time_left = FileDownloader._calc_eta(
-                start_download, time.time(), self.content_length, received_data
-            )
+                # Calculating the best block size for the
+                # current connection speed
+                self.block_size = self._best_block_size(
+                    end_block - start_block, len(block)
+                )
+                log.debug("Block size: %s", self.block_size)
+                write(block)
+                hash_.update(block)
+                self._throttle(len(block))
+
+                # Total data we've received so far
+
+                received_data += len(block)
+
+                # Record our progress so an interrupted download
+                # can be resumed later
+                if (
+                    self.file_binary_type == "file"
+                    and received_data - last_checkpoint >= self.resume_checkpoint_size
+                ):
+                    binary_file.flush()
+                    self._save_resume_state(resume_state, received_data)
+                    last_checkpoint = received_data
+
+                # If content length is None we will return a static percent
+                # -.-%
+                percent = FileDownloader._calc_progress_percent(
+                    received_data, self.content_length
+                )
 
-            status = {
-                "total": self.content_length,
-                "downloaded": received_data,
-                "status": "downloading",
-                "percent_complete": percent,
-                "time": time_left,
-            }
+                # If content length is None we will return a static time remaining
+                # --:--
+                now = time.time()
+                time_left = FileDownloader._calc_eta(
+                    start_download, now, self.content_length, received_data
+                )
 
-            # Call all progress hooks with status data
-            self._call_progress_hooks(status)
+                status = {
+                    "total": self.content_length,
+                    "downloaded": received_data,
+                    "status": "downloading",
+                    "percent_complete": percent,
+                    "time": time_left,
+                    "rate": FileDownloader._calc_rate(
+                        start_download, now, received_data - offset
+                    ),
+                }
+
+                # Call all progress hooks with status data
+                self._call_progress_hooks(status)
+        except (urllib3.exceptions.HTTPError, IOError) as err:
+            log.debug("Download interrupted")
+            log.debug(err, exc_info=True)
+            if self.file_binary_type == "file":
+                binary_file.close()
+                self._save_resume_state(resume_state, received_data)
+            return False
 
         status = {
             "total": self.content_length,
@@ -323,32 +872,310 @@ class FileDownloader(object):
             "status": "finished",
             "percent_complete": percent,
             "time": "00:00",
+            "rate": FileDownloader._calc_rate(
+                start_download, time.time(), received_data - offset
+            ),
         }
         self._call_progress_hooks(status)
         log.debug("Download Complete")
+        mirror_stats.add_throughput(
+            received_data - offset, time.time() - start_download
+        )
+
+        if self.content_length is not None and received_data != self.content_length:
+            log.debug("Received %s of %s bytes", received_data, self.content_length)
+            if self.file_binary_type == "file":
+                # The connection was closed early. Keep what we have.
+                self._save_resume_state(resume_state, received_data)
+            elif self.file_binary_type == "memory":
+                self.file_binary_data = None
+            return False
 
         if check_hash:
-            # Checks hash of downloaded file
-            if self.hexdigest is None:
-                # No hash provided to check.
-                # So just return any data received
-                log.debug("No hash to verify")
-                return None
-            if self.file_binary_data is None:
+            if self.file_binary_type == "memory" and self.file_binary_data is None:
                 # Exit quickly if we got nothing to compare
                 # Also I'm sure we'll get an exception trying to
                 # pass None to get hash :)
                 log.debug("Cannot verify file hash - No Data")
                 return False
-            log.debug("Checking file hash")
-            log.debug("Update hash: %s", self.hexdigest)
-
-            file_hash = hash_.hexdigest()
-            if file_hash == self.hexdigest:
-                log.debug("File hash verified")
-                return True
-            log.debug("Cannot verify file hash")
+            check = self._check_file_hash(hash_.hexdigest())
+            if self.file_binary_type == "file":
+                self._remove_resume_state()
+                if check is False and os.path.exists(self.file_binary_path):
+                    # Corrupt data. Don't resume from it next time.
+                    os.remove(self.file_binary_path)
+            return check
+        self._remove_resume_state()
+
+    def _get_conditional_headers(self):
+        if not self.validators:
+            return None
+        headers = {}
+        if self.validators.get("etag"):
+            headers["If-None-Match"] = self.validators["etag"]
+        if self.validators.get("last_modified"):
+            headers["If-Modified-Since"] = self.validators["last_modified"]
+        return headers
+
+    def _get_resume_state(self, data):
+        # We can only safely resume when we know the final size
+        # and have a hash to verify the assembled file against
+        if self.content_length is None or self.hexdigest is None:
+            return None
+        return {
+            "hexdigest": self.hexdigest,
+            "content_length": self.content_length,
+            "etag": data.headers.get("ETag"),
+            "last_modified": data.headers.get("Last-Modified"),
+        }
+
+    def _save_resume_state(self, resume_state, offset):
+        if resume_state is None:
+            return
+        resume_state = dict(resume_state, offset=offset)
+        try:
+            with open(self.resume_path, "w") as f:
+                json.dump(resume_state, f)
+        except Exception as err:
+            log.debug(err, exc_info=True)
+
+    def _load_resume_state(self):
+        # Returns the saved state of an interrupted download
+        # or None if the partial download cannot be continued
+        if self.hexdigest is None or not os.path.exists(self.resume_path):
+            return None
+        try:
+            with open(self.resume_path, "r") as f:
+                resume_state = json.load(f)
+            offset = min(
+                int(resume_state["offset"]), os.path.getsize(self.file_binary_path)
+            )
+            content_length = int(resume_state["content_length"])
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            self._remove_resume_state()
+            return None
+
+        if resume_state.get("hexdigest") != self.hexdigest:
+            log.debug("Partial download is for a different file")
+            self._remove_resume_state()
+            return None
+
+        if offset <= 0 or offset >= content_length:
+            self._remove_resume_state()
+            return None
+
+        resume_state["offset"] = offset
+        resume_state["content_length"] = content_length
+        return resume_state
+
+    def _remove_resume_state(self):
+        if os.path.exists(self.resume_path):
+            os.remove(self.resume_path)
+
+    @staticmethod
+    def _get_resume_headers(resume_state):
+        headers = {"Range": "bytes={}-".format(resume_state["offset"])}
+        # Make sure the file didn't change on the server since
+        # we downloaded the first part. If it did we'll get the
+        # whole file back with a 200.
+        validator = resume_state.get("etag") or resume_state.get("last_modified")
+        if validator is not None:
+            headers["If-Range"] = validator
+        return headers
+
+    @staticmethod
+    def _is_valid_resume(data, resume_state):
+        if data.status != 206:
             return False
+        content_range = data.headers.get("Content-Range", "")
+        expected = "bytes {}-{}/{}".format(
+            resume_state["offset"],
+            resume_state["content_length"] - 1,
+            resume_state["content_length"],
+        )
+        return content_range == expected
+
+    def _update_hash_from_file(self, hash_, start, length):
+        # Adds a byte range of the partial download to the given hash.
+        # The file is opened for every call so we never read stale
+        # buffered data while other threads are writing to it.
+        with open(self.file_binary_path, "rb") as f:
+            f.seek(start)
+            remaining = length
+            while remaining > 0:
+                block = f.read(min(remaining, 4194304))
+                if len(block) == 0:
+                    raise FileDownloaderError(
+                        "Partial file is truncated", expected=True
+                    )
+                hash_.update(block)
+                remaining -= len(block)
+        return hash_
+
+    def _check_file_hash(self, file_hash):
+        # Checks hash of downloaded file
+        if self.hexdigest is None:
+            # No hash provided to check.
+            # So just return any data received
+            log.debug("No hash to verify")
+            return None
+        log.debug("Checking file hash")
+        log.debug("Update hash: %s", self.hexdigest)
+
+        if file_hash == self.hexdigest:
+            log.debug("File hash verified")
+            return True
+        log.debug("Cannot verify file hash")
+        return False
+
+    def _can_download_segmented(self, data):
+        # Segmented downloads are only worth it for large files
+        # written to disk from servers which support range requests
+        if self.download_connections < 2 or self.file_binary_type != "file":
+            return False
+        if self.content_length is None:
+            return False
+        if self.content_length <= self.download_max_size:
+            return False
+        if data.headers.get("Accept-Ranges", "").lower() != "bytes":
+            log.debug("Server does not support range requests")
+            return False
+        return True
+
+    def _get_segments(self):
+        # Splits the content length into contiguous (start, end) byte
+        # ranges. End is inclusive to match the Range header.
+        count = min(self.download_connections, self.content_length)
+        segment_size = self.content_length // count
+        segments = []
+        for i in range(count):
+            start = i * segment_size
+            if i == count - 1:
+                end = self.content_length - 1
+            else:
+                end = start + segment_size - 1
+            segments.append((start, end))
+        return segments
+
+    def _download_segmented(self):
+        # Downloads byte ranges of the file concurrently into a
+        # preallocated file. Segments are hashed in order as they
+        # complete so we still end up with a single sha256 of the file.
+        # Returns the hex digest or None if any segment failed.
+        segments = self._get_segments()
+        log.debug("Downloading %s segments", len(segments))
+
+        with open(self.file_binary_path, "wb") as f:
+            f.truncate(self.content_length)
+
+        progress = {
+            "lock": threading.Lock(),
+            "received": 0,
+            "start": time.time(),
+        }
+
+        hash_ = hashlib.sha256()
+        try:
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                futures = [
+                    executor.submit(self._download_segment, start, end, progress)
+                    for start, end in segments
+                ]
+                for (start, end), future in zip(segments, futures):
+                    future.result()
+                    self._update_hash_from_file(hash_, start, end - start + 1)
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            if os.path.exists(self.file_binary_path):
+                os.remove(self.file_binary_path)
+            return None
+
+        status = {
+            "total": self.content_length,
+            "downloaded": progress["received"],
+            "status": "finished",
+            "percent_complete": "100.0",
+            "time": "00:00",
+            "rate": FileDownloader._calc_rate(
+                progress["start"], time.time(), progress["received"]
+            ),
+        }
+        self._call_progress_hooks(status)
+        log.debug("Download Complete")
+        mirror_stats.add_throughput(
+            progress["received"], time.time() - progress["start"]
+        )
+        return hash_.hexdigest()
+
+    def _download_segment(self, start, end, progress):
+        headers = self.http_pool.headers.copy()
+        headers["Range"] = "bytes={}-{}".format(start, end)
+        data = self.http_pool.urlopen(
+            "GET",
+            self.file_url,
+            headers=headers,
+            preload_content=False,
+            retries=self.max_download_retries,
+            decode_content=False,
+        )
+        try:
+            content_range = data.headers.get("Content-Range", "")
+            if data.status != 206 or not content_range.startswith(
+                "bytes {}-{}/".format(start, end)
+            ):
+                raise FileDownloaderError(
+                    "Invalid range response {}".format(data.status), expected=True
+                )
+
+            block_size = self.block_size
+            position = start
+            with open(self.file_binary_path, "r+b") as f:
+                f.seek(start)
+                while position <= end:
+                    start_block = time.time()
+                    block = data.read(block_size)
+                    end_block = time.time()
+                    if len(block) == 0:
+                        break
+                    block_size = self._best_block_size(
+                        end_block - start_block, len(block)
+                    )
+                    f.write(block)
+                    position += len(block)
+                    self._update_segment_progress(progress, len(block))
+                    self._throttle(len(block))
+        finally:
+            data.release_conn()
+
+        if position != end + 1:
+            raise FileDownloaderError("Incomplete segment download", expected=True)
+
+    def _update_segment_progress(self, progress, received):
+        # Called from the segment threads
+        with progress["lock"]:
+            progress["received"] += received
+            received_data = progress["received"]
+            now = time.time()
+            status = {
+                "total": self.content_length,
+                "downloaded": received_data,
+                "status": "downloading",
+                "percent_complete": FileDownloader._calc_progress_percent(
+                    received_data, self.content_length
+                ),
+                "time": FileDownloader._calc_eta(
+                    progress["start"], now, self.content_length, received_data
+                ),
+                "rate": FileDownloader._calc_rate(
+                    progress["start"], now, received_data
+                ),
+            }
+            self._call_progress_hooks(status)
+
+    def _throttle(self, received):
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(received)
 
     # Calling all progress hooks
     def _call_progress_hooks(self, data):
@@ -362,54 +1189,123 @@ class FileDownloader(object):
 
     # Creating response object to start download
     # Attempting to do some error correction for aws s3 urls
-    def _create_response(self):
+    def _create_response(self, headers=None):
+        # Extra headers for this request only
+        request_headers = self.http_pool.headers.copy()
+        if headers is not None:
+            request_headers.update(headers)
+        success_status = [200]
+        if "Range" in request_headers:
+            success_status.append(206)
+        if "If-None-Match" in request_headers or "If-Modified-Since" in request_headers:
+            success_status.append(304)
+
+        # Fastest healthy mirrors first
+        urls = mirror_stats.sort_urls(self.urls)
+
         data = None
-        max_download_retries = self.max_download_retries
-        for url in self.urls:
-            # Create url for resource
-            file_url = url + url_quote(self.filename)
-            log.debug("Url for request: %s", file_url)
-            try:
-                data = self.http_pool.urlopen(
-                    "GET",
-                    file_url,
-                    preload_content=False,
-                    retries=max_download_retries,
-                    decode_content=False,
-                )
-            except urllib3.exceptions.SSLError:
-                log.debug("SSL cert not verified")
-                continue
-            except urllib3.exceptions.MaxRetryError:
-                log.debug("MaxRetryError")
-                continue
-            except Exception as e:
-                # Catch whatever else comes up and log it
-                # to help fix other http related issues
-                log.debug(str(e), exc_info=True)
-            else:
-                if data.status != 200:
-                    log.debug("Received a non-200 response %d", data.status)
-                    data = None
-                else:
+        if self.race_mirrors and len(urls) > 1 and not mirror_stats.has_stats(urls):
+            # We don't know anything about these mirrors yet so
+            # we'll request from all of them and keep the first to answer
+            data = self._race_mirrors(urls, request_headers, success_status)
+        else:
+            for url in urls:
+                data = self._open_url(url, request_headers, success_status)
+                if data is not None:
                     break
 
         if data is not None:
-            log.debug("Resource URL: %s", file_url)
+            log.debug("Resource URL: %s", self.file_url)
         else:
             log.debug("Could not create resource URL.")
         return data
 
+    def _race_mirrors(self, urls, request_headers, success_status):
+        lock = threading.Lock()
+        state = {"winner": None}
+
+        def _open(url):
+            data = self._open_url(
+                url, request_headers, success_status, set_file_url=False
+            )
+            with lock:
+                if data is not None and state["winner"] is None:
+                    state["winner"] = url
+                    return data
+            # Slower mirrors still give us a latency score
+            # but we don't need their data
+            if data is not None:
+                data.close()
+                data.release_conn()
+            return None
+
+        executor = ThreadPoolExecutor(max_workers=len(urls))
+        futures = [executor.submit(_open, url) for url in urls]
+        data = None
+        try:
+            for future in as_completed(futures):
+                data = future.result()
+                if data is not None:
+                    break
+        finally:
+            executor.shutdown(wait=False)
+
+        if data is not None:
+            self.file_url = state["winner"] + url_quote(self.filename)
+            log.debug("Mirror race won by %s", state["winner"])
+        return data
+
+    def _open_url(self, url, request_headers, success_status, set_file_url=True):
+        # Create url for resource
+        file_url = url + url_quote(self.filename)
+        log.debug("Url for request: %s", file_url)
+        start = time.time()
+        try:
+            data = self.http_pool.urlopen(
+                "GET",
+                file_url,
+                headers=request_headers,
+                preload_content=False,
+                retries=self.max_download_retries,
+                decode_content=False,
+            )
+        except urllib3.exceptions.SSLError:
+            log.debug("SSL cert not verified")
+            mirror_stats.add_failure(url)
+            return None
+        except urllib3.exceptions.MaxRetryError:
+            log.debug("MaxRetryError")
+            mirror_stats.add_failure(url)
+            return None
+        except Exception as e:
+            # Catch whatever else comes up and log it
+            # to help fix other http related issues
+            log.debug(str(e), exc_info=True)
+            mirror_stats.add_failure(url)
+            return None
+
+        if data.status not in success_status:
+            # A stale mirror answers 404 quickly. It mustn't be ranked
+            # as the fastest.
+            log.debug("Received a non-200 response %d", data.status)
+            mirror_stats.add_failure(url)
+            data.release_conn()
+            return None
+        mirror_stats.add_latency(url, time.time() - start)
+
+        if set_file_url:
+            self.file_url = file_url
+        return data
+
     def _write_to_file(self):
         # Writes download data to disk
         if self.file_binary_type == "memory":
-            with open(self.filename, "wb") as f:
-                for block in self.file_binary_data:
-                    f.write(block)
+            with open(self.file_path, "wb") as f:
+                f.write(self.file_binary_data.getvalue())
         else:
-            if os.path.exists(self.filename):
-                os.unlink(self.filename)
-            os.rename(self.file_binary_path, self.filename)
+            if os.path.exists(self.file_path):
+                os.unlink(self.file_path)
+            os.rename(self.file_binary_path, self.file_path)
 
     @staticmethod
     def _get_content_length(data):
@@ -434,6 +1330,14 @@ class FileDownloader(object):
             return "--:--"
         return "%02d:%02d" % (eta_mins, eta_secs)
 
+    @staticmethod
+    def _calc_rate(start, now, received):
+        # Average download speed in bytes per second
+        dif = now - start
+        if dif < 0.001:  # One millisecond
+            return 0
+        return int(received / dif)
+
     @staticmethod
     def _calc_progress_percent(received, total):
         if total is None:
@@ -0,0 +1,252 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2020 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+import bisect
+import logging
+
+from dsdev_utils.helpers import Version
+
+from pyupdater import settings
+from pyupdater.utils.archive_payload import PATCH_PAYLOAD_KEY
+from pyupdater.utils.manifest import CUMULATIVE_PATCHES_KEY, PATCH_CHAINS_KEY
+from pyupdater.utils.patch_engines import DEFAULT_ENGINE, PATCH_ENGINE_KEY
+
+
+log = logging.getLogger(__name__)
+
+# Channels get_highest_version picks from
+CHANNELS = ["alpha", "beta", "stable"]
+
+
+class UpdateInfo(object):
+    """Archive & patch meta data of one version of a name on a platform
+
+    Args:
+
+        data (dict): Platform info from the version manifest
+    """
+
+    __slots__ = (
+        "filename",
+        "file_hash",
+        "file_size",
+        "patch_name",
+        "patch_hash",
+        "patch_size",
+        "patch_engine",
+        "patch_payload",
+        "cumulative_patches",
+    )
+
+    def __init__(self, data):
+        self.filename = data.get("filename")
+        self.file_hash = data.get("file_hash")
+        self.file_size = data.get("file_size")
+        self.patch_name = data.get("patch_name")
+        self.patch_hash = data.get("patch_hash")
+        self.patch_size = data.get("patch_size")
+        # Patches made before engines were recorded are bsdiff4
+        self.patch_engine = data.get(PATCH_ENGINE_KEY) or DEFAULT_ENGINE
+        # Params to rebuild the archive if the patch is of its payload
+        self.patch_payload = data.get(PATCH_PAYLOAD_KEY)
+
+        # Patches from older versions keyed by their version
+        self.cumulative_patches = {}
+        cumulative_patches = data.get(CUMULATIVE_PATCHES_KEY)
+        if isinstance(cumulative_patches, dict):
+            for version, patch in cumulative_patches.items():
+                self.cumulative_patches[version] = UpdateInfo(patch)
+
+
+class CompiledManifest(object):
+    """Version manifest compiled into lookup tables
+
+    Built once after the manifest is loaded so update checks & patch
+    chains don't walk the nested manifest dicts for every field.
+
+    Args:
+
+        json_data (dict): Version manifest
+    """
+
+    def __init__(self, json_data=None):
+        if not isinstance(json_data, dict):
+            json_data = {}
+
+        # (name, platform): {channel: Version}
+        self._latest = {}
+
+        # (name, version, platform): UpdateInfo
+        self._updates = {}
+
+        # (name, channel): Sorted list of Version
+        self._versions = {}
+
+        # (name, platform, channel): Patch chain precomputed at sign time
+        self._patch_chains = {}
+
+        # (name, version, platform): Versions with a cumulative patch
+        # from version
+        self._cumulative = {}
+
+        latest = json_data.get("latest")
+        if isinstance(latest, dict):
+            self._compile_latest(latest)
+
+        updates = json_data.get(settings.UPDATES_KEY)
+        if isinstance(updates, dict):
+            self._compile_updates(updates)
+
+        patch_chains = json_data.get(PATCH_CHAINS_KEY)
+        if isinstance(patch_chains, dict):
+            self._compile_patch_chains(patch_chains)
+
+    def _compile_latest(self, latest):
+        for name, channels in latest.items():
+            for channel, platforms in channels.items():
+                for platform, version in platforms.items():
+                    versions = self._latest.setdefault((name, platform), {})
+                    versions[channel] = Version(version)
+
+    def _compile_updates(self, updates):
+        for name, versions in updates.items():
+            channels = {}
+            for v, platforms in versions.items():
+                for platform, info in platforms.items():
+                    if isinstance(info, dict):
+                        update_info = UpdateInfo(info)
+                        self._updates[(name, v, platform)] = update_info
+                        for src in update_info.cumulative_patches:
+                            key = (name, src, platform)
+                            self._cumulative.setdefault(key, []).append(v)
+
+                version = Version(v)
+                channels.setdefault(version.channel, set()).add(version)
+
+            for channel, channel_versions in channels.items():
+                self._versions[(name, channel)] = sorted(channel_versions)
+
+        for versions in self._cumulative.values():
+            versions.sort(key=Version)
+
+    def _compile_patch_chains(self, patch_chains):
+        for name, platforms in patch_chains.items():
+            for platform, channels in platforms.items():
+                for channel, chain in channels.items():
+                    versions = chain.get("versions", [])
+                    # Chains without next only use regular patches
+                    next_ = chain.get("next", list(range(1, len(versions) + 1)))
+                    if not len(versions) == len(chain.get("sizes", [])) == len(next_):
+                        log.debug("Skipping bad patch chain for %s", name)
+                        continue
+                    positions = dict((v, i) for i, v in enumerate(versions))
+                    key = (name, platform, channel)
+                    self._patch_chains[key] = (
+                        versions,
+                        chain["sizes"],
+                        next_,
+                        positions,
+                    )
+
+    def get_latest(self, name, platform, channel, strict=True):
+        """Returns the latest version of name on platform
+
+        Args:
+
+            name (str): Name of the app or asset
+
+            platform (str): Platform to look up
+
+            channel (str): Release channel
+
+            strict (bool): False to look at every channel
+
+        Returns:
+
+            (Version): Latest version or None
+        """
+        versions = self._latest.get((name, platform), {})
+        if strict is False:
+            options = [versions[c] for c in CHANNELS if c in versions]
+            if len(options) == 0:
+                return None
+            return max(options)
+        return versions.get(channel)
+
+    def get_info(self, name, version, platform):
+        """Returns the UpdateInfo of name at version on platform or None"""
+        return self._updates.get((name, str(version), platform))
+
+    def get_patch(self, name, src, dst, platform):
+        """Returns the UpdateInfo of the patch from src to dst
+
+        A cumulative patch from src is used if there is one. Otherwise
+        the regular patch of dst, which is made from the version before it.
+        """
+        info = self.get_info(name, dst, platform)
+        if info is None:
+            return None
+        return info.cumulative_patches.get(str(src), info)
+
+    def get_cumulative_patches(self, name, version, platform):
+        """Returns the sorted versions with a cumulative patch from version"""
+        return self._cumulative.get((name, str(version), platform), [])
+
+    def get_versions(self, name, channel):
+        """Returns the sorted versions of name on channel"""
+        return self._versions.get((name, channel), [])
+
+    def get_versions_after(self, name, channel, version):
+        """Returns the sorted versions of name on channel newer than version"""
+        versions = self.get_versions(name, channel)
+        return versions[bisect.bisect_right(versions, version) :]
+
+    def get_patch_chain(self, name, platform, channel, version):
+        """Returns the precomputed patch chain from version
+
+        Returns:
+
+            (tuple): Versions to patch to in order & the total size of
+            their patches. None if there's no chain from version.
+        """
+        chain = self._patch_chains.get((name, platform, channel))
+        if chain is None:
+            return None
+
+        versions, sizes, next_, positions = chain
+        i = positions.get(str(version))
+        if i is None or i == len(versions) - 1:
+            return None
+
+        # Each step has to move forward so a bad chain can't loop
+        route = []
+        current, j = i, next_[i]
+        while current < j < len(versions):
+            route.append(versions[j])
+            if j == len(versions) - 1:
+                return route, sizes[i]
+            current, j = j, next_[j]
+        log.debug("Bad patch chain for %s", name)
+        return None
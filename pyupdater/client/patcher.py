@@ -23,25 +23,46 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
 from __future__ import print_function, unicode_literals
+from concurrent.futures import as_completed, ThreadPoolExecutor
 import logging
 import os
+import sys
 import tempfile
+import time
 
-import bsdiff4
-from dsdev_utils.crypto import get_package_hashes
-from dsdev_utils.helpers import EasyAccessDict, Version
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on windows
+    resource = None
+
+from dsdev_utils.helpers import Version
 from dsdev_utils.paths import ChDir, remove_any
 from dsdev_utils.system import get_system
 
-from pyupdater.client.downloader import FileDownloader
-from pyupdater import settings
+from pyupdater.client.downloader import FileDownloader, get_file_hash, mirror_stats
+from pyupdater.client.manifest import CompiledManifest
+from pyupdater.client.planner import add_apply_time, DEFAULT_BANDWIDTH, UpdatePlanner
+from pyupdater.utils.archive_payload import pack, pack_file, unpack, unpack_file
 from pyupdater.utils.exceptions import PatcherError
+from pyupdater.utils.patch_engines import get_engine
 
 log = logging.getLogger(__name__)
 
 _PLATFORM = get_system()
 
 
+def _get_peak_memory():
+    # Returns the peak resident set size of this process in MB
+    if resource is None:  # pragma: no cover
+        return "unknown"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on mac & kilobytes everywhere else
+    if sys.platform == "darwin":  # pragma: no cover
+        peak = peak / 1024
+    return "{0:.1f} MB".format(peak / 1024.0)
+
+
 class Patcher(object):
     """Downloads, verifies, and patches binaries
 
@@ -51,6 +72,9 @@ class Patcher(object):
 
         json_data (dict): Info dict with all package meta data
 
+        manifest (CompiledManifest): json_data compiled into lookup tables.
+        Compiled from json_data if not given
+
         current_version (str): Version number of currently installed binary
 
         latest_version (str): Newest version available
@@ -70,13 +94,33 @@ class Patcher(object):
         headers (dict): Headers to be used with http request.  Accepts urllib3 and generic headers.
 
         http_timeout (int): HTTP timeout or None
+
+        http_pool (HttpPool): Connection pool shared with the client
+
+        max_patch_downloads (int): Number of patches to download at once
+
+        pipeline_patches (bool): Apply each patch while the next ones are
+        still downloading
+
+        low_memory (bool): Download patches to disk & apply them file to
+        file instead of holding every patch in memory
+
+        rate_limiter (RateLimiter): Caps the speed of patch downloads
+
+        download_window (DownloadWindow): Time window patch downloads may
+        start in
+
+        planner (UpdatePlanner): Chooses between patching & a full update.
+        Built from the measured download speed if not given
     """
 
     def __init__(self, **kwargs):
         self.name = kwargs.get("name")
         self.channel = kwargs.get("channel")
         self.json_data = kwargs.get("json_data")
-        self.star_access_update_data = EasyAccessDict(self.json_data)
+        self.manifest = kwargs.get("manifest")
+        if self.manifest is None:
+            self.manifest = CompiledManifest(self.json_data)
         self.current_version = Version(kwargs.get("current_version"))
         self.latest_version = kwargs.get("latest_version")
         self.update_folder = kwargs.get("update_folder")
@@ -86,6 +130,14 @@ class Patcher(object):
         self.headers = kwargs.get("headers")
         self.downloader = kwargs.get("downloader")
         self.http_timeout = kwargs.get("http_timeout")
+        self.race_mirrors = kwargs.get("race_mirrors", False)
+        self.http_pool = kwargs.get("http_pool")
+        self.max_patch_downloads = kwargs.get("max_patch_downloads") or 4
+        self.pipeline_patches = kwargs.get("pipeline_patches", False)
+        self.low_memory = kwargs.get("low_memory", False)
+        self.rate_limiter = kwargs.get("rate_limiter")
+        self.download_window = kwargs.get("download_window")
+        self.planner = kwargs.get("planner")
 
         # Progress hooks to be called
         self.progress_hooks = kwargs.get("progress_hooks", [])
@@ -99,6 +151,20 @@ class Patcher(object):
         # binary blob of original archive to patch
         self.og_binary = None
 
+        # Pack params of the archive if og_binary is its uncompressed
+        # payload. Consecutive payload patches skip rebuilding the
+        # archives in between.
+        self.og_pack_params = None
+
+        # Low memory mode: paths of downloaded patches & the folder
+        # they're stored in. Lives in the update folder so the patched
+        # archive can be moved into place without a copy.
+        self.patch_files = []
+        self.patch_dir = None
+
+        # Path of the archive patched on disk in low memory mode
+        self.patched_file = None
+
         # Used for testing.
         self.platform = kwargs.get("platform", _PLATFORM)
 
@@ -124,23 +190,61 @@ class Patcher(object):
             log.debug("Cannot find all patches...")
             return False
 
-        # Download and verify patches in 1 go
+        if self.low_memory:
+            try:
+                return self._patch_on_disk()
+            finally:
+                if self.patch_dir is not None:
+                    remove_any(self.patch_dir)
+                log.debug("Peak memory usage: %s", _get_peak_memory())
+
+        if self.pipeline_patches:
+            # Apply patches while the remaining ones download
+            if self._download_apply_patches() is False:
+                log.debug("Patch check failed...")
+                return False
+        else:
+            # Download and verify patches in 1 go
+            if self._download_verify_patches() is False:
+                log.debug("Patch check failed...")
+                return False
+
+            try:
+                self._apply_patches_in_memory()
+            except PatcherError:
+                log.debug("Failed to apply patches in memory")
+                return False
+
+        log.debug("Peak memory usage: %s", _get_peak_memory())
+
+        try:
+            self._write_update_to_disk()
+        except PatcherError as err:
+            log.debug(err, exc_info=True)
+            return False
+        # Looks like all is well
+        return True
+
+    def _patch_on_disk(self):
+        # Spills patches to disk and applies them file to file so only
+        # one archive & one patch are in memory at a time.
+        self.patch_dir = tempfile.mkdtemp(prefix=".patches-", dir=self.update_folder)
+
         if self._download_verify_patches() is False:
             log.debug("Patch check failed...")
             return False
 
         try:
-            self._apply_patches_in_memory()
+            self._apply_patches_on_disk()
         except PatcherError:
-            log.debug("Failed to apply patches in memory")
+            log.debug("Failed to apply patches on disk")
+            return False
+
+        try:
+            self._write_update_to_disk()
+        except PatcherError as err:
+            log.debug(err, exc_info=True)
             return False
-        else:
-            try:
-                self._write_update_to_disk()
-            except PatcherError as err:
-                log.debug(err, exc_info=True)
-                return False
-        # Looks like all is well
         return True
 
     def _verify_installed_binary(self):
@@ -153,11 +257,11 @@ class Patcher(object):
                 log.debug("Cannot find archive to patch")
                 status = False
             else:
-                installed_file_hash = get_package_hashes(self.current_filename)
+                installed_file_hash = get_file_hash(self.current_filename)
                 if self.current_file_hash != installed_file_hash:
                     log.debug("Binary hash mismatch")
                     status = False
-                else:
+                elif self.low_memory is False:
                     # Read binary into memory to begin patching
                     try:
                         file_path = os.path.join(
@@ -181,141 +285,254 @@ class Patcher(object):
     # that is greater then the current version to the list
     # of needed patches.
     def _get_patch_info(self):
-        # Taking the list of needed patches and extracting the
-        # patch data from it. If any loop fails, will return False
+        # Picks the patches to download. If no route to the latest
+        # version is cheaper than a full update we'll return False
         # and start full binary update.
         log.debug("Getting patch meta-data")
-        required_patches = self._get_required_patches(self.name)
+        routes = self._get_patch_routes()
 
-        if len(required_patches) == 0:
+        if len(routes) == 0:
             log.debug("No patches to process")
             return False
 
-        # If we can't get the file size for all patches & the latest
-        # full update we fall back to the old patch update limit of 4
-        # We will only patch update if the total size of all needed
-        # patches are less than the size of a full update
-        fall_back = False
-        total_patch_size = 0
-
-        # Loop through all required patches and get file name, hash
-        # and file size.
-        for p in required_patches:
-            info = {}
-            platform_key = "{}*{}*{}*{}".format(
-                settings.UPDATES_KEY, self.name, str(p), self.platform
-            )
-            platform_info = self.star_access_update_data.get(platform_key)
-
-            try:
-                info["patch_name"] = platform_info["patch_name"]
-                info["patch_urls"] = self.update_urls
-                info["patch_hash"] = platform_info["patch_hash"]
-                patch_size = platform_info.get("patch_size")
-
-                if patch_size is None:
-                    # Since we are missing the patch size we cannot
-                    # compare the total size of all patches to the size
-                    # of a full update. Used for backwards compatibility
-                    # before we added patch size to version manifest.
-                    fall_back = True
-                else:
-                    try:
-                        total_patch_size += int(patch_size)
-                    except Exception as err:
-                        log.debug(err, exc_info=True)
-                        fall_back = True
-                self.patch_data.append(info)
-            except Exception as err:  # pragma: no cover
-                # Missing some required patch data
-                log.debug(err, exc_info=True)
-                return False
-
         latest_info = self._get_info(self.name, self.latest_version, option="file")
         latest_file_size = latest_info.get("file_size")
-        if latest_file_size is None:
-            # Since we are missing the full update size we cannot
-            # compare the total size of all patches to the full update.
-            fall_back = True
 
-        if fall_back is True:
-            if len(required_patches) > 4:
+        planner = self._get_planner()
+        plans = []
+        for route in routes:
+            plan = self._plan_route(planner, route)
+            if plan is not None:
+                plans.append((plan, route))
+
+        if latest_file_size is None or len(plans) == 0:
+            # If we can't get the file size for all patches & the latest
+            # full update we fall back to the old patch update limit of 4
+            log.debug("Missing sizes. Cannot plan update")
+            if len(routes[0]) > 4:
                 return False
-            else:
+            self._set_patch_data(routes[0])
+            return True
+
+        full = planner.plan_full(latest_file_size)
+        best = planner.choose([full] + [plan for plan, _ in plans])
+        for plan, route in plans:
+            if plan is best:
+                self._set_patch_data(route)
                 return True
+        return False
+
+    def _get_patch_routes(self):
+        # Returns the ways to patch to the latest version as lists of
+        # (version, UpdateInfo of the patch). The first route is the one
+        # with the fewest bytes, the rest start with a cumulative patch.
+        latest = str(self.latest_version)
+        chain = self.manifest.get_patch_chain(
+            self.name, self.platform, self.channel, self.current_version
+        )
+        if chain is not None and chain[0][-1] == latest:
+            log.debug("Using precomputed patch chain")
+            candidates = [chain[0]]
         else:
-            return Patcher._calc_diff(total_patch_size, latest_file_size)
+            required_patches = self._get_required_patches(self.name)
+            candidates = [[str(v) for v in required_patches]]
 
-    @staticmethod
-    def _calc_diff(patch_size, file_size):
-        if patch_size < file_size:
-            return True
-        else:
-            return False
+        cumulative = self.manifest.get_cumulative_patches(
+            self.name, self.current_version, self.platform
+        )
+        for v in cumulative:
+            if v == latest:
+                candidates.append([v])
+                continue
+
+            # Patch from the end of the cumulative patch onwards
+            chain = self.manifest.get_patch_chain(
+                self.name, self.platform, self.channel, v
+            )
+            if chain is not None and chain[0][-1] == latest:
+                candidates.append([v] + chain[0])
+
+        routes = []
+        for versions in candidates:
+            if len(versions) == 0 or versions in [[v for v, _ in r] for r in routes]:
+                continue
+            route = self._get_route(versions)
+            if route is not None:
+                routes.append(route)
+        return routes
+
+    def _get_route(self, versions):
+        # Cumulative patches can skip versions so each patch is looked
+        # up by the version it starts from
+        route = []
+        src = self.current_version
+        for v in versions:
+            platform_info = self.manifest.get_patch(self.name, src, v, self.platform)
+            if platform_info is None or platform_info.patch_name is None:
+                log.debug("Patch missing in version file: %s", v)
+                return None
+            if get_engine(platform_info.patch_engine) is None:
+                log.debug("Can't apply %s patches", platform_info.patch_engine)
+                return None
+            route.append((v, platform_info))
+            src = v
+        return route
+
+    def _get_planner(self):
+        if self.planner is not None:
+            return self.planner
+
+        bandwidth = mirror_stats.get_throughput()
+        if self.rate_limiter is not None:
+            bandwidth = min(bandwidth or DEFAULT_BANDWIDTH, self.rate_limiter.rate)
+        return UpdatePlanner(bandwidth=bandwidth, low_memory=self.low_memory)
+
+    def _plan_route(self, planner, route):
+        # Returns None if the size of any patch or archive is unknown
+        source_size = None
+        current_info = self.manifest.get_info(
+            self.name, self.current_version, self.platform
+        )
+        if current_info is not None:
+            source_size = current_info.file_size
+
+        versions = []
+        patch_sizes = []
+        archive_sizes = []
+        engines = []
+        for v, patch_info in route:
+            info = self.manifest.get_info(self.name, v, self.platform)
+            try:
+                patch_sizes.append(int(patch_info.patch_size))
+                size = int(info.file_size)
+                # Payload patches produce the uncompressed archive
+                if patch_info.patch_payload is not None:
+                    size = max(size, int(patch_info.patch_payload.get("size") or 0))
+                archive_sizes.append(size)
+            except (TypeError, ValueError, AttributeError):
+                return None
+            versions.append(v)
+            engines.append(patch_info.patch_engine)
+
+        if source_size is None or route[0][1].patch_payload is not None:
+            # Archives of nearby versions are about the same size
+            source_size = max(source_size or 0, archive_sizes[0])
+        return planner.plan_patches(
+            int(source_size), versions, patch_sizes, archive_sizes, engines
+        )
 
-    def _get_required_patches(self, name):
-        # Gathers patch name, hash & URL
-        needed_patches = []
-        try:
-            # Get list of Version objects initialized with keys
-            # from update manifest
-            version_key = "{}*{}".format(settings.UPDATES_KEY, name)
-            version_info = self.star_access_update_data(version_key)
-            versions = map(Version, version_info.keys())
-        except KeyError:  # pragma: no cover
-            log.debug("No updates found in updates dict")
-            # Will cause error to be thrown in _get_patch_info
-            # which will cause patch update to return False
-            versions = [1]
-
-        # We only care about the current channel
-        versions = [v for v in versions if v.channel == self.channel]
+    def _set_patch_data(self, route):
+        for _, platform_info in route:
+            self.patch_data.append(
+                {
+                    "patch_name": platform_info.patch_name,
+                    "patch_urls": self.update_urls,
+                    "patch_hash": platform_info.patch_hash,
+                    "patch_engine": platform_info.patch_engine,
+                    "patch_payload": platform_info.patch_payload,
+                }
+            )
 
+    def _get_required_patches(self, name):
+        # Versions are sorted when the manifest is compiled. We only
+        # care about the current channel.
         log.debug("Getting required patches")
-        for i in versions:
-            if i > self.current_version:
-                needed_patches.append(i)
-
-        # Used to guarantee patches are only added once
-        needed_patches = list(set(needed_patches))
-
-        # Ensuring we apply patches in correct order
-        return sorted(needed_patches)
+        return self.manifest.get_versions_after(
+            name, self.channel, self.current_version
+        )
 
     def _download_verify_patches(self):
-        # Downloads & verifies all patches
+        # Downloads & verifies all patches. Patches are downloaded
+        # concurrently but kept in the order they have to be applied.
         log.debug("Downloading patches")
         downloaded = 0
         percent = 0
         total = len(self.patch_data)
 
-        temp_dir = tempfile.gettempdir()
+        results = [None] * total
 
-        for p in self.patch_data:
-            # Don't write temp files to cwd
-            with ChDir(temp_dir):
-                if self.downloader:
-                    fd = self.downloader(
-                        p["patch_name"], p["patch_urls"], hexdigest=p["patch_hash"]
-                    )
+        if self.low_memory:
+            temp_dir = self.patch_dir
+        else:
+            temp_dir = tempfile.gettempdir()
+
+        # Don't write temp files to cwd
+        with ThreadPoolExecutor(max_workers=self._patch_workers()) as executor:
+            futures = self._submit_patch_downloads(executor, temp_dir)
+            for future in as_completed(futures):
+                data = future.result()
+
+                percent = int((float(downloaded + 1) / float(total)) * 100)
+                percent = "{0:.1f}".format(percent)
+                if data is not None:
+                    results[futures.index(future)] = data
+                    downloaded += 1
+                    status = {
+                        "total": total,
+                        "downloaded": downloaded,
+                        "percent_complete": percent,
+                        "status": "downloading",
+                    }
+                    self._call_progress_hooks(status)
                 else:
-                    fd = FileDownloader(
-                        p["patch_name"],
-                        p["patch_urls"],
-                        hexdigest=p["patch_hash"],
-                        verify=self.verify,
-                        max_download_retries=self.max_download_retries,
-                        headers=self.headers,
-                        http_timeout=self.http_timeout,
-                    )
+                    # Since patches are applied sequentially
+                    # we cannot continue successfully
+                    for f in futures:
+                        f.cancel()
+                    status = {
+                        "total": total,
+                        "downloaded": downloaded,
+                        "percent_complete": percent,
+                        "status": "failed to download all patches",
+                    }
+                    self._call_progress_hooks(status)
+                    return False
 
-                # Attempt to download resource
-                data = fd.download_verify_return()
+        status = {
+            "total": total,
+            "downloaded": downloaded,
+            "percent_complete": percent,
+            "status": "finished",
+        }
+        self._call_progress_hooks(status)
+
+        if self.low_memory:
+            self.patch_files = results
+        else:
+            self.patch_binary_data = results
+        return True
+
+    def _download_apply_patches(self):
+        # Downloads patches concurrently & applies each one in memory as
+        # soon as it and every patch before it are available. The next
+        # patches keep downloading while bsdiff works.
+        log.debug("Downloading & applying patches")
+        downloaded = 0
+        percent = 0
+        total = len(self.patch_data)
+
+        temp_dir = tempfile.gettempdir()
+
+        # Don't write temp files to cwd
+        with ThreadPoolExecutor(max_workers=self._patch_workers()) as executor:
+            futures = self._submit_patch_downloads(executor, temp_dir)
+            for p, future in zip(self.patch_data, futures):
+                data = future.result()
+
+                percent = int((float(downloaded + 1) / float(total)) * 100)
+                percent = "{0:.1f}".format(percent)
+                if data is None:
+                    for f in futures:
+                        f.cancel()
+                    status = {
+                        "total": total,
+                        "downloaded": downloaded,
+                        "percent_complete": percent,
+                        "status": "failed to download all patches",
+                    }
+                    self._call_progress_hooks(status)
+                    return False
 
-            percent = int((float(downloaded + 1) / float(total)) * 100)
-            percent = "{0:.1f}".format(percent)
-            if data is not None:
-                self.patch_binary_data.append(data)
                 downloaded += 1
                 status = {
                     "total": total,
@@ -324,17 +541,22 @@ class Patcher(object):
                     "status": "downloading",
                 }
                 self._call_progress_hooks(status)
-            else:
-                # Since patches are applied sequentially
-                # we cannot continue successfully
-                status = {
-                    "total": total,
-                    "downloaded": downloaded,
-                    "percent_complete": percent,
-                    "status": "failed to download all patches",
-                }
-                self._call_progress_hooks(status)
-                return False
+
+                try:
+                    self._apply_patch(
+                        data, p.get("patch_engine"), p.get("patch_payload")
+                    )
+                except PatcherError:
+                    log.debug("Failed to apply patches in memory")
+                    for f in futures:
+                        f.cancel()
+                    return False
+
+        try:
+            self._pack_binary()
+        except PatcherError:
+            log.debug("Failed to rebuild archive")
+            return False
 
         status = {
             "total": total,
@@ -346,6 +568,68 @@ class Patcher(object):
 
         return True
 
+    def _patch_workers(self):
+        return max(1, min(self.max_patch_downloads, len(self.patch_data)))
+
+    def _submit_patch_downloads(self, executor, download_dir):
+        # Returns futures in the order the patches have to be applied.
+        # Workers get an absolute download_dir since changing cwd
+        # would affect the whole process
+        if self.low_memory:
+            download = self._download_patch_to_disk
+        else:
+            download = self._download_patch
+        return [executor.submit(download, p, download_dir) for p in self.patch_data]
+
+    def _download_patch(self, p, download_dir):
+        # Downloads & verifies a single patch. Returns None on failure
+        fd = self._get_patch_downloader(p, download_dir)
+
+        # Attempt to download resource
+        try:
+            return fd.download_verify_return()
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            return None
+
+    def _download_patch_to_disk(self, p, download_dir):
+        # Downloads & verifies a single patch into download_dir.
+        # Returns the path of the patch or None on failure
+        fd = self._get_patch_downloader(p, download_dir)
+
+        try:
+            if fd.download_verify_write() is not True:
+                return None
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            return None
+        return os.path.join(download_dir, p["patch_name"])
+
+    def _get_patch_downloader(self, p, download_dir):
+        if self.downloader:
+            fd = self.downloader(
+                p["patch_name"],
+                p["patch_urls"],
+                hexdigest=p["patch_hash"],
+                download_dir=download_dir,
+            )
+        else:
+            fd = FileDownloader(
+                p["patch_name"],
+                p["patch_urls"],
+                hexdigest=p["patch_hash"],
+                verify=self.verify,
+                max_download_retries=self.max_download_retries,
+                headers=self.headers,
+                http_timeout=self.http_timeout,
+                race_mirrors=self.race_mirrors,
+                http_pool=self.http_pool,
+                rate_limiter=self.rate_limiter,
+                download_window=self.download_window,
+                download_dir=download_dir,
+            )
+        return fd
+
     def _call_progress_hooks(self, data):
         for ph in self.progress_hooks:
             try:
@@ -357,33 +641,132 @@ class Patcher(object):
     def _apply_patches_in_memory(self):
         # Applies a sequence of patches in memory
         log.debug("Applying patches")
-        for i in self.patch_binary_data:
+        for p, data in zip(self.patch_data, self.patch_binary_data):
+            self._apply_patch(data, p.get("patch_engine"), p.get("patch_payload"))
+        self._pack_binary()
+
+    def _apply_patches_on_disk(self):
+        # Applies a sequence of patches file to file. Each intermediate
+        # archive & patch is removed as soon as it has been used.
+        log.debug("Applying patches on disk")
+        src = os.path.join(self.update_folder, self.current_filename)
+        # Pack params of the archive if src is its payload
+        pack_params = None
+        for i, (p, patch_file) in enumerate(zip(self.patch_data, self.patch_files)):
+            dst = os.path.join(self.patch_dir, "patched-{}".format(i))
+            payload = p.get("patch_payload")
+            fmt = None if payload is None else payload.get("format")
             try:
-                self.og_binary = bsdiff4.patch(self.og_binary, i)
+                if pack_params is not None and pack_params.get("format") != fmt:
+                    src = self._convert_file(
+                        src, "packed-{}".format(i), pack_file, pack_params
+                    )
+                    pack_params = None
+                if fmt is not None and pack_params is None:
+                    src = self._convert_file(
+                        src, "payload-{}".format(i), unpack_file, fmt
+                    )
+                engine = self._get_engine(p.get("patch_engine"))
+                start = time.perf_counter()
+                engine.file_patch(src, dst, patch_file)
+                add_apply_time(
+                    engine.name, os.path.getsize(dst), time.perf_counter() - start
+                )
                 log.debug("Applied patch successfully")
             except Exception as err:
                 log.debug(err, exc_info=True)
                 raise PatcherError("Patch failed to apply")
+            finally:
+                remove_any(patch_file)
+                if src.startswith(self.patch_dir):
+                    remove_any(src)
+            src = dst
+            pack_params = payload
+
+        if pack_params is not None:
+            try:
+                src = self._convert_file(src, "packed", pack_file, pack_params)
+            except Exception as err:
+                log.debug(err, exc_info=True)
+                raise PatcherError("Failed to rebuild archive")
+        self.patched_file = src
+        self.patch_files = []
+
+    def _convert_file(self, src, name, convert, arg):
+        # Packs or unpacks src into the patch folder. Intermediate files
+        # are removed once converted.
+        dst = os.path.join(self.patch_dir, name)
+        try:
+            convert(src, dst, arg)
+        finally:
+            if src.startswith(self.patch_dir):
+                remove_any(src)
+        return dst
+
+    @staticmethod
+    def _get_engine(name):
+        engine = get_engine(name)
+        if engine is None:
+            raise PatcherError("Patch engine not available: {}".format(name))
+        return engine
+
+    def _apply_patch(self, patch, engine=None, payload=None):
+        # payload: Pack params of the archive the patch makes if it was
+        # made from the uncompressed payloads
+        fmt = None if payload is None else payload.get("format")
+        try:
+            engine = self._get_engine(engine)
+            if self.og_pack_params is not None:
+                if self.og_pack_params.get("format") != fmt:
+                    self._pack_binary()
+            if fmt is not None and self.og_pack_params is None:
+                self.og_binary = unpack(self.og_binary, fmt)
+            start = time.perf_counter()
+            self.og_binary = engine.patch(self.og_binary, patch)
+            add_apply_time(
+                engine.name, len(self.og_binary), time.perf_counter() - start
+            )
+            self.og_pack_params = payload
+            log.debug("Applied patch successfully")
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            raise PatcherError("Patch failed to apply")
+
+    def _pack_binary(self):
+        # Rebuilds the archive if the last patch was of its payload. The
+        # hash check after writing it catches a zlib that compresses
+        # differently than the one the archive was made with.
+        if self.og_pack_params is None:
+            return
+        try:
+            self.og_binary = pack(self.og_binary, self.og_pack_params)
+            self.og_pack_params = None
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            raise PatcherError("Failed to rebuild archive")
 
     def _write_update_to_disk(self):  # pragma: no cover
         # Writes updated binary to disk
         log.debug("Writing update to disk")
-        filename_key = "{}*{}*{}*{}*{}".format(
-            settings.UPDATES_KEY,
-            self.name,
-            self.latest_version,
-            self.platform,
-            "filename",
-        )
-        filename = self.star_access_update_data.get(filename_key)
+        filename = None
+        info = self.manifest.get_info(self.name, self.latest_version, self.platform)
+        if info is not None:
+            filename = info.filename
 
         if filename is None:
             raise PatcherError("Filename missing in version file")
 
         with ChDir(self.update_folder):
             try:
-                with open(filename, "wb") as f:
-                    f.write(self.og_binary)
+                if self.patched_file is not None:
+                    # Patched on disk. Just move it into place
+                    if os.path.exists(filename):
+                        remove_any(filename)
+                    os.rename(self.patched_file, filename)
+                    self.patched_file = None
+                else:
+                    with open(filename, "wb") as f:
+                        f.write(self.og_binary)
                 log.debug("Wrote update file")
             except IOError:
                 # Removes file if it got created
@@ -398,9 +781,10 @@ class Patcher(object):
 
                 new_file_hash = file_info["file_hash"]
                 log.debug("checking file hash match")
-                if new_file_hash != get_package_hashes(filename):
+                actual_file_hash = get_file_hash(filename)
+                if new_file_hash != actual_file_hash:
                     log.debug("Version file hash: %s", new_file_hash)
-                    log.debug("Actual file hash: %s", get_package_hashes(filename))
+                    log.debug("Actual file hash: %s", actual_file_hash)
                     log.debug("File hash does not match")
                     remove_any(filename)
                     raise PatcherError("Bad hash on patched file", expected=True)
@@ -416,20 +800,19 @@ class Patcher(object):
             _size = "patch_size"
 
         # Returns filename and hash for given name and version
-        platform_key = "{}*{}*{}*{}".format(
-            settings.UPDATES_KEY, name, version, self.platform
-        )
-        platform_info = self.star_access_update_data.get(platform_key)
+        platform_info = self.manifest.get_info(name, version, self.platform)
 
         info = {}
         if platform_info is not None:
-            filename = platform_info.get(_name)
+            filename = getattr(platform_info, _name)
             log.debug("Current Info - Filename: %s", filename)
 
-            file_hash = platform_info.get(_hash, "")
+            file_hash = getattr(platform_info, _hash)
+            if file_hash is None:
+                file_hash = ""
             log.debug("Current Info - File hash: %s", file_hash)
 
-            file_size = platform_info.get(_size)
+            file_size = getattr(platform_info, _size)
             log.debug("Current Info - File size: %s", file_size)
             _info = dict(filename=filename, file_hash=file_hash, file_size=file_size)
             info.update(_info)
@@ -0,0 +1,290 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2020 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import division, unicode_literals
+import logging
+import threading
+
+from pyupdater.utils import get_available_memory
+from pyupdater.utils.patch_engines import DEFAULT_ENGINE, get_engine
+
+log = logging.getLogger(__name__)
+
+# Download speed assumed until a download has been measured.
+# Bytes per second.
+DEFAULT_BANDWIDTH = 1024 * 1024
+
+# Share of the available memory a patch update may use
+MEMORY_HEADROOM = 0.8
+
+# Weight given to the newest apply speed sample
+APPLY_RATE_ALPHA = 0.3
+
+# Smaller patches are mostly overhead so they don't count
+# towards the apply speed
+APPLY_RATE_MIN_SIZE = 256 * 1024
+
+# Engine name -> measured apply speed
+_apply_rates = {}
+_apply_rate_lock = threading.Lock()
+
+
+def add_apply_time(engine, size, elapsed):
+    """Records how long a patch of engine took to apply. Refines the
+    apply speed used by the planner for the rest of the process.
+
+    Args:
+
+        engine (str): Patch engine name
+
+        size (int): Bytes of patched archive produced
+
+        elapsed (float): Seconds spent applying the patch
+    """
+    if size < APPLY_RATE_MIN_SIZE or elapsed <= 0:
+        return
+    rate = size / elapsed
+    with _apply_rate_lock:
+        if engine in _apply_rates:
+            rate = (
+                APPLY_RATE_ALPHA * rate + (1 - APPLY_RATE_ALPHA) * _apply_rates[engine]
+            )
+        _apply_rates[engine] = rate
+    log.debug("%s patch apply rate: %.0f bytes/s", engine, rate)
+
+
+def get_apply_rate(engine=None):
+    """Returns how fast patches of engine apply on this machine. The
+    engine's apply_rate until one of its patches has been timed.
+
+    Args:
+
+        engine (str): Patch engine name. Defaults to DEFAULT_ENGINE
+
+    Returns:
+
+        (float): Bytes of patched archive produced per second. None if
+        the engine isn't available
+    """
+    name = engine or DEFAULT_ENGINE
+    with _apply_rate_lock:
+        rate = _apply_rates.get(name)
+    if rate is not None:
+        return rate
+    patch_engine = get_engine(name)
+    if patch_engine is None:
+        return None
+    return patch_engine.apply_rate
+
+
+class UpdatePlan(object):
+    """A way to get to the latest version & its estimated cost
+
+    Args:
+
+        kind (str): "full" or "patch"
+
+        download_size (int): Bytes to download
+
+    Kwargs:
+
+        versions (list): Versions patched to in order
+
+        apply_size (int): Bytes of archive the patches produce
+
+        apply_sizes (dict): apply_size split by patch engine name. All
+        DEFAULT_ENGINE if not given
+
+        memory (int): Peak bytes held in memory while patching
+    """
+
+    __slots__ = (
+        "kind",
+        "versions",
+        "download_size",
+        "apply_size",
+        "apply_sizes",
+        "memory",
+        "cost",
+    )
+
+    def __init__(self, kind, download_size, **kwargs):
+        self.kind = kind
+        self.versions = kwargs.get("versions") or []
+        self.download_size = download_size
+        self.apply_size = kwargs.get("apply_size", 0)
+        self.apply_sizes = kwargs.get("apply_sizes")
+        if self.apply_sizes is None:
+            self.apply_sizes = {DEFAULT_ENGINE: self.apply_size}
+        self.memory = kwargs.get("memory", 0)
+        # Estimated seconds. Set by the planner
+        self.cost = None
+
+    def __str__(self):
+        if self.kind == "full":
+            return "full update"
+        return "{} patch(es) to {}".format(
+            len(self.versions), " -> ".join(str(v) for v in self.versions)
+        )
+
+
+class UpdatePlanner(object):
+    """Picks the cheapest way to update. Weighs the time to download,
+    the time to apply patches & the memory patching needs.
+
+    Kwargs:
+
+        bandwidth (float): Download speed in bytes per second.
+        Default DEFAULT_BANDWIDTH
+
+        apply_rate (float): Patch apply speed in bytes per second of
+        every engine. Taken from get_apply_rate if not given
+
+        available_memory (int): Bytes of memory patching may use.
+        Looked up if not given. No limit if it can't be determined
+
+        low_memory (bool): Patches are applied file to file
+    """
+
+    def __init__(self, **kwargs):
+        self.bandwidth = kwargs.get("bandwidth") or DEFAULT_BANDWIDTH
+        self._apply_rate = kwargs.get("apply_rate")
+        self.available_memory = kwargs.get("available_memory")
+        if self.available_memory is None:
+            self.available_memory = get_available_memory()
+        self.low_memory = kwargs.get("low_memory", False)
+
+    @property
+    def apply_rate(self):
+        return self.get_apply_rate()
+
+    def get_apply_rate(self, engine=None):
+        """Returns the apply speed of engine in bytes per second. None
+        if the engine isn't available"""
+        if self._apply_rate is not None:
+            return self._apply_rate
+        return get_apply_rate(engine)
+
+    def plan_full(self, file_size):
+        """Returns the UpdatePlan of downloading the full archive"""
+        return UpdatePlan("full", file_size)
+
+    def plan_patches(
+        self, source_size, versions, patch_sizes, archive_sizes, engines=None
+    ):
+        """Returns the UpdatePlan of a patch route
+
+        Args:
+
+            source_size (int): Size of the installed archive
+
+            versions (list): Versions patched to in order
+
+            patch_sizes (list): Size of each patch
+
+            archive_sizes (list): Size of the archive each patch produces
+
+            engines (list): Engine name of each patch. All DEFAULT_ENGINE
+            if not given
+        """
+        # Every patch reads the previous archive & writes the next one.
+        # In memory all patches are downloaded before they're applied.
+        sources = [source_size] + archive_sizes[:-1]
+        working_set = max(s + a for s, a in zip(sources, archive_sizes))
+        if self.low_memory:
+            memory = working_set + max(patch_sizes)
+        else:
+            memory = working_set + sum(patch_sizes)
+
+        # Engines apply at different speeds
+        apply_sizes = {}
+        for engine, size in zip(engines or [None] * len(archive_sizes), archive_sizes):
+            engine = engine or DEFAULT_ENGINE
+            apply_sizes[engine] = apply_sizes.get(engine, 0) + size
+        return UpdatePlan(
+            "patch",
+            sum(patch_sizes),
+            versions=versions,
+            apply_size=sum(archive_sizes),
+            apply_sizes=apply_sizes,
+            memory=memory,
+        )
+
+    def estimate(self, plan):
+        """Sets & returns the estimated seconds plan takes. None if there
+        isn't enough memory for it."""
+        if (
+            self.available_memory is not None
+            and plan.memory > self.available_memory * MEMORY_HEADROOM
+        ):
+            plan.cost = None
+        else:
+            plan.cost = plan.download_size / self.bandwidth
+            for engine, size in plan.apply_sizes.items():
+                if size == 0:
+                    continue
+                rate = self.get_apply_rate(engine)
+                if rate is None:
+                    # Can't be applied here
+                    plan.cost = None
+                    break
+                plan.cost += size / rate
+        return plan.cost
+
+    def choose(self, plans):
+        """Returns the cheapest plan. Earlier plans win ties.
+
+        Args:
+
+            plans (list): UpdatePlans to pick from
+
+        Returns:
+
+            (UpdatePlan): Cheapest plan or None if none of them fit in memory
+        """
+        log.debug(
+            "Planning update. Bandwidth: %.0f bytes/s Available memory: %s",
+            self.bandwidth,
+            self.available_memory,
+        )
+        best = None
+        for plan in plans:
+            cost = self.estimate(plan)
+            log.debug(
+                "Plan %s: download %s bytes, apply %s bytes, memory %s bytes, "
+                "cost %s",
+                plan,
+                plan.download_size,
+                plan.apply_size,
+                plan.memory,
+                "n/a" if cost is None else "{:.3f}s".format(cost),
+            )
+            if cost is None:
+                continue
+            if best is None or cost < best.cost:
+                best = plan
+
+        if best is not None:
+            log.debug("Chose %s", best)
+        return best
@@ -35,12 +35,12 @@ import threading
 import zipfile
 import ctypes
 
-from dsdev_utils.helpers import Version
 from dsdev_utils.paths import ChDir, get_mac_dot_app_dir, remove_any
 from dsdev_utils.system import get_system
 
 from pyupdater import settings
-from pyupdater.client.downloader import FileDownloader, get_hash
+from pyupdater.client.downloader import FileDownloader, get_file_hash
+from pyupdater.client.manifest import CompiledManifest
 from pyupdater.client.patcher import Patcher
 from pyupdater.core.package_handler.package import remove_previous_versions
 from pyupdater.utils.exceptions import ClientError
@@ -128,7 +128,8 @@ def get_highest_version(name, plat, channel, easy_data, strict):
     #
     #      channel (str): the release channel
     #
-    #      easy_data (dict): data file to search
+    #      easy_data (CompiledManifest): data file to search. An
+    #                                    EasyAccessDict is compiled first
     #
     #      strict (bool): specify whether or not to take the channel
     #                     into consideration
@@ -136,52 +137,11 @@ def get_highest_version(name, plat, channel, easy_data, strict):
     #   Returns:
     #
     #      (str) Highest version number
+    manifest = easy_data
+    if not isinstance(manifest, CompiledManifest):
+        manifest = CompiledManifest(getattr(easy_data, "dict", easy_data))
 
-    # We grab all keys and return the version corresponding to the
-    # channel passed to this function
-    version_key_alpha = "{}*{}*{}*{}".format("latest", name, "alpha", plat)
-    version_key_beta = "{}*{}*{}*{}".format("latest", name, "beta", plat)
-    version_key_stable = "{}*{}*{}*{}".format("latest", name, "stable", plat)
-    version = None
-
-    version_options = []
-
-    alpha_available = False
-    alpha_str = easy_data.get(version_key_alpha)
-    if alpha_str is not None:
-        log.debug("Alpha str: %s", alpha_str)
-        alpha = Version(alpha_str)
-        version_options.append(alpha)
-        alpha_available = True
-
-    beta_available = False
-    beta_str = easy_data.get(version_key_beta)
-    if beta_str is not None:
-        log.debug("Beta str: %s", beta_str)
-        beta = Version(beta_str)
-        version_options.append(beta)
-        beta_available = True
-
-    stable_str = easy_data.get(version_key_stable)
-    stable_available = False
-    if stable_str is not None:
-        log.debug("Stable str: %s", stable_str)
-        stable = Version(stable_str)
-        version_options.append(stable)
-        stable_available = True
-
-    if strict is False:
-        return str(max(version_options))
-
-    if alpha_available is True and channel == "alpha":
-        version = alpha
-
-    if beta_available is True and channel == "beta":
-        version = beta
-
-    if stable_available is True and channel == "stable":
-        version = stable
-
+    version = manifest.get_latest(name, plat, channel, strict)
     if version is not None:
         log.debug("Highest version: %s", version)
         return str(version)
@@ -382,6 +342,9 @@ class LibUpdate(object):
         # set this back to False.
         self._is_downloading = False
 
+        # Set when download is called with background=True
+        self._background = False
+
         # Used with the version property.
         # Returns a user friendly version string
         self._version = ""
@@ -409,6 +372,11 @@ class LibUpdate(object):
         # Raw form of easy_data
         self.json_data = data.get("json_data")
 
+        # The version manifest compiled into lookup tables
+        self.manifest = data.get("manifest")
+        if self.manifest is None:
+            self.manifest = CompiledManifest(self.json_data)
+
         # The directory used to store files needed for the restart process
         # on windows
         self.data_dir = data.get("data_dir")
@@ -440,6 +408,19 @@ class LibUpdate(object):
         # HTTP Timeout
         self.http_timeout = data.get("http_timeout")
 
+        # Number of concurrent ranged requests used for the full update
+        self.download_connections = data.get("download_connections")
+
+        # Race all update urls on first use to find the fastest mirror
+        self.race_mirrors = data.get("race_mirrors", False)
+
+        # Connection pool shared with the client
+        self.http_pool = data.get("http_pool")
+
+        # Throttle & schedule background downloads
+        self.rate_limiter = data.get("rate_limiter")
+        self.download_window = data.get("download_window")
+
         self.downloader = data.get("downloader")
 
         # The update strategy to use
@@ -447,7 +428,7 @@ class LibUpdate(object):
 
         # The latest version available
         self.latest = get_highest_version(
-            self.name, self.platform, self.channel, self.easy_data, self.strict
+            self.name, self.platform, self.channel, self.manifest, self.strict
         )
 
         # The name of the current versions update archive.
@@ -455,12 +436,12 @@ class LibUpdate(object):
         # patch update
         cv = self.current_version
         self._current_archive_name = LibUpdate._get_filename(
-            self.name, cv, self.platform, self.easy_data
+            self.name, cv, self.platform, self.manifest
         )
 
         # Get filename of latest versions update archive
         self.filename = LibUpdate._get_filename(
-            self.name, self.latest, self.platform, self.easy_data
+            self.name, self.latest, self.platform, self.manifest
         )
         assert self.filename is not None
 
@@ -500,10 +481,12 @@ class LibUpdate(object):
         if background is True:
             if self._is_downloading is False:
                 self._is_downloading = True
+                self._background = True
                 threading.Thread(target=self._download).start()
         else:
             if self._is_downloading is False:
                 self._is_downloading = True
+                self._background = False
                 return self._download()
 
     def extract(self):
@@ -527,7 +510,7 @@ class LibUpdate(object):
         return True
 
     @staticmethod
-    def _get_filename(name, version, platform, easy_data):
+    def _get_filename(name, version, platform, manifest):
         """Gets full filename for given name & version combo
 
         Args:
@@ -536,16 +519,16 @@ class LibUpdate(object):
 
             version (str): Version of file to get full filename for
 
-            easy_data (dict): Data file to search
+            manifest (CompiledManifest): Data file to search
 
         Returns:
 
             (str) Filename with extension
         """
-        filename_key = "{}*{}*{}*{}*{}".format(
-            settings.UPDATES_KEY, name, version, platform, "filename"
-        )
-        filename = easy_data.get(filename_key)
+        filename = None
+        info = manifest.get_info(name, version, platform)
+        if info is not None:
+            filename = info.filename
 
         log.debug("Filename for %s-%s: %s", name, version, filename)
         return filename
@@ -614,10 +597,10 @@ class LibUpdate(object):
                 raise ClientError("Update archive is corrupt")
 
     def _get_file_hash_from_manifest(self):
-        hash_key = "{}*{}*{}*{}*{}".format(
-            self._updates_key, self.name, self.latest, self.platform, "file_hash"
-        )
-        return self.easy_data.get(hash_key)
+        info = self.manifest.get_info(self.name, self.latest, self.platform)
+        if info is None:
+            return None
+        return info.file_hash
 
     # Must be called from directory where file is located
     def _verify_file_hash(self):
@@ -627,13 +610,12 @@ class LibUpdate(object):
 
         file_hash = self._get_file_hash_from_manifest()
         try:
-            with open(self.filename, "rb") as f:
-                data = f.read()
+            actual_hash = get_file_hash(self.filename)
         except Exception as err:
             log.debug(err, exc_info=True)
             return False
 
-        if file_hash == get_hash(data):
+        if file_hash == actual_hash:
             return True
         else:
             return False
@@ -664,12 +646,15 @@ class LibUpdate(object):
             )
             return False
 
+        init_data = dict(self.init_data)
+        init_data.update(self._get_throttle_options())
+
         # Initialize Patch object with all required information
         p = Patcher(
             current_version=self.current_version,
             latest_version=self.latest,
             update_folder=self.update_folder,
-            **self.init_data
+            **init_data
         )
 
         # Returns True if everything went well
@@ -702,6 +687,10 @@ class LibUpdate(object):
                     max_download_retries=self.max_download_retries,
                     headers=self.headers,
                     http_timeout=self.http_timeout,
+                    download_connections=self.download_connections,
+                    race_mirrors=self.race_mirrors,
+                    http_pool=self.http_pool,
+                    **self._get_throttle_options()
                 )
             result = fd.download_verify_write()
             if result:
@@ -711,6 +700,15 @@ class LibUpdate(object):
                 log.debug("Failed To Download Latest Version")
                 return False
 
+    def _get_throttle_options(self):
+        # Rate limits & download windows only apply to background downloads
+        if self._background is False:
+            return {"rate_limiter": None, "download_window": None}
+        return {
+            "rate_limiter": self.rate_limiter,
+            "download_window": self.download_window,
+        }
+
     def cleanup(self):
         """Cleans up old update archives for this app or asset"""
         log.debug("Beginning removal of old updates")
@@ -100,6 +100,6 @@ class PyUpdater(object):
         """Creates signing keys"""
         return self.key_importer.start()
 
-    def sign_update(self, split_version):
+    def sign_update(self, split_version, shard=False, compact=False, keep=None):
         """Signs version file with signing key"""
-        self.kh.sign_update(split_version)
+        self.kh.sign_update(split_version, shard, compact, keep)
@@ -34,6 +34,13 @@ from nacl.signing import SigningKey
 from pyupdater import settings
 from pyupdater.utils.storage import Storage
 from pyupdater.utils.encoding import UnpaddedBase64Encoder
+from pyupdater.utils.manifest import (
+    build_manifest_shards,
+    build_patch_chains,
+    compact_manifest,
+    pack_manifest,
+    PATCH_CHAINS_KEY,
+)
 
 
 log = logging.getLogger(__name__)
@@ -71,20 +78,52 @@ class KeyHandler(object):
             self.deploy_dir, settings.VERSION_FILE_FILENAME_COMPAT
         )
 
+        # Signed manifest containers. Signature covers the stored bytes.
+        self.version_file_v2 = os.path.join(
+            self.deploy_dir, settings.VERSION_FILE_FILENAME_V2
+        )
+
+        self.version_file_v2_compat = os.path.join(
+            self.deploy_dir, settings.VERSION_FILE_FILENAME_V2_COMPAT
+        )
+
+        # Signed index of the per name manifest shards
+        self.manifest_index_file = os.path.join(
+            self.deploy_dir, settings.MANIFEST_INDEX_FILENAME
+        )
+
+        self.manifest_index_file_compat = os.path.join(
+            self.deploy_dir, settings.MANIFEST_INDEX_FILENAME_COMPAT
+        )
+
         # The name of the gzipped key file in
         # the pyu-data/deploy directory
         self.key_file = os.path.join(self.deploy_dir, settings.KEY_FILE_FILENAME)
 
-    def sign_update(self, split_version):
+    def sign_update(self, split_version, shard=False, compact=False, keep=None):
         """Signs version file with private key
 
         Proxy method for :meth:`_add_sig`
+
+        Args:
+
+            split_version (bool): Create a version file for the
+            current platform only
+
+            shard (bool): Also create a signed index & a manifest shard
+            per name & release channel
+
+            compact (bool): Remove versions clients can no longer patch
+            from before signing
+
+            keep (int): When compacting also keep the last N versions of
+            each channel & platform
         """
         # Loads private key
         # Loads version file to memory
         # Signs Version file
         # Writes version file back to disk
-        self._add_sig(split_version)
+        self._add_sig(split_version, shard, compact, keep)
 
     def _load_private_keys(self):
         # Loads private key
@@ -101,7 +140,7 @@ class KeyHandler(object):
                 pass
         return private_key
 
-    def _add_sig(self, split_version):
+    def _add_sig(self, split_version, shard=False, compact=False, keep=None):
         # Adding new signature to version file
         # Raw private key will need to be converted into
         # a signing key object
@@ -118,16 +157,24 @@ class KeyHandler(object):
             log.debug("Removing signatures from version file")
             del update_data["signature"]
 
+        if compact is True:
+            self._compact_update_data(update_data, keep)
+
+        # Lets clients pick their patches with a single lookup
+        update_data.pop(PATCH_CHAINS_KEY, None)
+        patch_chains = build_patch_chains(update_data)
+        if patch_chains:
+            update_data[PATCH_CHAINS_KEY] = patch_chains
+
         # We create a signature from the string
         update_data_str = json.dumps(update_data, sort_keys=True)
+        payload = bytes(update_data_str, "latin-1")
 
         # Creating signing key object
         private_key = SigningKey(private_key_raw, self.key_encoder)
         log.debug("Signing update data")
         # Signs update data with private key
-        signature = private_key.sign(bytes(update_data_str, "latin-1"))
-
-        signature = self.key_encoder.encode(signature[:64]).decode()
+        signature = self._sign(private_key, payload)
 
         log.debug("Sig: %s", signature)
 
@@ -141,9 +188,32 @@ class KeyHandler(object):
         # Write updated version file to .pyupdater/config.pyu
         self._write_update_data(update_data, split_version)
 
+        # Write the manifest container with the exact bytes we signed
+        self._write_manifest(payload, signature, split_version)
+
+        if shard is True:
+            self._write_manifest_shards(
+                json.loads(update_data_str), private_key, split_version
+            )
+
         # Write gzipped key file
         self._write_key_file()
 
+    def _compact_update_data(self, update_data, keep):
+        size = len(json.dumps(update_data, sort_keys=True))
+        removed = compact_manifest(update_data, keep)
+        saved = size - len(json.dumps(update_data, sort_keys=True))
+        log.info("Compacted version manifest")
+        log.info("Removed %s entries, saved %s bytes", len(removed), saved)
+
+        # Pruned versions would come back on the next sign otherwise
+        self.db.save(settings.CONFIG_DB_KEY_VERSION_META, update_data)
+        return removed
+
+    def _sign(self, private_key, payload):
+        signature = private_key.sign(payload)
+        return self.key_encoder.encode(signature[:64]).decode()
+
     def _write_update_data(self, data, split_version):
         log.debug("Saved version meta data")
 
@@ -159,6 +229,39 @@ class KeyHandler(object):
 
         log.debug("Created gzipped version manifest in deploy dir")
 
+    def _write_manifest(self, payload, signature, split_version):
+        if split_version:
+            version_file = self.version_file_v2
+        else:
+            version_file = self.version_file_v2_compat
+
+        with gzip.open(version_file, "wb") as f:
+            f.write(pack_manifest(payload, signature))
+
+        log.debug("Created gzipped manifest container in deploy dir")
+
+    def _write_manifest_shards(self, update_data, private_key, split_version):
+        if split_version:
+            index_file = self.manifest_index_file
+            shard_template = settings.MANIFEST_SHARD_FILENAME
+        else:
+            index_file = self.manifest_index_file_compat
+            shard_template = settings.MANIFEST_SHARD_FILENAME_COMPAT
+
+        index, files = build_manifest_shards(update_data, shard_template)
+
+        # Shards aren't signed. The index holds the hash of each one.
+        for filename, data in files.items():
+            with gzip.open(os.path.join(self.deploy_dir, filename), "wb") as f:
+                f.write(data)
+
+        payload = bytes(json.dumps(index, sort_keys=True), "utf-8")
+        signature = self._sign(private_key, payload)
+        with gzip.open(index_file, "wb") as f:
+            f.write(pack_manifest(payload, signature))
+
+        log.debug("Created %s manifest shards in deploy dir", len(files))
+
     def _write_key_file(self):
         keypack_data = self.db.load(settings.CONFIG_DB_KEY_KEYPACK)
         if keypack_data is None:
@@ -23,22 +23,36 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
 from __future__ import print_function, unicode_literals
+from concurrent.futures import as_completed, ProcessPoolExecutor
 import logging
-import multiprocessing
 import os
 import shutil
-import sys
+import time
 
-from dsdev_utils.crypto import get_package_hashes as gph
-from dsdev_utils.helpers import EasyAccessDict
+from dsdev_utils.helpers import EasyAccessDict, Version
 from dsdev_utils.paths import ChDir
 
 from pyupdater import settings
-from pyupdater.utils import get_size_in_bytes as in_bytes
+from pyupdater.utils.archive_payload import PATCH_PAYLOAD_KEY
+from pyupdater.utils.manifest import CUMULATIVE_PATCHES_KEY
+from pyupdater.utils.patch_engines import (
+    DEFAULT_ENGINE,
+    get_engine,
+    load_plugins,
+    PATCH_ENGINE_KEY,
+)
 from pyupdater.utils.storage import Storage
 
+from .hash_cache import HashCache
 from .package import remove_previous_versions, Package
-from .patch import make_patch, Patch
+from .patch import (
+    get_cumulative_distances,
+    get_patch_memory,
+    get_patch_workers,
+    log_patch_report,
+    make_patch,
+    Patch,
+)
 
 log = logging.getLogger(__name__)
 
@@ -64,9 +78,32 @@ class PackageHandler(object):
         # Used to store config information
         self.db = Storage()
 
+        # Patches from older versions straight to the newest
+        self.cumulative_distances = []
+
+        # Name of the engine patches are made with
+        self.patch_engine = DEFAULT_ENGINE
+
+        # Diff the uncompressed payload of archives
+        self.payload_patches = False
+
         if config:
             # Support for creating patches
             self.patch_support = config.get("UPDATE_PATCHES", True) is True
+            self.cumulative_distances = get_cumulative_distances(
+                config.get("CUMULATIVE_PATCHES", 0),
+                config.get("CUMULATIVE_PATCH_SPACING", "linear"),
+            )
+            self.patch_engine = config.get("PATCH_ENGINE") or DEFAULT_ENGINE
+            load_plugins()
+            if get_engine(self.patch_engine) is None:
+                log.warning(
+                    "Patch engine %s not available. Using %s",
+                    self.patch_engine,
+                    DEFAULT_ENGINE,
+                )
+                self.patch_engine = DEFAULT_ENGINE
+            self.payload_patches = config.get("PAYLOAD_PATCHES", False) is True
         else:
             self.patch_support = False
 
@@ -76,6 +113,11 @@ class PackageHandler(object):
         self.deploy_dir = os.path.join(self.data_dir, "deploy")
         self.new_dir = os.path.join(self.data_dir, "new")
         self.config_dir = os.path.join(os.getcwd(), settings.CONFIG_DATA_FOLDER)
+
+        # Storage() created the config dir
+        self.hash_cache = HashCache(
+            os.path.join(self.config_dir, settings.CONFIG_FILE_HASH_CACHE)
+        )
         self.setup()
 
     def setup(self):
@@ -107,15 +149,18 @@ class PackageHandler(object):
         pkg_manifest, patch_manifest = self._get_package_list(report_errors)
 
         patches = PackageHandler._make_patches(patch_manifest)
-        PackageHandler._cleanup(patch_manifest)
+        PackageHandler._cleanup(patch_manifest, self._get_archives_to_keep())
         PackageHandler._add_patches_to_packages(
-            pkg_manifest, patches, self.patch_support
+            pkg_manifest, patches, self.patch_support, self.hash_cache
         )
+        log_patch_report(patches)
         PackageHandler._update_version_file(self.version_data, pkg_manifest)
 
         self._write_json_to_file(self.version_data)
         self._write_config_to_file(self.config)
         self._move_packages(pkg_manifest)
+        self.hash_cache.save()
+        self.hash_cache.log_timings()
 
     def _setup_work_dirs(self):
         # Sets up work dirs on dev machine.  Creates the following folder
@@ -169,8 +214,10 @@ class PackageHandler(object):
         patch_manifest = []
         bad_packages = []
         with ChDir(self.new_dir):
-            # Getting a list of all files in the new dir
-            packages = os.listdir(os.getcwd())
+            # Getting a list of all files in the new dir. Sorted so patch
+            # numbers don't depend on the order files are listed in.
+            packages = sorted(os.listdir(os.getcwd()))
+            new_packages = []
             for p in packages:
                 # On package initialization we do the following
                 # 1. Check for a supported archive
@@ -183,10 +230,14 @@ class PackageHandler(object):
                     # new_pkg.info['reason'] will tell why
                     bad_packages.append(new_pkg)
                     continue
+                new_packages.append((p, new_pkg))
 
-                # Add package hash
-                new_pkg.file_hash = gph(new_pkg.filename)
-                new_pkg.file_size = in_bytes(new_pkg.filename)
+            # Add package hashes. Unchanged files aren't read again.
+            files_info = self.hash_cache.get_files_info(
+                [os.path.abspath(new_pkg.filename) for _, new_pkg in new_packages]
+            )
+            for (p, new_pkg), file_info in zip(new_packages, files_info):
+                new_pkg.file_hash, new_pkg.file_size = file_info
 
                 PackageHandler._update_file_list(self.version_data, new_pkg)
 
@@ -201,11 +252,18 @@ class PackageHandler(object):
                         "json_data": self.version_data,
                         "pkg_info": new_pkg,
                         "config": self.config,
+                        "engine": self.patch_engine,
+                        "payload": self.payload_patches,
                     }
                     _patch = Patch(**data)
 
                     if _patch.ok:
                         patch_manifest.append(_patch)
+                        patch_manifest += self._get_cumulative_patches(data)
+
+        # Patch creation can take a while. Keep the hashes if it's
+        # interrupted.
+        self.hash_cache.save()
 
         if report_errors is True:  # pragma: no cover
             log.warning("Bad package & reason for being naughty:")
@@ -236,54 +294,138 @@ class PackageHandler(object):
                     log.debug("Adding new version to package-config")
                     data["package"][p.name][p.platform] = p.version
 
+    def _get_cumulative_patches(self, data):
+        # Patches from older archives in the files dir straight
+        # to the new package
+        if len(self.cumulative_distances) == 0:
+            return []
+
+        pkg = data["pkg_info"]
+        with ChDir(self.files_dir):
+            archives = []
+            for f in os.listdir(os.getcwd()):
+                archive = Package(f)
+                if archive.info["status"] is False:
+                    continue
+                if (archive.name, archive.platform, archive.channel) != (
+                    pkg.name,
+                    pkg.platform,
+                    pkg.channel,
+                ):
+                    continue
+                if Version(archive.version) < Version(pkg.version):
+                    archives.append(archive)
+
+        # Newest first. The previous version gets the regular patch.
+        archives.sort(key=lambda a: Version(a.version), reverse=True)
+        patches = []
+        for distance in self.cumulative_distances:
+            if distance > len(archives):
+                break
+            src = archives[distance - 1]
+            log.debug("Cumulative patch from %s", src.filename)
+            _patch = Patch(src_filename=src.filename, src_version=src.version, **data)
+            if _patch.ok:
+                patches.append(_patch)
+        return patches
+
+    def _get_archives_to_keep(self):
+        # Older archives needed for the cumulative patches of the next
+        # version. The newest archive is always kept.
+        if len(self.cumulative_distances) == 0:
+            return 0
+        return max(self.cumulative_distances) - 1
+
     @staticmethod
-    def _cleanup(patch_manifest):
+    def _cleanup(patch_manifest, keep=0):
         # Remove old archives that were previously used to create patches
         if len(patch_manifest) < 1:
             return
         log.info("Cleaning up stale files")
         for p in patch_manifest:
-            remove_previous_versions(os.path.dirname(p.src), p.dst)
+            remove_previous_versions(os.path.dirname(p.src), p.dst, keep)
 
     @staticmethod
     def _make_patches(patch_manifest):
         pool_output = []
         if len(patch_manifest) < 1:
             return pool_output
-        log.info("Starting patch creation")
-        if sys.platform != "win32":
-            try:
-                cpu_count = multiprocessing.cpu_count() * 2
-            except Exception as err:
-                log.debug(err, exc_info=True)
-                log.warning("Cannot get cpu count from os. Using default 2")
-                cpu_count = 2
-
-            pool = multiprocessing.Pool(processes=cpu_count)
-            pool_output = pool.map(make_patch, patch_manifest)
-        else:
-            pool_output = []
-            for p in patch_manifest:
-                pool_output.append(make_patch(p))
+        workers = get_patch_workers(patch_manifest)
+        log.info("Starting patch creation with %s workers", workers)
+
+        # Largest patches first so they don't end up running alone
+        # at the end
+        order = sorted(
+            range(len(patch_manifest)),
+            key=lambda i: get_patch_memory(patch_manifest[i]),
+            reverse=True,
+        )
+        pool_output = list(patch_manifest)
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (executor.submit(make_patch, patch_manifest[i]), i) for i in order
+            )
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    p = future.result()
+                except Exception as err:
+                    # The client does a full update instead
+                    log.debug(err, exc_info=True)
+                    log.warning(
+                        "Failed to create patch: %s", patch_manifest[i].basename
+                    )
+                    patch_manifest[i].ok = False
+                    if os.path.exists(patch_manifest[i].patch_name):
+                        os.remove(patch_manifest[i].patch_name)
+                    continue
+                log.info("Created patch %s in %.2fs", p.basename, p.time)
+                pool_output[i] = p
+
+        log.info(
+            "Created %s of %s patches in %.2fs",
+            len([p for p in pool_output if p.ok]),
+            len(pool_output),
+            time.perf_counter() - start,
+        )
         return pool_output
 
     @staticmethod
-    def _add_patches_to_packages(package_manifest, patches, patch_support):
+    def _add_patches_to_packages(
+        package_manifest, patches, patch_support, hash_cache=None
+    ):
         if patches is not None and len(patches) >= 1:
             log.debug("Adding patches to package list")
+            good_patches = []
             for p in patches:
-                if not p.ok or not os.path.exists(p.patch_name):
-                    continue
-
-                log.debug("We have a good patch: %s", p)
+                if p.ok and os.path.exists(p.patch_name):
+                    log.debug("We have a good patch: %s", p)
+                    good_patches.append(p)
+
+            # Patches hashed while they were made aren't read again.
+            # The rest are hashed concurrently.
+            if hash_cache is None:
+                hash_cache = HashCache()
+            unhashed = [p for p in good_patches if p.hash is None]
+            files_info = hash_cache.get_files_info([p.patch_name for p in unhashed])
+            for p, file_info in zip(unhashed, files_info):
+                p.hash, p.size = file_info
+            for p in good_patches:
+                hash_cache.add(p.patch_name, p.hash)
+
+            # Added in the order they were made
+            for p in good_patches:
                 for pm in package_manifest:
-                    if p.dst_filename == pm.filename:
-                        pm.patch = p
-                        pm.patch.hash = gph(pm.patch.patch_name)
-                        pm.patch.size = in_bytes(pm.patch.patch_name)
-                        break
-                    else:
+                    if p.dst_filename != pm.filename:
                         log.debug("No patch match found")
+                        continue
+
+                    if p.cumulative:
+                        pm.cumulative_patches.append(p)
+                    else:
+                        pm.patch = p
+                    break
         else:
             if patch_support is True:
                 log.debug("No patches found: %s", patches)
@@ -323,6 +465,26 @@ class PackageHandler(object):
             info["patch_name"] = package_info.patch.basename
             info["patch_hash"] = package_info.patch.hash
             info["patch_size"] = package_info.patch.size
+            # Clients assume bsdiff4 if no engine is given
+            if package_info.patch.engine != DEFAULT_ENGINE:
+                info[PATCH_ENGINE_KEY] = package_info.patch.engine
+            if package_info.patch.pack_params is not None:
+                info[PATCH_PAYLOAD_KEY] = package_info.patch.pack_params
+
+        # Patches from older versions keyed by their version
+        if len(package_info.cumulative_patches) > 0:
+            info[CUMULATIVE_PATCHES_KEY] = {}
+            for p in package_info.cumulative_patches:
+                patch = {
+                    "patch_name": p.basename,
+                    "patch_hash": p.hash,
+                    "patch_size": p.size,
+                }
+                if p.engine != DEFAULT_ENGINE:
+                    patch[PATCH_ENGINE_KEY] = p.engine
+                if p.pack_params is not None:
+                    patch[PATCH_PAYLOAD_KEY] = p.pack_params
+                info[CUMULATIVE_PATCHES_KEY][p.src_version] = patch
 
         return info
 
@@ -380,12 +542,20 @@ class PackageHandler(object):
         log.info("Moving packages to deploy folder")
         for p in package_manifest:
             with ChDir(self.new_dir):
+                patches = p.cumulative_patches
                 if p.patch is not None:
-                    if os.path.exists(os.path.join(self.deploy_dir, p.patch.basename)):
-                        os.remove(os.path.join(self.deploy_dir, p.patch.basename))
-                    log.debug("Moving %s to %s", p.patch.basename, self.deploy_dir)
-                    if os.path.exists(p.patch.basename):
-                        shutil.move(p.patch.basename, self.deploy_dir)
+                    patches = [p.patch] + patches
+
+                for patch in patches:
+                    if os.path.exists(os.path.join(self.deploy_dir, patch.basename)):
+                        os.remove(os.path.join(self.deploy_dir, patch.basename))
+                    log.debug("Moving %s to %s", patch.basename, self.deploy_dir)
+                    if os.path.exists(patch.basename):
+                        shutil.move(patch.basename, self.deploy_dir)
+                        self.hash_cache.move(
+                            patch.basename,
+                            os.path.join(self.deploy_dir, patch.basename),
+                        )
 
                 shutil.copy(p.filename, self.deploy_dir)
                 log.debug("Copying %s to %s", p.filename, self.deploy_dir)
@@ -393,4 +563,7 @@ class PackageHandler(object):
                 if os.path.exists(os.path.join(self.files_dir, p.filename)):
                     os.remove(os.path.join(self.files_dir, p.filename))
                 shutil.move(p.filename, self.files_dir)
+                self.hash_cache.move(
+                    p.filename, os.path.join(self.files_dir, p.filename)
+                )
                 log.debug("Moving %s to %s", p.filename, self.files_dir)
@@ -0,0 +1,209 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2020 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Bytes read at a time when hashing
+BLOCK_SIZE = 1024 * 1024
+
+
+def get_file_info(filename, block_size=BLOCK_SIZE):
+    """Hashes a file in a single streaming pass
+
+    Args:
+
+        filename (str): Path of the file
+
+    Returns:
+
+        (tuple): sha256 hash & size in bytes
+    """
+    hash_ = hashlib.sha256()
+    size = 0
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            hash_.update(block)
+            size += len(block)
+    return hash_.hexdigest(), size
+
+
+class HashCache(object):
+    """Hashes & sizes of files kept between runs
+
+    Entries are keyed on the file's path & only used while its size,
+    modification time & inode haven't changed. Safe to use from
+    multiple threads.
+
+    Kwargs:
+
+        path (str): Path of the json file the cache is stored in. Kept
+        in memory only if None
+    """
+
+    # Bumped when the format of an entry changes
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # (filename, size, seconds, cached) of each lookup
+        self.timings = []
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with io.open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            log.warning("Ignoring corrupt hash cache")
+            return
+
+        if data.get("version") == HashCache.VERSION:
+            self._entries = data.get("entries", {})
+
+    @staticmethod
+    def _get_key(stat):
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def get_file_info(self, filename):
+        """Returns the sha256 hash & size of filename. Only reads the file
+        if it changed since it was last hashed."""
+        start = time.perf_counter()
+        path = os.path.abspath(filename)
+        key = HashCache._get_key(os.stat(path))
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry["key"] == key:
+            log.debug("Hash cache hit: %s", filename)
+            file_hash, size = entry["hash"], entry["key"][0]
+            cached = True
+        else:
+            file_hash, size = get_file_info(path)
+            log.debug("Hash for %s: %s", filename, file_hash)
+            cached = False
+
+        with self._lock:
+            # The file changed while being read. Don't cache it.
+            if not cached and size == key[0]:
+                self._entries[path] = {"key": key, "hash": file_hash}
+            if cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+            elapsed = time.perf_counter() - start
+            self.timings.append((os.path.basename(path), size, elapsed, cached))
+        return file_hash, size
+
+    def add(self, filename, file_hash):
+        """Caches the hash of a file hashed elsewhere"""
+        path = os.path.abspath(filename)
+        key = HashCache._get_key(os.stat(path))
+        with self._lock:
+            self._entries[path] = {"key": key, "hash": file_hash}
+
+    def get_files_info(self, filenames):
+        """Hashes files concurrently. hashlib releases the GIL while
+        hashing large blocks, so threads hash on every core.
+
+        Args:
+
+            filenames (list): Paths of the files
+
+        Returns:
+
+            (list): sha256 hash & size of each file in the same order
+        """
+        if len(filenames) == 0:
+            return []
+        workers = max(1, min(len(filenames), os.cpu_count() or 1))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.get_file_info, filenames))
+
+    def log_timings(self):
+        """Logs how long hashing each file took"""
+        with self._lock:
+            timings = sorted(self.timings)
+        if len(timings) == 0:
+            return
+
+        log.info(
+            "Hashed %s files, %s from cache, %s bytes in %.2fs",
+            len(timings),
+            len([t for t in timings if t[3]]),
+            sum(t[1] for t in timings),
+            sum(t[2] for t in timings),
+        )
+        for filename, size, elapsed, cached in timings:
+            log.info(
+                "  %s: %s bytes in %.3fs%s",
+                filename,
+                size,
+                elapsed,
+                " (cached)" if cached else "",
+            )
+
+    def move(self, src, dst):
+        """Moves the entry of a renamed file to its new path"""
+        with self._lock:
+            entry = self._entries.pop(os.path.abspath(src), None)
+            if entry is not None:
+                self._entries[os.path.abspath(dst)] = entry
+
+    def save(self):
+        """Writes the cache to disk. Entries of removed files are dropped."""
+        if self.path is None:
+            return
+
+        with self._lock:
+            entries = dict(
+                (path, entry)
+                for path, entry in self._entries.items()
+                if os.path.exists(path)
+            )
+            self._entries = entries
+            temp_path = self.path + ".tmp"
+            with io.open(temp_path, "w", encoding="utf-8") as f:
+                data = {"version": HashCache.VERSION, "entries": entries}
+                f.write(json.dumps(data))
+            os.replace(temp_path, self.path)
+        log.debug("Hash cache: %s hits, %s misses", self.hits, self.misses)
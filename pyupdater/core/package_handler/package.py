@@ -60,8 +60,17 @@ def parse_platform(name):
     return platform_name
 
 
-def remove_previous_versions(directory, filename):
-    """Removes previous version of named file"""
+def remove_previous_versions(directory, filename, keep=0):
+    """Removes previous version of named file
+
+    Args:
+
+        directory (str): Directory to clean up
+
+        filename (str): File to remove older versions of
+
+        keep (int): Number of newest older versions to keep per platform
+    """
     log.debug("In remove_previous_versions")
 
     if filename is None:
@@ -92,6 +101,7 @@ def remove_previous_versions(directory, filename):
     log.debug("Current version: %s", package_info.version)
     assert package_info.name is not None
     log.debug("Name to search for: %s", package_info.name)
+    old_packages = []
     with ChDir(directory):
         temp = os.listdir(os.getcwd())
         for t in temp:
@@ -114,13 +124,23 @@ def remove_previous_versions(directory, filename):
             log.debug("Old name: %s", temp_pkg.filename)
 
             if temp_pkg.version < package_info.version:
-                old_path = os.path.join(directory, t)
-                log.debug("Removing old update: %s", old_path)
-                remove_any(old_path)
+                old_packages.append(temp_pkg)
             else:
                 log.debug("Old version: %s", temp_pkg.version)
                 log.debug("Current version: %s", package_info.version)
 
+    # Newest first so the kept versions are the most recent ones
+    old_packages.sort(key=lambda p: Version(p.version), reverse=True)
+    kept = {}
+    for p in old_packages:
+        kept[p.platform] = kept.get(p.platform, 0) + 1
+        if kept[p.platform] <= keep:
+            log.debug("Keeping old update: %s", p.filename)
+            continue
+        old_path = os.path.join(directory, p.filename)
+        log.debug("Removing old update: %s", old_path)
+        remove_any(old_path)
+
 
 class Package(object):
     """Holds information of update file.
@@ -146,6 +166,8 @@ class Package(object):
         self.platform = None
         self.info = dict(status=False, reason="")
         self.patch = None
+        # Patches from older versions straight to this one
+        self.cumulative_patches = []
         # seems to produce the best diffs.
         # Tests on homepage: https://github.com/Digital-Sapphire/PyUpdater
         # Zip doesn't keep +x permissions. Only using gz for now.
@@ -22,36 +22,225 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
-from __future__ import unicode_literals
+from __future__ import division, unicode_literals
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
+import sys
+import time
 
-try:  # pragma: no cover
-    import bsdiff4
-except ImportError:  # pragma: no cover
-    bsdiff4 = None
 from dsdev_utils.paths import ChDir
 
 from pyupdater import settings
-from pyupdater.utils import remove_dot_files
+from pyupdater.utils import get_available_memory, remove_dot_files
+from pyupdater.utils.archive_payload import (
+    get_format,
+    get_pack_params,
+    get_payload_size,
+    unpack,
+)
+from pyupdater.utils.exceptions import PackageHandlerError, UtilsError
+from pyupdater.utils.patch_engines import DEFAULT_ENGINE, get_engine, load_plugins
 
 
 log = logging.getLogger(__name__)
 
+# ProcessPoolExecutor's limit on windows
+MAX_WINDOWS_WORKERS = 61
+
+
+def get_cumulative_distances(count, spacing="linear"):
+    """Returns how many versions back each cumulative patch starts from
+
+    The previous version is 1 & always gets a regular patch.
+
+    Args:
+
+        count (int): Number of cumulative patches
+
+        spacing (str): linear - 2, 3, 4... geometric - 2, 4, 8...
+
+    Returns:
+
+        (list): Distances in versions
+    """
+    if not count or count < 1:
+        return []
+    if spacing == "geometric":
+        return [2**i for i in range(1, count + 1)]
+    return list(range(2, count + 2))
+
+
+def get_patch_memory(patch):
+    """Returns the estimated peak memory in bytes needed to make patch"""
+    load_plugins()
+    engine = get_engine(patch.engine) or get_engine()
+    src_factor, dst_factor = engine.memory_factors
+    src_size = os.path.getsize(patch.src)
+    dst_size = os.path.getsize(patch.dst)
+    if patch.payload is False:
+        return src_size * src_factor + dst_size * dst_factor
+
+    # Payloads are diffed while both archives are still in memory
+    return (
+        src_size
+        + dst_size
+        + get_payload_size(patch.src) * src_factor
+        + get_payload_size(patch.dst) * dst_factor
+    )
+
+
+def get_patch_workers(patches, cpu_count=None, available_memory=None):
+    """Returns how many patches can be made at once without running out
+    of cpus or memory
+
+    Args:
+
+        patches (list): Patches to make
+
+        cpu_count (int): Looked up if not given
+
+        available_memory (int): Bytes of memory. Looked up if not given.
+        Half the cpus are used if it can't be determined
+
+    Returns:
+
+        (int): Number of workers
+    """
+    if len(patches) == 0:
+        return 0
+
+    if cpu_count is None:
+        try:
+            cpu_count = multiprocessing.cpu_count()
+        except NotImplementedError:
+            log.warning("Cannot get cpu count from os. Using default 2")
+            cpu_count = 2
+    workers = min(cpu_count, len(patches))
+
+    if available_memory is None:
+        available_memory = get_available_memory()
+    if available_memory is not None:
+        # Sized for the largest patches running side by side
+        needed = sorted((get_patch_memory(p) for p in patches), reverse=True)
+        fits = 0
+        for memory in needed[:workers]:
+            available_memory -= memory
+            if available_memory < 0:
+                break
+            fits += 1
+        workers = min(workers, fits)
+    else:
+        log.info(
+            "Cannot determine available memory. Skipping memory bound & "
+            "using half the cpus"
+        )
+        workers = min(workers, max(1, cpu_count // 2))
+
+    if sys.platform == "win32":
+        workers = min(workers, MAX_WINDOWS_WORKERS)
+
+    # Patches that don't fit are still made. One at a time.
+    return max(1, workers)
+
 
 def make_patch(patch):
     log.debug("Patch source path: %s", patch.src)
     log.debug("Patch destination path: %s", patch.dst)
     log.info("Creating patch... %s", patch.basename)
 
-    bsdiff4.file_diff(patch.src, patch.dst, patch.patch_name)
+    # Worker processes don't inherit the engines loaded by the parent
+    # on every platform
+    load_plugins()
+    engine = get_engine(patch.engine)
+    if engine is None:
+        msg = "Patch engine not available: {}".format(patch.engine)
+        raise PackageHandlerError(msg)
+
+    start = time.perf_counter()
+    with open(patch.src, "rb") as f:
+        src = f.read()
+    with open(patch.dst, "rb") as f:
+        dst = f.read()
+
+    dst_size = len(dst)
+    if patch.payload is True:
+        src, dst, patch.pack_params = _get_payloads(src, dst)
+
+    # The patch is hashed while it's still in memory so it never has
+    # to be read again
+    data = engine.diff(src, dst)
+    with open(patch.patch_name, "wb") as f:
+        f.write(data)
+
+    patch.hash = hashlib.sha256(data).hexdigest()
+    patch.size = len(data)
+    if dst_size > 0:
+        patch.ratio = len(data) / dst_size
+    patch.time = time.perf_counter() - start
 
     log.info("Done creating patch... %s", patch.basename)
 
     return patch
 
 
+def _get_payloads(src, dst):
+    # Returns the uncompressed payloads of both archives & the params to
+    # rebuild dst. The archives as is if dst can't be rebuilt bit for
+    # bit on the client.
+    fmt = get_format(dst)
+    if fmt is None or get_format(src) != fmt:
+        log.debug("Archive payload can't be diffed")
+        return src, dst, None
+
+    try:
+        src_payload = unpack(src, fmt)
+        dst_payload = unpack(dst, fmt)
+    except UtilsError as err:
+        log.debug(err, exc_info=True)
+        return src, dst, None
+
+    params = get_pack_params(dst, dst_payload)
+    if params is None:
+        log.info("Archive can't be rebuilt from its payload. Diffing the archive")
+        return src, dst, None
+    return src_payload, dst_payload, params
+
+
+def log_patch_report(patches):
+    """Logs how much smaller than a full update each patch is
+
+    Args:
+
+        patches (list): Patches made by make_patch
+    """
+    patches = [p for p in patches if p.ok and p.size is not None]
+    if len(patches) == 0:
+        return
+
+    log.info("Patch report:")
+    for p in patches:
+        log.info(
+            "  %s -> %s: %s bytes, %.1f%% of the full update, made in %.2fs",
+            p.basename,
+            p.dst_filename,
+            p.size,
+            (p.ratio or 0) * 100,
+            p.time or 0,
+        )
+
+    patch_size = sum(p.size for p in patches)
+    full_size = sum(p.size / p.ratio for p in patches if p.ratio)
+    log.info(
+        "  %s patches, %s bytes. %.1f%% of the full updates they replace",
+        len(patches),
+        patch_size,
+        patch_size / full_size * 100 if full_size else 0,
+    )
+
+
 class Patch(object):
     def __init__(self, **kwargs):
         self._pkg_info = kwargs.get("pkg_info")
@@ -62,6 +251,17 @@ class Patch(object):
         self._config = kwargs.get("config")
         self._test = kwargs.get("test", False)
 
+        # Name of the patch engine used to make the patch
+        self.engine = kwargs.get("engine") or DEFAULT_ENGINE
+
+        # Diff the uncompressed payload of the archives
+        self.payload = kwargs.get("payload", False)
+
+        # Set for cumulative patches made from an older archive
+        self._src_filename = kwargs.get("src_filename")
+        self.src_version = kwargs.get("src_version")
+        self.cumulative = self._src_filename is not None
+
         self.ok = False
         self.patch_num = None
         self.src = None
@@ -71,6 +271,15 @@ class Patch(object):
         self.hash = None
         self.size = None
 
+        # Set by make_patch. Seconds it took to make the patch & patch
+        # size as a share of the full update
+        self.time = None
+        self.ratio = None
+
+        # Set by make_patch if the payload was diffed. Clients need them
+        # to rebuild the archive.
+        self.pack_params = None
+
         self._check_make_patch()
 
         if self.ok:
@@ -98,8 +307,8 @@ class Patch(object):
         if self._json_data.get("latest") is not None:
             log.debug(json.dumps(self._json_data["latest"], indent=2))
         log.debug("Checking if patch creation is possible")
-        if bsdiff4 is None:
-            log.warning("Bsdiff is missing. Cannot create patches")
+        if get_engine(self.engine) is None:
+            log.warning("%s is missing. Cannot create patches", self.engine)
             return
 
         if os.path.exists(self._files_dir):
@@ -116,7 +325,9 @@ class Patch(object):
             _name = self._pkg_info.name
             _plat = self._pkg_info.platform
             _channel = self._pkg_info.channel
-            if self._test is False:
+            if self._src_filename is not None:
+                filename = self._src_filename
+            elif self._test is False:
                 # If latest not available in version file. Exit
                 try:
                     log.debug("Looking for %s on %s", _name, _plat)
@@ -38,6 +38,9 @@ CONFIG_DATA_FOLDER = ".pyupdater"
 # User config file
 CONFIG_FILE_USER = "config.pyu"
 
+# Hashes & sizes of processed files
+CONFIG_FILE_HASH_CACHE = "hashes.pyu"
+
 CONFIG_DB_KEY_APP_CONFIG = "app_config"
 CONFIG_DB_KEY_KEYPACK = "keypack"
 CONFIG_DB_KEY_VERSION_META = "version_meta"
@@ -66,4 +69,14 @@ UPDATE_FOLDER = "update"
 # Name of version file in online repo
 VERSION_FILE_FILENAME = "versions-{}.gz".format(system.get_system())
 VERSION_FILE_FILENAME_COMPAT = "versions.gz"
+
+# Name of the signed manifest container in online repo
+VERSION_FILE_FILENAME_V2 = "versions-{}.v2.gz".format(system.get_system())
+VERSION_FILE_FILENAME_V2_COMPAT = "versions.v2.gz"
+
+# Name of the signed index of manifest shards & of each shard
+MANIFEST_INDEX_FILENAME = "versions-{}.index.gz".format(system.get_system())
+MANIFEST_INDEX_FILENAME_COMPAT = "versions.index.gz"
+MANIFEST_SHARD_FILENAME = "versions-{}.{{}}.shard.gz".format(system.get_system())
+MANIFEST_SHARD_FILENAME_COMPAT = "versions.{}.shard.gz"
 KEY_FILE_FILENAME = "keys.gz"
@@ -23,12 +23,15 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
 from __future__ import absolute_import, unicode_literals
+import ctypes
 import io
 import logging
 import json
 import os
+import re
 import shutil
 import subprocess
+import sys
 import tarfile
 import zipfile
 
@@ -218,6 +221,92 @@ def get_size_in_bytes(filename):
     return size
 
 
+def get_available_memory():
+    """Returns the physical memory available to this process in bytes
+    or None if it can't be determined"""
+    if sys.platform == "win32":  # pragma: no cover
+        return _get_windows_memory()
+    if sys.platform == "darwin":  # pragma: no cover
+        return _get_mac_memory()
+
+    # Includes reclaimable page cache on linux
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):  # pragma: no cover
+        return None
+
+
+def _get_windows_memory():  # pragma: no cover
+    class MemoryStatusEx(ctypes.Structure):
+        _fields_ = [
+            ("dwLength", ctypes.c_ulong),
+            ("dwMemoryLoad", ctypes.c_ulong),
+            ("ullTotalPhys", ctypes.c_ulonglong),
+            ("ullAvailPhys", ctypes.c_ulonglong),
+            ("ullTotalPageFile", ctypes.c_ulonglong),
+            ("ullAvailPageFile", ctypes.c_ulonglong),
+            ("ullTotalVirtual", ctypes.c_ulonglong),
+            ("ullAvailVirtual", ctypes.c_ulonglong),
+            ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+        ]
+
+    status = MemoryStatusEx()
+    status.dwLength = ctypes.sizeof(MemoryStatusEx)
+    try:
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+    except (AttributeError, OSError) as err:
+        log.debug(err, exc_info=True)
+    return None
+
+
+def _get_mac_memory():  # pragma: no cover
+    try:
+        output = subprocess.check_output(["vm_stat"], timeout=5)
+        memory = _parse_vm_stat(output.decode("utf-8", "replace"))
+        if memory is not None:
+            return memory
+    except (OSError, subprocess.SubprocessError) as err:
+        log.debug(err, exc_info=True)
+
+    # Total memory. Assume half of it is free.
+    try:
+        output = subprocess.check_output(["sysctl", "-n", "hw.memsize"], timeout=5)
+        return int(output.strip()) // 2
+    except (OSError, subprocess.SubprocessError, ValueError) as err:
+        log.debug(err, exc_info=True)
+    return None
+
+
+def _parse_vm_stat(output):
+    # Free, inactive & speculative pages can be used without swapping.
+    # Returns None if output isn't understood.
+    match = re.search(r"page size of (\d+) bytes", output)
+    if match is None:
+        return None
+    page_size = int(match.group(1))
+
+    pages = {}
+    for line in output.splitlines():
+        key, _, value = line.partition(":")
+        value = value.strip().rstrip(".")
+        if value.isdigit():
+            pages[key.strip()] = int(value)
+
+    keys = ["Pages free", "Pages inactive", "Pages speculative"]
+    if "Pages free" not in pages:
+        return None
+    return sum(pages.get(k, 0) for k in keys) * page_size
+
+
 def create_asset_archive(name, version):
     """Used to make archives of file or dir. Zip on windows and tar.gz
     on all other platforms
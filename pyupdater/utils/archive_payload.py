@@ -0,0 +1,404 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2020 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+import binascii
+import io
+import logging
+import os
+import struct
+import zipfile
+import zlib
+
+from pyupdater.utils.exceptions import UtilsError
+
+
+log = logging.getLogger(__name__)
+
+# Key of the pack params in the version manifest
+PATCH_PAYLOAD_KEY = "patch_payload"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZIP_MAGIC = b"PK\x03\x04"
+
+CHUNK_SIZE = 1024 * 1024
+
+# Bytes of uncompressed data compressed at each level while looking
+# for the level an archive was made with
+PROBE_SIZE = 1024 * 1024
+
+# Levels in the order they're tried. tarfile & gzip default to 9.
+# zipfile defaults to 6.
+LEVELS = [9, 6, 1, 2, 3, 4, 5, 7, 8]
+
+# gzip header flags
+_FHCRC = 2
+_FEXTRA = 4
+_FNAME = 8
+_FCOMMENT = 16
+
+# zip general purpose flags we can't rebuild
+_ZIP_ENCRYPTED = 1
+_ZIP_DATA_DESCRIPTOR = 8
+_ZIP64_SIZE = 0xFFFFFFFF
+
+
+def get_format(data):
+    """Returns the format of the archive which starts with data. "gzip",
+    "zip" or None if the payload of the archive can't be diffed"""
+    if data[:2] == GZIP_MAGIC:
+        return "gzip"
+    if data[:4] == ZIP_MAGIC:
+        return "zip"
+    return None
+
+
+def unpack(data, fmt):
+    """Returns the uncompressed payload of the archive data.
+
+    gzip: The tar stream. zip: The archive with each deflated member
+    replaced by its uncompressed bytes.
+
+    Raises:
+
+        UtilsError: If the archive can't be unpacked
+    """
+    src = io.BytesIO(data)
+    dst = io.BytesIO()
+    _unpack(src, dst, fmt)
+    return dst.getvalue()
+
+
+def pack(payload, params):
+    """Returns the archive payload was unpacked from. Compressed
+    as described by params from get_pack_params.
+
+    Raises:
+
+        UtilsError: If the payload can't be packed
+    """
+    src = io.BytesIO(payload)
+    dst = io.BytesIO()
+    _pack(src, dst, params)
+    return dst.getvalue()
+
+
+def unpack_file(src_path, dst_path, fmt):
+    """Like unpack but file to file"""
+    with open(src_path, "rb") as src:
+        with open(dst_path, "wb") as dst:
+            _unpack(src, dst, fmt)
+
+
+def pack_file(src_path, dst_path, params):
+    """Like pack but file to file"""
+    with open(src_path, "rb") as src:
+        with open(dst_path, "wb") as dst:
+            _pack(src, dst, params)
+
+
+def get_pack_params(data, payload):
+    """Returns what's needed to rebuild the archive data bit for bit from
+    its payload. Clients rebuild archives with pack.
+
+    Args:
+
+        data (bytes): The archive
+
+        payload (bytes): Payload of data from unpack
+
+    Returns:
+
+        (dict): format, zlib level, payload size & the gzip header. None
+        if data can't be rebuilt. i.e. it wasn't made with zlib or needs
+        features we don't support.
+    """
+    fmt = get_format(data)
+    try:
+        if fmt == "gzip":
+            params, levels = _get_gzip_params(data, payload)
+        elif fmt == "zip":
+            params, levels = _get_zip_params(data)
+        else:
+            return None
+        params["size"] = len(payload)
+
+        # Levels can compress the start of a stream the same & different
+        # zlib versions don't always compress the same. Only trust a
+        # full rebuild.
+        for level in levels:
+            params["level"] = level
+            if pack(payload, params) == data:
+                return params
+    except (UtilsError, zipfile.BadZipfile, zlib.error) as err:
+        log.debug(err, exc_info=True)
+        return None
+
+    log.debug("Can't rebuild %s archive", fmt)
+    return None
+
+
+def get_payload_size(path):
+    """Returns the estimated size of the payload of the archive at path.
+    The archive size if its payload can't be diffed."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        fmt = get_format(f.read(4))
+        if fmt == "gzip" and size >= 18:
+            # Uncompressed size mod 2**32 is in the trailer
+            f.seek(-4, os.SEEK_END)
+            isize = struct.unpack("<I", f.read(4))[0]
+            return max(size, isize)
+
+    if fmt == "zip":
+        try:
+            with zipfile.ZipFile(path) as zf:
+                for info in zf.infolist():
+                    size += info.file_size - info.compress_size
+        except zipfile.BadZipfile:
+            pass
+    return size
+
+
+def _get_levels(raw, compressed):
+    # Returns the levels which could have turned raw into compressed.
+    # zlib only emits output for data it has seen so without a flush
+    # it has to be the start of compressed. Highly compressible data
+    # may need more than one probe before anything is emitted.
+    levels = []
+    for level in LEVELS:
+        c = _get_compressor(level)
+        out = b""
+        pos = 0
+        while len(out) == 0 and pos < len(raw):
+            out += c.compress(raw[pos : pos + PROBE_SIZE])
+            pos += PROBE_SIZE
+        if pos >= len(raw):
+            if out + c.flush() == compressed:
+                levels.append(level)
+        elif compressed.startswith(out):
+            levels.append(level)
+    return levels
+
+
+def _get_compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def _get_gzip_params(data, payload):
+    header = _read_gzip_header(io.BytesIO(data))
+    params = {
+        "format": "gzip",
+        "header": binascii.hexlify(header).decode("ascii"),
+    }
+    return params, _get_levels(payload, data[len(header) : -8])
+
+
+def _get_zip_params(data):
+    # Members are compressed with the same level. The largest one tells
+    # levels apart best.
+    params = {"format": "zip"}
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        members = [i for i in zf.infolist() if i.compress_type == zipfile.ZIP_DEFLATED]
+        if len(members) == 0:
+            return params, [6]
+
+        info = max(members, key=lambda i: i.file_size)
+        raw = zf.read(info)
+    offset = info.header_offset
+    name_len, extra_len = struct.unpack("<HH", data[offset + 26 : offset + 30])
+    start = offset + 30 + name_len + extra_len
+    return params, _get_levels(raw, data[start : start + info.compress_size])
+
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise UtilsError("Unexpected end of archive", expected=True)
+    return data
+
+
+def _copy(src, dst, size=None):
+    # Copies size bytes or everything left
+    while size is None or size > 0:
+        want = CHUNK_SIZE if size is None else min(CHUNK_SIZE, size)
+        data = src.read(want)
+        if size is None:
+            if len(data) == 0:
+                break
+        else:
+            if len(data) != want:
+                raise UtilsError("Unexpected end of archive", expected=True)
+            size -= want
+        dst.write(data)
+
+
+def _unpack(src, dst, fmt):
+    try:
+        if fmt == "gzip":
+            _unpack_gzip(src, dst)
+        elif fmt == "zip":
+            _walk_zip(src, dst, _inflate_member)
+        else:
+            raise UtilsError("Unknown payload format: {}".format(fmt), expected=True)
+    except zlib.error as err:
+        raise UtilsError("Corrupt archive: {}".format(err), expected=True)
+
+
+def _pack(src, dst, params):
+    fmt = params.get("format")
+    level = params.get("level")
+    if fmt == "gzip":
+        _pack_gzip(src, dst, binascii.unhexlify(params["header"]), level)
+    elif fmt == "zip":
+
+        def deflate_member(src, dst, csize, usize):
+            _deflate_member(src, dst, csize, usize, level)
+
+        _walk_zip(src, dst, deflate_member)
+    else:
+        raise UtilsError("Unknown payload format: {}".format(fmt), expected=True)
+
+
+def _read_gzip_header(f):
+    header = _read(f, 10)
+    if header[:2] != GZIP_MAGIC or header[2:3] != b"\x08":
+        raise UtilsError("Not a gzip archive", expected=True)
+
+    flags = ord(header[3:4])
+    if flags & _FEXTRA:
+        extra_len = _read(f, 2)
+        header += extra_len + _read(f, struct.unpack("<H", extra_len)[0])
+    for flag in (_FNAME, _FCOMMENT):
+        if flags & flag:
+            while True:
+                c = _read(f, 1)
+                header += c
+                if c == b"\x00":
+                    break
+    if flags & _FHCRC:
+        header += _read(f, 2)
+    return header
+
+
+def _unpack_gzip(src, dst):
+    _read_gzip_header(src)
+    d = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    while not d.eof:
+        data = src.read(CHUNK_SIZE)
+        if len(data) == 0:
+            raise UtilsError("Unexpected end of archive", expected=True)
+        data = d.decompress(data)
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        dst.write(data)
+
+    # Only single member archives can be rebuilt
+    trailer = d.unused_data
+    if len(trailer) < 9:
+        trailer += src.read(9 - len(trailer))
+    if len(trailer) != 8:
+        raise UtilsError("Unexpected data after gzip stream", expected=True)
+    if struct.unpack("<II", trailer) != (crc & 0xFFFFFFFF, size & 0xFFFFFFFF):
+        raise UtilsError("gzip checksum mismatch", expected=True)
+
+
+def _pack_gzip(src, dst, header, level):
+    dst.write(header)
+    c = _get_compressor(level)
+    crc = 0
+    size = 0
+    while True:
+        data = src.read(CHUNK_SIZE)
+        if len(data) == 0:
+            break
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        dst.write(c.compress(data))
+    dst.write(c.flush())
+    dst.write(struct.pack("<II", crc & 0xFFFFFFFF, size & 0xFFFFFFFF))
+
+
+def _walk_zip(src, dst, member):
+    # Copies local headers as is & passes the data of deflated members
+    # to member. Everything from the central directory on is copied as
+    # is. The sizes in each local header say how much data follows in
+    # both the archive & the payload.
+    while True:
+        sig = src.read(4)
+        if sig != ZIP_MAGIC:
+            dst.write(sig)
+            _copy(src, dst)
+            return
+
+        header = sig + _read(src, 26)
+        fields = struct.unpack("<HHHHHIIIHH", header[4:])
+        flags, method = fields[1], fields[2]
+        csize, usize, name_len, extra_len = fields[6:]
+        if flags & (_ZIP_ENCRYPTED | _ZIP_DATA_DESCRIPTOR):
+            raise UtilsError("Unsupported zip member flags", expected=True)
+        if _ZIP64_SIZE in (csize, usize):
+            raise UtilsError("zip64 members not supported", expected=True)
+        dst.write(header + _read(src, name_len + extra_len))
+
+        if method == zipfile.ZIP_STORED:
+            _copy(src, dst, csize)
+        elif method == zipfile.ZIP_DEFLATED:
+            member(src, dst, csize, usize)
+        else:
+            raise UtilsError("Unsupported zip compression", expected=True)
+
+
+def _inflate_member(src, dst, csize, usize):
+    d = zlib.decompressobj(-zlib.MAX_WBITS)
+    size = 0
+    while csize > 0:
+        data = _read(src, min(CHUNK_SIZE, csize))
+        csize -= len(data)
+        data = d.decompress(data)
+        size += len(data)
+        dst.write(data)
+    data = d.flush()
+    size += len(data)
+    dst.write(data)
+    if not d.eof or size != usize:
+        raise UtilsError("Corrupt zip member", expected=True)
+
+
+def _deflate_member(src, dst, csize, usize, level):
+    c = _get_compressor(level)
+    size = 0
+    while usize > 0:
+        data = _read(src, min(CHUNK_SIZE, usize))
+        usize -= len(data)
+        data = c.compress(data)
+        size += len(data)
+        dst.write(data)
+    data = c.flush()
+    size += len(data)
+    dst.write(data)
+    if size != csize:
+        raise UtilsError("zip member doesn't rebuild to its size", expected=True)
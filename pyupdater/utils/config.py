@@ -49,6 +49,16 @@ class Config(dict):
             "PLUGIN_CONFIGS": {},
             # Support for patch updates
             "UPDATE_PATCHES": True,
+            # Number of older versions to also patch straight to the
+            # newest version from
+            "CUMULATIVE_PATCHES": 0,
+            # Which older versions: linear or geometric
+            "CUMULATIVE_PATCH_SPACING": "linear",
+            # Engine patches are made with. bsdiff4 or zstd
+            "PATCH_ENGINE": "bsdiff4",
+            # Diff the uncompressed payload of gzip & zip archives.
+            # Older clients can't apply these patches.
+            "PAYLOAD_PATCHES": False,
             # Max retries for downloads
             "MAX_DOWNLOAD_RETRIES": 3,
             # HTTP TIMEOUT
@@ -0,0 +1,428 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2020 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+import hashlib
+import json
+import logging
+
+from dsdev_utils.helpers import Version
+
+from pyupdater import settings
+from pyupdater.utils.exceptions import UtilsError
+
+log = logging.getLogger(__name__)
+
+# Version of the manifest container format
+MANIFEST_FORMAT = 2
+
+# Key in version file where precomputed patch chains are stored
+PATCH_CHAINS_KEY = "patch_chains"
+
+# Key in a platform's info holding patches from older versions
+CUMULATIVE_PATCHES_KEY = "cumulative_patches"
+
+
+# A manifest container is a json header line followed by the payload.
+#
+#   {"format": 2, "signature": "..."}\n
+#   <payload>
+#
+# The signature covers the payload bytes exactly as stored, so they
+# can be verified without parsing & re-serializing the manifest.
+def pack_manifest(payload, signature, **kwargs):
+    """Creates a manifest container
+
+    Args:
+
+        payload (bytes): Signed manifest data
+
+        signature (str): Encoded signature of payload
+
+    Kwargs:
+
+        Extra values to store in the header
+
+    Returns:
+
+        (bytes): Container data
+    """
+    header = {"format": MANIFEST_FORMAT, "signature": signature}
+    header.update(kwargs)
+    header = json.dumps(header, sort_keys=True)
+    return bytes(header, "utf-8") + b"\n" + payload
+
+
+def unpack_manifest(data):
+    """Splits a manifest container into its header & payload
+
+    Args:
+
+        data (bytes): Container data
+
+    Returns:
+
+        (tuple): header (dict), payload (bytes)
+
+    Raises:
+
+        UtilsError: data isn't a supported manifest container
+    """
+    header, sep, payload = data.partition(b"\n")
+    try:
+        header = json.loads(header.decode("utf-8"))
+    except ValueError:
+        raise UtilsError("Invalid manifest header", expected=True)
+
+    if not sep or not isinstance(header, dict) or "format" not in header:
+        raise UtilsError("Not a manifest container", expected=True)
+
+    if header["format"] != MANIFEST_FORMAT:
+        raise UtilsError(
+            "Unsupported manifest format: {}".format(header["format"]), expected=True
+        )
+    return header, payload
+
+
+def is_manifest_container(data):
+    """Returns True if data looks like a manifest container. False if
+    it's a legacy version file"""
+    # Legacy version files are a single line of json
+    header, sep, payload = data.partition(b"\n")
+    return len(sep) > 0 and len(payload.strip()) > 0
+
+
+def get_shard_id(name, channel=None):
+    """Returns a filename safe id for the shard of name & channel"""
+    key = json.dumps([name, channel])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def split_manifest(update_data):
+    """Splits a version manifest into a shard per name & a shard per
+    name & release channel
+
+    Args:
+
+        update_data (dict): Unsigned version manifest
+
+    Returns:
+
+        (dict): Shards keyed by (name, channel). Channel is None for the
+        shard holding every channel of name.
+    """
+    shards = {}
+    updates = update_data.get(settings.UPDATES_KEY, {})
+    latest = update_data.get("latest", {})
+    for name, versions in updates.items():
+        name_latest = latest.get(name, {})
+        name_chains = update_data.get(PATCH_CHAINS_KEY, {}).get(name)
+        shards[(name, None)] = {
+            settings.UPDATES_KEY: {name: versions},
+            "latest": {name: name_latest},
+        }
+        if name_chains is not None:
+            shards[(name, None)][PATCH_CHAINS_KEY] = {name: name_chains}
+
+        for channel, platforms in name_latest.items():
+            # The latest versions are always kept so the shard can't
+            # end up without the file it points to
+            latest_versions = set(platforms.values())
+            channel_versions = {}
+            for v, info in versions.items():
+                if v in latest_versions or Version(v).channel == channel:
+                    channel_versions[v] = info
+
+            shards[(name, channel)] = {
+                settings.UPDATES_KEY: {name: channel_versions},
+                "latest": {name: {channel: platforms}},
+            }
+            if name_chains is not None:
+                channel_chains = {}
+                for platform, chains in name_chains.items():
+                    if channel in chains:
+                        channel_chains[platform] = {channel: chains[channel]}
+                shards[(name, channel)][PATCH_CHAINS_KEY] = {name: channel_chains}
+    return shards
+
+
+def build_manifest_shards(update_data, filename_template):
+    """Creates the shards of a version manifest & the index of them
+
+    Args:
+
+        update_data (dict): Unsigned version manifest
+
+        filename_template (str): Shard filename with a placeholder for
+        the shard id
+
+    Returns:
+
+        (tuple): index (dict), shard files (dict of filename to bytes)
+    """
+    index = {}
+    files = {}
+    for (name, channel), shard in split_manifest(update_data).items():
+        data = bytes(json.dumps(shard, sort_keys=True), "utf-8")
+        filename = filename_template.format(get_shard_id(name, channel))
+        files[filename] = data
+
+        info = {
+            "filename": filename,
+            "file_hash": hashlib.sha256(data).hexdigest(),
+            "file_size": len(data),
+        }
+        entry = index.setdefault(name, {"channels": {}})
+        if channel is None:
+            entry.update(info)
+        else:
+            entry["channels"][channel] = info
+
+    log.debug("Created %s manifest shards", len(files))
+    return {"shards": index}, files
+
+
+def _group_by_channel(versions):
+    # Sorted versions grouped by channel the same way the patcher does it
+    channels = {}
+    for v in versions:
+        channels.setdefault(Version(v).channel, []).append(v)
+
+    for channel_versions in channels.values():
+        channel_versions.sort(key=Version)
+    return channels
+
+
+def _get_platforms(versions, channel_versions):
+    platforms = set()
+    for v in channel_versions:
+        platforms.update(versions[v])
+    return platforms
+
+
+def _get_oldest_needed(versions, channel_versions, platform, keep):
+    # Returns the index of the oldest version in channel_versions
+    # a client on platform can still patch from
+    newest = versions[channel_versions[-1]].get(platform)
+    if newest is None:
+        return len(channel_versions)
+
+    # Same limits the patcher uses. Patching only happens if all
+    # patches together are smaller than the full update.
+    file_size = newest.get("file_size")
+    fall_back = file_size is None
+    total_patch_size = 0
+    oldest = len(channel_versions) - 1
+    for i in range(len(channel_versions) - 1, 0, -1):
+        info = versions[channel_versions[i]].get(platform)
+        if info is None or "patch_name" not in info:
+            break
+
+        patch_size = info.get("patch_size")
+        if patch_size is None:
+            fall_back = True
+        else:
+            total_patch_size += int(patch_size)
+
+        num_patches = len(channel_versions) - i
+        if fall_back is True:
+            if num_patches > 4:
+                break
+        elif total_patch_size >= file_size:
+            break
+        oldest = i - 1
+
+    # Explicit retention of the last N versions
+    if keep:
+        with_platform = [
+            i for i, v in enumerate(channel_versions) if platform in versions[v]
+        ]
+        if with_platform:
+            oldest = min(oldest, with_platform[-keep:][0])
+    return oldest
+
+
+def compact_manifest(update_data, keep=None):
+    """Removes versions clients can no longer patch from
+
+    Versions referenced in latest are always kept. Clients running a
+    removed version fall back to a full update.
+
+    Args:
+
+        update_data (dict): Version manifest. Compacted in place.
+
+        keep (int): Also keep the last N versions of each channel &
+        platform
+
+    Returns:
+
+        (list): (name, version, platform) of each removed entry
+    """
+    removed = []
+    updates = update_data.get(settings.UPDATES_KEY, {})
+    latest = update_data.get("latest", {})
+    for name, versions in updates.items():
+        latest_versions = set()
+        for channel in latest.get(name, {}).values():
+            latest_versions.update(channel.items())
+
+        for channel_versions in _group_by_channel(versions).values():
+            for platform in _get_platforms(versions, channel_versions):
+                oldest = _get_oldest_needed(versions, channel_versions, platform, keep)
+
+                # Cumulative patches can reach further back
+                routes = _get_routes(versions, channel_versions, platform)
+                file_size = versions[channel_versions[-1]].get(platform, {})
+                file_size = file_size.get("file_size")
+
+                for v in channel_versions[:oldest]:
+                    if platform not in versions[v]:
+                        continue
+                    if (platform, v) in latest_versions:
+                        continue
+                    if v in routes and file_size and routes[v][0] < file_size:
+                        continue
+                    del versions[v][platform]
+                    removed.append((name, v, platform))
+
+                _remove_dead_patches(versions, channel_versions, platform)
+
+        for v in [v for v in versions if len(versions[v]) == 0]:
+            del versions[v]
+
+    log.debug("Removed %s entries from version manifest", len(removed))
+    return removed
+
+
+def _remove_dead_patches(versions, channel_versions, platform):
+    # Drops patches from versions no longer in the manifest
+    for i, v in enumerate(channel_versions):
+        info = versions[v].get(platform)
+        if info is None:
+            continue
+
+        if i > 0 and platform not in versions[channel_versions[i - 1]]:
+            for key in [
+                "patch_name",
+                "patch_hash",
+                "patch_size",
+                "patch_engine",
+                "patch_payload",
+            ]:
+                info.pop(key, None)
+
+        cumulative = info.get(CUMULATIVE_PATCHES_KEY, {})
+        for src in list(cumulative):
+            if src not in versions or platform not in versions[src]:
+                del cumulative[src]
+        if CUMULATIVE_PATCHES_KEY in info and len(cumulative) == 0:
+            del info[CUMULATIVE_PATCHES_KEY]
+
+
+def _get_patch_edges(versions, channel_versions, platform):
+    # Patches with a known size as {src: [(dst, size)]}
+    edges = {}
+    for i, v in enumerate(channel_versions):
+        info = versions[v].get(platform)
+        if info is None:
+            continue
+
+        # Regular patches are made from the previous version
+        prev = channel_versions[i - 1] if i > 0 else None
+        if prev is not None and platform in versions[prev]:
+            if "patch_name" in info and info.get("patch_size") is not None:
+                edges.setdefault(prev, []).append((v, int(info["patch_size"])))
+
+        for src, patch in info.get(CUMULATIVE_PATCHES_KEY, {}).items():
+            if src not in versions or platform not in versions[src]:
+                continue
+            if patch.get("patch_size") is not None:
+                edges.setdefault(src, []).append((v, int(patch["patch_size"])))
+    return edges
+
+
+def _get_routes(versions, channel_versions, platform):
+    # Cheapest patch route from each version to the newest version
+    # as {version: (total patch size, next version)}
+    newest = channel_versions[-1]
+    if platform not in versions[newest]:
+        return {}
+
+    edges = _get_patch_edges(versions, channel_versions, platform)
+    routes = {newest: (0, None)}
+    # Patches only go forward so every destination is already solved
+    for v in reversed(channel_versions[:-1]):
+        best = None
+        for dst, size in edges.get(v, []):
+            if dst not in routes:
+                continue
+            cost = size + routes[dst][0]
+            if best is None or cost < best[0]:
+                best = (cost, dst)
+        if best is not None:
+            routes[v] = best
+    return routes
+
+
+def _get_patch_chain(versions, channel_versions, platform):
+    routes = _get_routes(versions, channel_versions, platform)
+    if len(routes) < 2:
+        return None
+
+    chain = [v for v in channel_versions if v in routes]
+    positions = dict((v, i) for i, v in enumerate(chain))
+    return {
+        "versions": chain,
+        "sizes": [routes[v][0] for v in chain],
+        "next": [positions.get(routes[v][1], -1) for v in chain],
+    }
+
+
+def build_patch_chains(update_data):
+    """Precomputes the patch chain to the newest version of each name,
+    platform & channel
+
+    Args:
+
+        update_data (dict): Version manifest
+
+    Returns:
+
+        (dict): Chains keyed by name, platform & channel. Each has the
+        ordered versions that patch to the newest one, the total size
+        of the cheapest patches from each of them & the index of the
+        version the first of those patches leads to.
+    """
+    chains = {}
+    updates = update_data.get(settings.UPDATES_KEY, {})
+    for name, versions in updates.items():
+        for channel, channel_versions in _group_by_channel(versions).items():
+            for platform in _get_platforms(versions, channel_versions):
+                chain = _get_patch_chain(versions, channel_versions, platform)
+                if chain is None:
+                    continue
+                platforms = chains.setdefault(name, {})
+                platforms.setdefault(platform, {})[channel] = chain
+    return chains
@@ -0,0 +1,263 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2020 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+import abc
+import logging
+import threading
+
+try:  # pragma: no cover
+    import bsdiff4
+except ImportError:  # pragma: no cover
+    bsdiff4 = None
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+from stevedore.extension import ExtensionManager
+
+from pyupdater.utils.exceptions import UtilsError
+
+
+log = logging.getLogger(__name__)
+
+# Used for patches without an engine in the version manifest
+DEFAULT_ENGINE = "bsdiff4"
+
+# Key of the engine name in the version manifest
+PATCH_ENGINE_KEY = "patch_engine"
+
+# Entry point namespace of third party engines
+ENGINE_NAMESPACE = "pyupdater.plugins.patch_engine"
+
+
+class PatchEngine(abc.ABC):
+    """Makes & applies binary patches. Subclass to add an engine &
+    register it with register_engine or through the
+    pyupdater.plugins.patch_engine entry point. Entry points are only
+    loaded on the repo side. Subclasses that don't implement diff &
+    patch can't be created.
+    """
+
+    # Name recorded with each patch in the version manifest
+    name = None
+
+    # Peak memory while making a patch as multiples of the source &
+    # destination archive sizes
+    memory_factors = (2, 2)
+
+    # Bytes of patched archive produced per second. Used by the client
+    # to cost patch updates until it has timed patches of this engine.
+    apply_rate = 16 * 1024 * 1024
+
+    def is_available(self):
+        """Returns False if a required package isn't installed"""
+        return True
+
+    @abc.abstractmethod
+    def diff(self, src, dst):
+        """Returns a patch that turns the bytes src into dst"""
+
+    @abc.abstractmethod
+    def patch(self, src, patch):
+        """Returns the bytes patch turns src into"""
+
+    def file_patch(self, src_path, dst_path, patch_path):
+        """Applies the patch at patch_path to src_path & writes dst_path"""
+        with open(src_path, "rb") as f:
+            src = f.read()
+        with open(patch_path, "rb") as f:
+            patch = f.read()
+        with open(dst_path, "wb") as f:
+            f.write(self.patch(src, patch))
+
+
+class Bsdiff4Engine(PatchEngine):
+    """bsdiff. Small patches but suffix sorting the source is slow &
+    needs a lot of memory on large archives."""
+
+    name = "bsdiff4"
+
+    # Both archives, 2 64 bit ints per byte of the source for the
+    # suffix array & the diff output
+    memory_factors = (17, 3)
+
+    # Applying is bound by bz2 decompression of the patch
+    apply_rate = 32 * 1024 * 1024
+
+    def is_available(self):
+        return bsdiff4 is not None
+
+    def diff(self, src, dst):
+        return bsdiff4.diff(src, dst)
+
+    def patch(self, src, patch):
+        return bsdiff4.patch(src, patch)
+
+    def file_patch(self, src_path, dst_path, patch_path):
+        bsdiff4.file_patch(src_path, dst_path, patch_path)
+
+
+class ZstdEngine(PatchEngine):
+    """zstd compression of the new archive with the old archive as a raw
+    content dictionary, like zstd --patch-from. Long distance matching
+    finds matches across the whole source. Much faster than bsdiff on
+    large archives. Requires the zstandard package."""
+
+    name = "zstd"
+
+    # Both archives plus the match window & hash tables
+    memory_factors = (3, 3)
+
+    apply_rate = 256 * 1024 * 1024
+
+    # Compression level. Level 19 makes patches a few percent smaller
+    # but diffs large archives several times slower, which gives up most
+    # of zstd's speed over bsdiff. Subclass to trade build time for
+    # patch size.
+    level = 9
+
+    def is_available(self):
+        return zstandard is not None
+
+    @staticmethod
+    def _get_window_log(size):
+        # The window has to reach from the end of the new archive back
+        # to the start of the old one
+        window_log = max(zstandard.WINDOWLOG_MIN, int(size).bit_length())
+        return min(window_log, zstandard.WINDOWLOG_MAX)
+
+    @staticmethod
+    def _get_dict(src):
+        return zstandard.ZstdCompressionDict(
+            src, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+        )
+
+    def diff(self, src, dst):
+        params = zstandard.ZstdCompressionParameters.from_level(
+            self.level,
+            source_size=len(dst),
+            window_log=ZstdEngine._get_window_log(len(src) + len(dst)),
+            enable_ldm=True,
+        )
+        compressor = zstandard.ZstdCompressor(
+            compression_params=params, dict_data=ZstdEngine._get_dict(src)
+        )
+        return compressor.compress(dst)
+
+    def patch(self, src, patch):
+        frame = zstandard.get_frame_parameters(patch)
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=ZstdEngine._get_dict(src),
+            max_window_size=max(frame.window_size, 1 << zstandard.WINDOWLOG_MIN),
+        )
+        return decompressor.decompress(patch)
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+_plugins_lock = threading.Lock()
+_plugins_loaded = False
+
+
+def register_engine(engine):
+    """Makes engine available by its name
+
+    Args:
+
+        engine (PatchEngine): Engine to register
+
+    Raises:
+
+        UtilsError: If engine isn't a PatchEngine
+    """
+    if not isinstance(engine, PatchEngine):
+        raise UtilsError("Patch engines must subclass PatchEngine", expected=True)
+    with _engines_lock:
+        _engines[engine.name] = engine
+
+
+def load_plugins():
+    """Registers engines installed through the
+    pyupdater.plugins.patch_engine entry point. Only loaded once per
+    process. Called on the repo side. The client only uses the built-in
+    engines & engines passed to register_engine.
+    """
+    global _plugins_loaded
+    with _plugins_lock:
+        if _plugins_loaded:
+            return
+
+        try:
+            namespace = ExtensionManager(ENGINE_NAMESPACE, invoke_on_load=True)
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            namespace = None
+
+        # Engines missing diff or patch fail to load & are logged by
+        # stevedore
+        for ext in getattr(namespace, "extensions", []):
+            if getattr(ext.obj, "name", None) is None:
+                log.error("Patch engine does not have required name attribute")
+                continue
+            try:
+                register_engine(ext.obj)
+            except UtilsError as err:
+                log.error("%s: %s", ext.name, err)
+
+        _plugins_loaded = True
+
+
+def get_engine(name=None):
+    """Returns the named engine
+
+    Args:
+
+        name (str): Engine name. Defaults to DEFAULT_ENGINE
+
+    Returns:
+
+        (PatchEngine): The engine or None if it's unknown or its
+        requirements aren't installed
+    """
+    with _engines_lock:
+        engine = _engines.get(name or DEFAULT_ENGINE)
+    if engine is None:
+        log.debug("Unknown patch engine: %s", name)
+        return None
+    if not engine.is_available():
+        log.debug("Patch engine not available: %s", name)
+        return None
+    return engine
+
+
+def get_engine_names():
+    """Returns the sorted names of engines that can be used"""
+    with _engines_lock:
+        engines = list(_engines.values())
+    return sorted(e.name for e in engines if e.is_available())
+
+
+register_engine(Bsdiff4Engine())
+register_engine(ZstdEngine())
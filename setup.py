@@ -42,6 +42,7 @@ with open("README.md", "r") as f:
 
 extra_s3 = "PyUpdater-s3-Plugin >= 4.0.5"
 extra_scp = "PyUpdater-scp-Plugin >= 4.0"
+extra_zstd = "zstandard >= 0.15"
 
 
 setup(
@@ -56,7 +57,12 @@ setup(
     download_url=("https://github.com/Digital-Sapphire/PyUpdater/archive/master.zip"),
     license="MIT",
     keywords=KEYWORDS,
-    extras_require={"s3": extra_s3, "scp": extra_scp, "all": [extra_s3, extra_scp]},
+    extras_require={
+        "s3": extra_s3,
+        "scp": extra_scp,
+        "zstd": extra_zstd,
+        "all": [extra_s3, extra_scp, extra_zstd],
+    },
     zip_safe=False,
     include_package_data=True,
     tests_require=["pytest"],
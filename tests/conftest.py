@@ -26,7 +26,7 @@ import os
 import tempfile
 import threading
 
-from http.server import SimpleHTTPRequestHandler as RequestHandler
+from http.server import HTTPServer, SimpleHTTPRequestHandler as RequestHandler
 
 import socketserver as SocketServer
 
@@ -41,6 +41,31 @@ from pyupdater.utils.storage import Storage
 from tconfig import TConfig
 
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is python 3.7+
+    daemon_threads = True
+
+
+@pytest.fixture
+def threadedserver():
+    # Serves a request handler class from a background thread.
+    # Returns the base url.
+    servers = []
+
+    def start(handler):
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(httpd)
+        return "http://127.0.0.1:{}/".format(httpd.server_address[1])
+
+    yield start
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
 @pytest.fixture
 def cleandir():
     new_path = tempfile.mkdtemp()
@@ -25,17 +25,33 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler
 import json
 import os
 import time
 
-from dsdev_utils.helpers import EasyAccessDict
+from dsdev_utils.helpers import EasyAccessDict, Version
 from dsdev_utils.system import get_system
 from dsdev_utils.paths import ChDir, remove_any
+from nacl.signing import SigningKey
 import pytest
 
+from pyupdater import settings
+import pyupdater.client
 from pyupdater.client import Client
+from pyupdater.client.manifest import CompiledManifest
 from pyupdater.client.updates import gen_user_friendly_version, get_highest_version
+from pyupdater.utils.encoding import UnpaddedBase64Encoder
+from pyupdater.utils.exceptions import UtilsError
+from pyupdater.utils.manifest import (
+    build_manifest_shards,
+    is_manifest_container,
+    pack_manifest,
+    split_manifest,
+    unpack_manifest,
+)
 from tconfig import TConfig
 
 
@@ -270,6 +286,47 @@ class TestChannelLessStrict(object):
         )
 
 
+class TestCompiledManifest(object):
+
+    version_data = {
+        "latest": {"Acme": {"stable": {"mac": "4.2.0.2.0"}}},
+        "updates": {
+            "Acme": {
+                "4.2.0.2.0": {"mac": {"filename": "Acme-4.2.tar.gz"}},
+                "4.0.0.2.0": {"mac": {"filename": "Acme-4.0.tar.gz"}},
+                "4.1.0.2.0": {
+                    "mac": {"filename": "Acme-4.1.tar.gz", "patch_name": "p"},
+                    "win": {"filename": "Acme-4.1.zip"},
+                },
+            }
+        },
+    }
+
+    def test_lookups(self):
+        manifest = CompiledManifest(self.version_data)
+        assert str(manifest.get_latest("Acme", "mac", "stable")) == "4.2.0.2.0"
+        assert manifest.get_latest("Acme", "mac", "beta") is None
+        assert manifest.get_latest("Acme", "win", "stable", strict=False) is None
+
+        info = manifest.get_info("Acme", "4.1.0.2.0", "mac")
+        assert info.filename == "Acme-4.1.tar.gz"
+        assert info.patch_name == "p"
+        assert info.file_hash is None
+        assert manifest.get_info("Acme", "4.1.0.2.0", "nix") is None
+
+    def test_versions_after(self):
+        manifest = CompiledManifest(self.version_data)
+        versions = manifest.get_versions_after("Acme", "stable", Version("4.0.0.2.0"))
+        assert [str(v) for v in versions] == ["4.1.0.2.0", "4.2.0.2.0"]
+        assert manifest.get_versions_after("Acme", "stable", Version("4.2")) == []
+        assert manifest.get_versions_after("Other", "stable", Version("1.0")) == []
+
+    def test_empty(self):
+        manifest = CompiledManifest(None)
+        assert manifest.get_latest("Acme", "mac", "stable") is None
+        assert manifest.get_versions("Acme", "stable") == []
+
+
 class TestMissingStable(object):
 
     version_data = {
@@ -281,3 +338,392 @@ class TestMissingStable(object):
     def test1(self):
         data = EasyAccessDict(self.version_data)
         assert get_highest_version("Acme", "mac", "stable", data, strict=True) is None
+
+
+class ManifestRequestHandler(BaseHTTPRequestHandler):
+    # Serves in memory files with an ETag & honors If-None-Match
+    protocol_version = "HTTP/1.1"
+    files = {}
+    # (filename, status) of every request
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        filename = self.path.lstrip("/")
+        data = self.files.get(filename)
+        if data is None:
+            self.requests.append((filename, 404))
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = '"{}"'.format(hashlib.sha256(data).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.requests.append((filename, 304))
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.requests.append((filename, 200))
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class SignedRepo(object):
+    # Signs key & version files the way the repo side does
+
+    def __init__(self, url):
+        self.url = url
+        self.root_key = SigningKey.generate()
+        self.app_key = SigningKey.generate()
+        self.public_key = UnpaddedBase64Encoder.encode(
+            bytes(self.root_key.verify_key)
+        ).decode()
+
+        app_public = UnpaddedBase64Encoder.encode(bytes(self.app_key.verify_key))
+        signature = UnpaddedBase64Encoder.encode(self.root_key.sign(app_public)[:64])
+        key_data = {"app_public": app_public.decode(), "signature": signature.decode()}
+        self.add_file("keys.gz", key_data)
+
+    def add_file(self, filename, data):
+        data = json.dumps(data, sort_keys=True).encode()
+        ManifestRequestHandler.files[filename] = gzip.compress(data)
+
+    def sign(self, data):
+        signature = self.app_key.sign(data)[:64]
+        return UnpaddedBase64Encoder.encode(signature).decode()
+
+    def publish(self, version, container=True):
+        data = {
+            "latest": {"Acme": {"stable": {"mac": version}}},
+            "updates": {"Acme": {version: {"mac": {"filename": "Acme.tar.gz"}}}},
+        }
+        self.data = json.loads(json.dumps(data))
+        update_data = json.dumps(data, sort_keys=True).encode()
+        signature = self.sign(update_data)
+        if container:
+            ManifestRequestHandler.files[
+                settings.VERSION_FILE_FILENAME_V2
+            ] = gzip.compress(pack_manifest(update_data, signature))
+        data["signature"] = signature
+        for vf in ["versions.gz", settings.VERSION_FILE_FILENAME]:
+            self.add_file(vf, data)
+
+    def publish_shards(self):
+        index, files = build_manifest_shards(
+            self.data, settings.MANIFEST_SHARD_FILENAME
+        )
+        for filename, data in files.items():
+            ManifestRequestHandler.files[filename] = gzip.compress(data)
+        payload = json.dumps(index, sort_keys=True).encode()
+        ManifestRequestHandler.files[settings.MANIFEST_INDEX_FILENAME] = gzip.compress(
+            pack_manifest(payload, self.sign(payload))
+        )
+        return index["shards"]
+
+    def client(self, **config):
+        t_config = TConfig()
+        t_config.DATA_DIR = os.getcwd()
+        t_config.PUBLIC_KEY = self.public_key
+        t_config.UPDATE_URLS = [self.url]
+        for k, v in config.items():
+            setattr(t_config, k, v)
+        return Client(t_config, refresh=True, test=True)
+
+
+@pytest.fixture
+def signed_repo(threadedserver):
+    pyupdater.client._missing_manifests.clear()
+    ManifestRequestHandler.files = {}
+    ManifestRequestHandler.requests = []
+    repo = SignedRepo(threadedserver(ManifestRequestHandler))
+    repo.publish("4.1.0.2.0")
+    return repo
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestConditionalRefresh(object):
+    def test_not_modified(self, signed_repo, monkeypatch):
+        client = signed_repo.client()
+        assert client.verified is True
+        json_data = client.json_data
+        assert [r[1] for r in ManifestRequestHandler.requests] == [200, 200]
+
+        # Unchanged data must not be verified again
+        def fail(*args, **kwargs):
+            raise AssertionError("Verified again")
+
+        monkeypatch.setattr(pyupdater.client, "VerifyKey", fail)
+        del ManifestRequestHandler.requests[:]
+        client.refresh()
+        assert [r[1] for r in ManifestRequestHandler.requests] == [304, 304]
+        assert client.verified is True
+        assert client.json_data == json_data
+
+    def test_modified(self, signed_repo):
+        client = signed_repo.client()
+        signed_repo.publish("4.2.0.2.0")
+        del ManifestRequestHandler.requests[:]
+        client.refresh()
+        assert [r[1] for r in ManifestRequestHandler.requests] == [304, 200]
+        assert client.verified is True
+        assert client.json_data["latest"]["Acme"]["stable"]["mac"] == "4.2.0.2.0"
+
+    def test_cache_deleted(self, signed_repo):
+        client = signed_repo.client()
+        os.remove(client.version_file_v2)
+        del ManifestRequestHandler.requests[:]
+        client.refresh()
+        assert [r[1] for r in ManifestRequestHandler.requests] == [304, 200]
+        assert os.path.exists(client.version_file_v2)
+
+    def test_new_client_verifies(self, signed_repo):
+        signed_repo.client()
+        del ManifestRequestHandler.requests[:]
+        client = signed_repo.client()
+        assert [r[1] for r in ManifestRequestHandler.requests] == [304, 304]
+        assert client.verified is True
+
+
+@pytest.fixture
+def shared_digests():
+    pyupdater.client._shared_verified_digests.clear()
+    yield pyupdater.client._shared_verified_digests
+    pyupdater.client._shared_verified_digests.clear()
+
+
+@pytest.mark.usefixtures("cleandir", "shared_digests")
+class TestVerifiedCache(object):
+    def test_shared(self, signed_repo, monkeypatch):
+        client = signed_repo.client(CACHE_VERIFIED_MANIFEST=True)
+        assert client.verified is True
+        json_data = client.json_data
+
+        def fail(*args, **kwargs):
+            raise AssertionError("Verified again")
+
+        monkeypatch.setattr(pyupdater.client, "VerifyKey", fail)
+        client = signed_repo.client(CACHE_VERIFIED_MANIFEST=True)
+        assert client.verified is True
+        assert client.json_data == json_data
+
+    def test_changed_manifest(self, signed_repo, shared_digests):
+        signed_repo.client(CACHE_VERIFIED_MANIFEST=True)
+        signed_repo.publish("4.2.0.2.0")
+        client = signed_repo.client(CACHE_VERIFIED_MANIFEST=True)
+        assert client.verified is True
+        assert len(shared_digests) == 3
+        assert not os.path.exists("verified.json")
+
+    def test_tampered_manifest(self, signed_repo):
+        signed_repo.client(CACHE_VERIFIED_MANIFEST=True)
+        # New data with a bad signature
+        data = b'{"latest": {"Acme": {"stable": {"mac": "9.0.0.2.0"}}}}'
+        signature = signed_repo.app_key.sign(b"{}")[:64]
+        signature = UnpaddedBase64Encoder.encode(signature).decode()
+        ManifestRequestHandler.files[settings.VERSION_FILE_FILENAME_V2] = gzip.compress(
+            pack_manifest(data, signature)
+        )
+        client = signed_repo.client(CACHE_VERIFIED_MANIFEST=True)
+        assert client.verified is False
+
+    def test_forged_cache_file(self, signed_repo, shared_digests):
+        client = signed_repo.client(CACHE_VERIFIED_MANIFEST=True)
+        assert client.verified is True
+
+        # Tamper with the cached manifest & forge a digest for it the
+        # way older clients stored them in the data dir
+        data = b'{"latest": {"Acme": {"stable": {"mac": "9.0.0.2.0"}}}}'
+        signature = signed_repo.app_key.sign(b"{}")[:64]
+        signature = UnpaddedBase64Encoder.encode(signature).decode()
+        with open(client.version_file_v2, "wb") as f:
+            f.write(gzip.compress(pack_manifest(data, signature)))
+        forged = pyupdater.client._get_verified_digest(
+            client.app_key, pack_manifest(data, signature)
+        )
+        with open("verified.json", "w") as f:
+            json.dump({"manifest": forged}, f)
+
+        # A new process starts without the digests of the last one
+        shared_digests.clear()
+        del ManifestRequestHandler.requests[:]
+        client = signed_repo.client(CACHE_VERIFIED_MANIFEST=True)
+        assert ManifestRequestHandler.requests[-1] == (
+            settings.VERSION_FILE_FILENAME_V2,
+            304,
+        )
+        assert client.verified is False
+        assert forged not in shared_digests
+
+    def test_disabled(self, signed_repo, shared_digests):
+        signed_repo.client()
+        assert len(shared_digests) == 0
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestManifestContainer(object):
+    def test_container_preferred(self, signed_repo, monkeypatch):
+        # The container payload is verified as is
+        def fail(*args, **kwargs):
+            raise AssertionError("Manifest re-serialized")
+
+        client = signed_repo.client()
+        monkeypatch.setattr(pyupdater.client.json, "dumps", fail)
+        client = signed_repo.client()
+        assert client.verified is True
+        assert client.json_data["latest"]["Acme"]["stable"]["mac"] == "4.1.0.2.0"
+        assert ManifestRequestHandler.requests[-1] == (
+            settings.VERSION_FILE_FILENAME_V2,
+            304,
+        )
+
+    def test_legacy_repo(self, signed_repo):
+        del ManifestRequestHandler.files[settings.VERSION_FILE_FILENAME_V2]
+        client = signed_repo.client()
+        assert client.verified is True
+        assert ManifestRequestHandler.requests[1:] == [
+            (settings.VERSION_FILE_FILENAME_V2, 404),
+            (settings.VERSION_FILE_FILENAME, 200),
+        ]
+
+    def test_legacy_repo_skips_container(self, signed_repo):
+        del ManifestRequestHandler.files[settings.VERSION_FILE_FILENAME_V2]
+        client = signed_repo.client()
+        del ManifestRequestHandler.requests[:]
+        client.refresh()
+        assert client.verified is True
+        assert ManifestRequestHandler.requests == [
+            (settings.KEY_FILE_FILENAME, 304),
+            (settings.VERSION_FILE_FILENAME, 304),
+        ]
+
+        # Also skipped by new clients of the same repo
+        del ManifestRequestHandler.requests[:]
+        client = signed_repo.client()
+        assert client.verified is True
+        assert settings.VERSION_FILE_FILENAME_V2 not in [
+            r[0] for r in ManifestRequestHandler.requests
+        ]
+
+    def test_all_missing_not_cached(self, signed_repo):
+        files = ManifestRequestHandler.files
+        ManifestRequestHandler.files = {}
+        client = signed_repo.client(MAX_DOWNLOAD_RETRIES=1)
+        assert client.verified is False
+        assert len(pyupdater.client._missing_manifests) == 0
+
+        ManifestRequestHandler.files = files
+        del ManifestRequestHandler.requests[:]
+        client.refresh()
+        assert client.verified is True
+        assert ManifestRequestHandler.requests[1] == (
+            settings.VERSION_FILE_FILENAME_V2,
+            200,
+        )
+
+    def test_pack_unpack(self):
+        data = pack_manifest(b'{"a": 1}\n{"b": 2}', "sig")
+        assert is_manifest_container(data)
+        assert not is_manifest_container(b'{"a": 1}')
+        header, payload = unpack_manifest(data)
+        assert header == {"format": 2, "signature": "sig"}
+        assert payload == b'{"a": 1}\n{"b": 2}'
+
+    def test_unsupported_format(self):
+        with pytest.raises(UtilsError):
+            unpack_manifest(b'{"format": 3}\n{}')
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestManifestShards(object):
+    def test_update_check(self, signed_repo):
+        shards = signed_repo.publish_shards()
+        del ManifestRequestHandler.requests[:]
+        client = signed_repo.client(MANIFEST_SHARDS=True)
+        assert client.verified is True
+        assert client.json_data == {}
+        assert ManifestRequestHandler.requests[1:] == [
+            (settings.MANIFEST_INDEX_FILENAME, 200)
+        ]
+
+        update = client.update_check("Acme", "4.0.0")
+        assert update is not None
+        assert update.latest == "4.1.0.2.0"
+        filename = shards["Acme"]["channels"]["stable"]["filename"]
+        assert ManifestRequestHandler.requests[-1] == (filename, 200)
+
+        # Loaded once per refresh
+        del ManifestRequestHandler.requests[:]
+        assert client.update_check("Acme", "4.0.0") is not None
+        assert client.update_check("Other", "1.0") is None
+        assert ManifestRequestHandler.requests == []
+
+    def test_non_strict(self, signed_repo):
+        shards = signed_repo.publish_shards()
+        client = signed_repo.client(MANIFEST_SHARDS=True)
+        assert client.update_check("Acme", "4.0.0", strict=False) is not None
+        filename = shards["Acme"]["filename"]
+        assert ManifestRequestHandler.requests[-1] == (filename, 200)
+
+    def test_tampered_shard(self, signed_repo):
+        shards = signed_repo.publish_shards()
+        filename = shards["Acme"]["channels"]["stable"]["filename"]
+        ManifestRequestHandler.files[filename] = gzip.compress(b"{}")
+        client = signed_repo.client(MANIFEST_SHARDS=True)
+        assert client.verified is True
+        assert client.update_check("Acme", "4.0.0") is None
+
+    def test_no_index(self, signed_repo):
+        client = signed_repo.client(MANIFEST_SHARDS=True)
+        assert client.manifest_index is None
+        assert client.verified is True
+        assert client.update_check("Acme", "4.0.0") is not None
+
+    def test_offline(self, signed_repo):
+        signed_repo.publish_shards()
+        client = signed_repo.client(MANIFEST_SHARDS=True)
+        assert client.update_check("Acme", "4.0.0") is not None
+
+        # Only the key file is left online
+        files = ManifestRequestHandler.files
+        ManifestRequestHandler.files = {"keys.gz": files["keys.gz"]}
+        client = signed_repo.client(MANIFEST_SHARDS=True)
+        assert client.manifest_index is not None
+        assert client.update_check("Acme", "4.0.0") is not None
+
+    def test_split_manifest(self):
+        data = {
+            "latest": {"Acme": {"stable": {"mac": "1.1"}, "beta": {"mac": "1.2b1"}}},
+            "updates": {
+                "Acme": {"1.0": {"mac": {}}, "1.1": {"mac": {}}, "1.2b1": {"mac": {}}},
+                "Lib": {"2.0": {"mac": {}}},
+            },
+        }
+        shards = split_manifest(data)
+        assert sorted(shards, key=str) == sorted(
+            [("Acme", None), ("Acme", "beta"), ("Acme", "stable"), ("Lib", None)],
+            key=str,
+        )
+        assert shards[("Acme", None)]["updates"] == {"Acme": data["updates"]["Acme"]}
+        assert sorted(shards[("Acme", "stable")]["updates"]["Acme"]) == ["1.0", "1.1"]
+        assert sorted(shards[("Acme", "beta")]["updates"]["Acme"]) == ["1.2b1"]
+        assert shards[("Acme", "beta")]["latest"] == {
+            "Acme": {"beta": {"mac": "1.2b1"}}
+        }
+
+    def test_split_patch_chains(self):
+        chain = {"versions": ["1.0", "1.1"], "sizes": [10, 0]}
+        data = {
+            "latest": {"Acme": {"stable": {"mac": "1.1"}, "beta": {"mac": "1.2b1"}}},
+            "updates": {"Acme": {"1.0": {}, "1.1": {}, "1.2b1": {}}},
+            "patch_chains": {"Acme": {"mac": {"stable": chain}}},
+        }
+        shards = split_manifest(data)
+        assert shards[("Acme", None)]["patch_chains"] == data["patch_chains"]
+        assert shards[("Acme", "stable")]["patch_chains"] == data["patch_chains"]
+        assert shards[("Acme", "beta")]["patch_chains"] == {"Acme": {}}
@@ -23,10 +23,27 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import hashlib
+import io
+from http.server import BaseHTTPRequestHandler
+import os
+import time
 
 import pytest
 
-from pyupdater.client.downloader import FileDownloader, get_hash
+from pyupdater.client import downloader
+from pyupdater.client.downloader import (
+    DownloadWindow,
+    FileDownloader,
+    get_file_hash,
+    get_hash,
+    get_http_pool,
+    mirror_stats,
+    MirrorStats,
+    RateLimiter,
+)
 from pyupdater.utils.exceptions import FileDownloaderError
 
 
@@ -115,3 +132,374 @@ class TestGetHash(object):
     def test_get_hash(self):
         digest = "380fd2bf3d78bb411e4c1801ce3ce7804bf5a22d79" "405d950e5d5c8f3169fca0"
         assert digest == get_hash("Get this hash please")
+
+    def test_get_file_hash(self):
+        data = os.urandom(1024 * 1024 + 10)
+        with open("archive", "wb") as f:
+            f.write(data)
+        assert get_file_hash("archive", block_size=4096) == get_hash(data)
+
+    def test_get_file_hash_cache(self, monkeypatch):
+        with open("archive", "wb") as f:
+            f.write(b"version 1")
+        digest = get_file_hash("archive")
+
+        def fail(*args):
+            raise AssertionError("File hashed again")
+
+        monkeypatch.setattr(downloader, "_hash_file", fail)
+        assert get_file_hash("archive") == digest
+
+        monkeypatch.undo()
+        with open("archive", "ab") as f:
+            f.write(b" & 2")
+        assert get_file_hash("archive") == get_hash(b"version 1 & 2")
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    # Serves in memory files and honors single byte range requests
+    protocol_version = "HTTP/1.1"
+    files = {}
+    # Filename -> number of bytes to send before dropping the connection
+    drop_after = {}
+    # Range headers received
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.files.get(self.path.lstrip("/"))
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        range_header = self.headers.get("Range")
+        RangeRequestHandler.ranges.append(range_header)
+        if range_header is None:
+            self.send_response(200)
+            start, end = 0, len(data) - 1
+        else:
+            start, end = range_header.split("=")[1].split("-")
+            start = int(start)
+            end = int(end) if end else len(data) - 1
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, len(data))
+            )
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        drop_after = self.drop_after.pop(self.path.lstrip("/"), None)
+        if drop_after is not None:
+            self.wfile.write(data[start:drop_after])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start : end + 1])
+
+
+class NotFoundHandler(RangeRequestHandler):
+    # A mirror without any files
+    files = {}
+
+
+@pytest.fixture
+def rangeserver(threadedserver):
+    return threadedserver(RangeRequestHandler)
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestSegmented(object):
+    def test_segments(self):
+        fd = FileDownloader(FILENAME, URLS, download_connections=4)
+        fd.content_length = 10
+        assert fd._get_segments() == [(0, 1), (2, 3), (4, 5), (6, 9)]
+
+    def test_segmented_download(self, rangeserver):
+        data = os.urandom(1024 * 1024 + 7)
+        RangeRequestHandler.files["segmented.bin"] = data
+        fd = FileDownloader(
+            "segmented.bin",
+            [rangeserver],
+            hexdigest=hashlib.sha256(data).hexdigest(),
+            download_connections=4,
+        )
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is True
+        with open("segmented.bin", "rb") as f:
+            assert f.read() == data
+
+    def test_segmented_bad_hash(self, rangeserver):
+        RangeRequestHandler.files["segmented.bin"] = os.urandom(1024)
+        fd = FileDownloader(
+            "segmented.bin", [rangeserver], hexdigest="bad hash", download_connections=4
+        )
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestResume(object):
+    def test_resume_interrupted_download(self, rangeserver):
+        data = os.urandom(1024 * 1024)
+        RangeRequestHandler.files["resume.bin"] = data
+        RangeRequestHandler.drop_after["resume.bin"] = 300 * 1024
+        digest = hashlib.sha256(data).hexdigest()
+
+        fd = FileDownloader("resume.bin", [rangeserver], hexdigest=digest)
+        fd.download_max_size = 0
+        fd.resume_checkpoint_size = 1024
+        assert fd.download_verify_write() is False
+        assert os.path.exists("resume.bin.part")
+        assert os.path.exists("resume.bin.part.json")
+
+        del RangeRequestHandler.ranges[:]
+        fd = FileDownloader("resume.bin", [rangeserver], hexdigest=digest)
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is True
+        assert RangeRequestHandler.ranges[0] == "bytes={}-".format(300 * 1024)
+        assert not os.path.exists("resume.bin.part.json")
+        with open("resume.bin", "rb") as f:
+            assert f.read() == data
+
+    def test_resume_different_file(self, rangeserver):
+        data = os.urandom(1024)
+        RangeRequestHandler.files["resume.bin"] = data
+        with open("resume.bin.part", "wb") as f:
+            f.write(data[:512])
+        with open("resume.bin.part.json", "w") as f:
+            f.write('{"hexdigest": "old", "content_length": 1024, "offset": 512}')
+
+        del RangeRequestHandler.ranges[:]
+        fd = FileDownloader(
+            "resume.bin", [rangeserver], hexdigest=hashlib.sha256(data).hexdigest()
+        )
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is True
+        assert RangeRequestHandler.ranges == [None]
+
+    def test_download_dir(self, rangeserver):
+        data = os.urandom(1024)
+        RangeRequestHandler.files["resume.bin"] = data
+        os.mkdir("downloads")
+        download_dir = os.path.abspath("downloads")
+        fd = FileDownloader(
+            "resume.bin",
+            [rangeserver],
+            hexdigest=hashlib.sha256(data).hexdigest(),
+            download_dir=download_dir,
+        )
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is True
+        assert os.listdir(".") == ["downloads"]
+        with open(os.path.join(download_dir, "resume.bin"), "rb") as f:
+            assert f.read() == data
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestMirrors(object):
+    def test_sort_urls(self):
+        stats = MirrorStats()
+        stats.add_latency("fast/", 0.1)
+        stats.add_latency("slow/", 2.0)
+        stats.add_failure("down/")
+        urls = ["down/", "unknown/", "slow/", "fast/"]
+        assert stats.sort_urls(urls) == ["fast/", "slow/", "unknown/", "down/"]
+
+    def test_failure_cleared_by_success(self):
+        stats = MirrorStats()
+        stats.add_failure("flaky/")
+        stats.add_latency("flaky/", 0.5)
+        stats.add_latency("other/", 1.0)
+        assert stats.sort_urls(["other/", "flaky/"]) == ["flaky/", "other/"]
+
+    def test_throughput(self):
+        stats = MirrorStats()
+        assert stats.get_throughput() is None
+        # Too small to measure
+        stats.add_throughput(1024, 0.1)
+        assert stats.get_throughput() is None
+        stats.add_throughput(1024 * 1024, 1.0)
+        assert stats.get_throughput() == 1024 * 1024
+        stats.reset()
+        assert stats.get_throughput() is None
+
+    def test_race_mirrors(self, rangeserver):
+        mirror_stats.reset()
+        data = os.urandom(1024)
+        RangeRequestHandler.files["race.bin"] = data
+        bad_url = "http://127.0.0.1:1/"
+        fd = FileDownloader(
+            "race.bin",
+            [bad_url, rangeserver],
+            hexdigest=hashlib.sha256(data).hexdigest(),
+            max_download_retries=0,
+            race_mirrors=True,
+        )
+        assert fd.download_verify_return() == data
+        assert fd.file_url == rangeserver + "race.bin"
+        assert mirror_stats.sort_urls([bad_url, rangeserver])[0] == rangeserver
+
+    def test_not_found_mirror(self, rangeserver, threadedserver):
+        mirror_stats.reset()
+        data = os.urandom(1024)
+        RangeRequestHandler.files["mirror.bin"] = data
+        stale = threadedserver(NotFoundHandler)
+        # Known but slow
+        mirror_stats.add_latency(rangeserver, 1.0)
+        fd = FileDownloader(
+            "mirror.bin",
+            [stale, rangeserver],
+            hexdigest=hashlib.sha256(data).hexdigest(),
+        )
+        assert fd.download_verify_return() == data
+        assert mirror_stats.sort_urls([stale, rangeserver]) == [rangeserver, stale]
+
+    def test_all_mirrors_unreachable(self):
+        bad_urls = ["http://127.0.0.1:1/", "http://127.0.0.1:2/"]
+        for method, args in [
+            ("download_verify_write", []),
+            ("download_verify_stream", [io.BytesIO()]),
+        ]:
+            for hexdigest in ["abc", None]:
+                fd = FileDownloader(
+                    "x.bin", bad_urls, hexdigest=hexdigest, max_download_retries=0
+                )
+                assert getattr(fd, method)(*args) is False
+        fd = FileDownloader("x.bin", bad_urls, hexdigest="abc", max_download_retries=0)
+        assert fd.download_verify_return() is None
+        assert os.listdir(os.getcwd()) == []
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestSharedPool(object):
+    def test_connection_reuse(self, rangeserver):
+        data = os.urandom(1024)
+        RangeRequestHandler.files["pool.bin"] = data
+        http_pool = get_http_pool(keep_alive=True)
+        for _ in range(3):
+            fd = FileDownloader(
+                "pool.bin",
+                [rangeserver],
+                hexdigest=hashlib.sha256(data).hexdigest(),
+                http_pool=http_pool,
+            )
+            assert fd.http_pool is http_pool
+            assert fd.download_verify_return() == data
+        assert http_pool.stats == {"opened": 1, "reused": 2, "requests": 3}
+
+    def test_concurrent_stats(self, rangeserver):
+        data = os.urandom(1024)
+        RangeRequestHandler.files["pool.bin"] = data
+        http_pool = get_http_pool(maxsize=4)
+
+        def download(_):
+            fd = FileDownloader("pool.bin", [rangeserver], http_pool=http_pool)
+            return fd.download_verify_return()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            assert list(executor.map(download, range(32))) == [data] * 32
+        stats = http_pool.stats
+        assert stats["requests"] == 32
+        assert stats["opened"] + stats["reused"] == 32
+
+    def test_stats_survive_pool_eviction(self, rangeserver):
+        RangeRequestHandler.files["pool.bin"] = b"data"
+        http_pool = get_http_pool()
+        fd = FileDownloader("pool.bin", [rangeserver], http_pool=http_pool)
+        fd.download_verify_return()
+        http_pool.clear()
+        assert http_pool.stats["opened"] == 1
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestStreaming(object):
+    def test_stream(self, rangeserver):
+        data = os.urandom(100 * 1024)
+        RangeRequestHandler.files["stream.bin"] = data
+        fd = FileDownloader(
+            "stream.bin", [rangeserver], hexdigest=hashlib.sha256(data).hexdigest()
+        )
+        sink = io.BytesIO()
+        assert fd.download_verify_stream(sink) is True
+        assert sink.getvalue() == data
+        assert os.listdir(os.getcwd()) == []
+
+    def test_stream_bad_hash(self, rangeserver):
+        RangeRequestHandler.files["stream.bin"] = os.urandom(1024)
+        fd = FileDownloader("stream.bin", [rangeserver], hexdigest="bad hash")
+        assert fd.download_verify_stream(io.BytesIO()) is False
+
+    def test_write_small_file(self, rangeserver):
+        data = os.urandom(1024)
+        RangeRequestHandler.files["small.bin"] = data
+        fd = FileDownloader(
+            "small.bin", [rangeserver], hexdigest=hashlib.sha256(data).hexdigest()
+        )
+        assert fd.download_verify_write() is True
+        assert fd.file_binary_type == "file"
+        assert fd.file_binary_data is None
+        assert os.listdir(os.getcwd()) == ["small.bin"]
+        with open("small.bin", "rb") as f:
+            assert f.read() == data
+
+    def test_return(self, rangeserver):
+        data = os.urandom(100 * 1024)
+        RangeRequestHandler.files["return.bin"] = data
+        fd = FileDownloader(
+            "return.bin", [rangeserver], hexdigest=hashlib.sha256(data).hexdigest()
+        )
+        assert fd.download_verify_return() == data
+        assert fd.file_binary_type == "memory"
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestThrottle(object):
+    def test_rate_limiter(self):
+        limiter = RateLimiter(100 * 1024, burst=10 * 1024)
+        start = time.time()
+        for _ in range(5):
+            limiter.consume(10 * 1024)
+        # The first 10KB are free
+        assert time.time() - start >= 0.35
+
+    def test_rate_limited_download(self, rangeserver):
+        data = os.urandom(200 * 1024)
+        RangeRequestHandler.files["limited.bin"] = data
+        statuses = []
+        fd = FileDownloader(
+            "limited.bin",
+            [rangeserver],
+            hexdigest=hashlib.sha256(data).hexdigest(),
+            rate_limiter=RateLimiter(400 * 1024, burst=16 * 1024),
+            progress_hooks=[statuses.append],
+        )
+        start = time.time()
+        assert fd.download_verify_return() == data
+        assert time.time() - start >= 0.4
+        assert statuses[-1]["status"] == "finished"
+        assert 0 < statuses[-1]["rate"] <= 500 * 1024
+
+    def test_download_window(self):
+        window = DownloadWindow("01:00", "05:00")
+        assert window.is_open(datetime.datetime(2020, 1, 1, 2, 30))
+        assert not window.is_open(datetime.datetime(2020, 1, 1, 5, 0))
+        now = datetime.datetime(2020, 1, 1, 0, 30)
+        assert window.seconds_until_open(now) == 30 * 60
+        now = datetime.datetime(2020, 1, 1, 23, 0)
+        assert window.seconds_until_open(now) == 2 * 60 * 60
+
+    def test_download_window_midnight(self):
+        window = DownloadWindow("22:00", "02:00")
+        assert window.is_open(datetime.datetime(2020, 1, 1, 23, 0))
+        assert window.is_open(datetime.datetime(2020, 1, 1, 1, 0))
+        assert not window.is_open(datetime.datetime(2020, 1, 1, 12, 0))
+        assert window.seconds_until_open(datetime.datetime(2020, 1, 1, 12, 0)) == (
+            10 * 60 * 60
+        )
+
+    def test_bad_download_window(self):
+        with pytest.raises(FileDownloaderError):
+            DownloadWindow("1am", "5am")
@@ -23,11 +23,20 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals
+import gzip
+import json
 import os
 
+from nacl.signing import VerifyKey
 import pytest
 
+from pyupdater import settings
+from pyupdater.core.key_handler import KeyHandler
 from pyupdater.core.key_handler.keys import KeyImporter, Keys
+from pyupdater.utils.encoding import UnpaddedBase64Encoder
+from pyupdater.client.downloader import get_hash
+from pyupdater.utils.manifest import unpack_manifest
+from pyupdater.utils.storage import Storage
 
 
 @pytest.mark.usefixtures("cleandir")
@@ -48,3 +57,80 @@ class TestKeys(object):
     def test_key_importer_fail(self):
         ki = KeyImporter()
         assert ki.start() is False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestKeyHandler(object):
+    def test_sign_update(self):
+        Keys(test=True).make_keypack("one")
+        assert KeyImporter().start() is True
+        db = Storage()
+        version_data = {"updates": {"Acme": {}}, "latest": {"Acme": {}}}
+        db.save(settings.CONFIG_DB_KEY_VERSION_META, version_data)
+
+        kh = KeyHandler()
+        os.makedirs(kh.deploy_dir)
+        kh.sign_update(split_version=True)
+
+        with gzip.open(kh.version_file, "rb") as f:
+            legacy = json.loads(f.read().decode())
+        with gzip.open(kh.version_file_v2, "rb") as f:
+            header, payload = unpack_manifest(f.read())
+
+        assert header["signature"] == legacy.pop("signature")
+        assert json.loads(payload.decode()) == legacy
+
+        app_public = db.load(settings.CONFIG_DB_KEY_KEYPACK)["upload"]["app_public"]
+        pub_key = VerifyKey(app_public.encode(), UnpaddedBase64Encoder)
+        pub_key.verify(payload, UnpaddedBase64Encoder.decode(header["signature"]))
+
+    def test_sign_update_shard(self):
+        Keys(test=True).make_keypack("one")
+        assert KeyImporter().start() is True
+        db = Storage()
+        version_data = {
+            "updates": {"Acme": {"1.0": {"mac": {"filename": "Acme.tar.gz"}}}},
+            "latest": {"Acme": {"stable": {"mac": "1.0"}}},
+        }
+        db.save(settings.CONFIG_DB_KEY_VERSION_META, version_data)
+
+        kh = KeyHandler()
+        os.makedirs(kh.deploy_dir)
+        kh.sign_update(split_version=True, shard=True)
+
+        with gzip.open(kh.manifest_index_file, "rb") as f:
+            header, payload = unpack_manifest(f.read())
+
+        app_public = db.load(settings.CONFIG_DB_KEY_KEYPACK)["upload"]["app_public"]
+        pub_key = VerifyKey(app_public.encode(), UnpaddedBase64Encoder)
+        pub_key.verify(payload, UnpaddedBase64Encoder.decode(header["signature"]))
+
+        shards = json.loads(payload.decode())["shards"]
+        info = shards["Acme"]["channels"]["stable"]
+        with gzip.open(os.path.join(kh.deploy_dir, info["filename"]), "rb") as f:
+            data = f.read()
+        assert get_hash(data) == info["file_hash"]
+        assert json.loads(data.decode()) == version_data
+
+    def test_sign_update_compact(self):
+        Keys(test=True).make_keypack("one")
+        assert KeyImporter().start() is True
+        db = Storage()
+        old = {"filename": "Acme-1.0.tar.gz", "file_size": 100}
+        new = {"filename": "Acme-1.1.tar.gz", "file_size": 100}
+        version_data = {
+            "updates": {"Acme": {"1.0": {"mac": old}, "1.1": {"mac": new}}},
+            "latest": {"Acme": {"stable": {"mac": "1.1"}}},
+        }
+        db.save(settings.CONFIG_DB_KEY_VERSION_META, version_data)
+
+        kh = KeyHandler()
+        os.makedirs(kh.deploy_dir)
+        kh.sign_update(split_version=True, compact=True)
+
+        with gzip.open(kh.version_file, "rb") as f:
+            legacy = json.loads(f.read().decode())
+        assert list(legacy["updates"]["Acme"]) == ["1.1"]
+
+        version_data = db.load(settings.CONFIG_DB_KEY_VERSION_META)
+        assert list(version_data["updates"]["Acme"]) == ["1.1"]
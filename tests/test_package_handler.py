@@ -22,18 +22,38 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
-from __future__ import unicode_literals
+from __future__ import division, unicode_literals
 
+import gzip
+import hashlib
 import io
+import json
+import logging
 import os
+import random
+import shutil
 
+import bsdiff4
 from dsdev_utils.paths import ChDir
 import pytest
 
 from pyupdater import settings
 from pyupdater.core.package_handler import PackageHandler
-from pyupdater.core.package_handler.package import Package, parse_platform
-from pyupdater.core.package_handler.patch import Patch
+from pyupdater.core.package_handler.hash_cache import get_file_info, HashCache
+from pyupdater.core.package_handler.package import (
+    Package,
+    parse_platform,
+    remove_previous_versions,
+)
+from pyupdater.core.package_handler import patch as patch_module
+from pyupdater.core.package_handler.patch import (
+    get_cumulative_distances,
+    get_patch_memory,
+    get_patch_workers,
+    log_patch_report,
+    Patch,
+)
+from pyupdater.utils.archive_payload import pack
 from pyupdater.utils.config import Config
 from pyupdater.utils.exceptions import PackageHandlerError
 
@@ -42,6 +62,28 @@ from tconfig import TConfig
 user_data_dir = settings.USER_DATA_FOLDER
 
 
+class FakePatch(object):
+    # Just what make_patch needs. Has to be picklable
+    def __init__(self, name, src_data, dst_data):
+        with open(name + ".src", "wb") as f:
+            f.write(src_data)
+        with open(name + ".dst", "wb") as f:
+            f.write(dst_data)
+        self.src = os.path.abspath(name + ".src")
+        self.dst = os.path.abspath(name + ".dst")
+        self.patch_name = os.path.abspath(name)
+        self.basename = name
+        self.dst_filename = name + ".dst"
+        self.engine = "bsdiff4"
+        self.payload = False
+        self.pack_params = None
+        self.ok = True
+        self.time = None
+        self.hash = None
+        self.size = None
+        self.ratio = None
+
+
 @pytest.mark.usefixtures("cleandir", "pyu")
 class TestUtils(object):
     def test_init(self):
@@ -194,5 +236,259 @@ class TestPatch(object):
         assert patch.ok
         assert config["patches"][pkg.name]
 
+    def test_cumulative_patch(self, patch_setup):
+        with open(os.path.join(self.files_dir, "Acme-mac-4.0.tar.gz"), "w") as f:
+            f.write("v0")
+
+        with ChDir(self.new_dir):
+            full_path = os.path.abspath("Acme-mac-4.2.tar.gz")
+            pkg = Package(full_path)
+
+        patch = Patch(
+            filename=full_path,
+            files_dir=self.files_dir,
+            new_dir=self.new_dir,
+            json_data={},
+            pkg_info=pkg,
+            config={},
+            src_filename="Acme-mac-4.0.tar.gz",
+            src_version="4.0.0.2.0",
+        )
+        assert patch.ok
+        assert patch.cumulative
+        assert patch.src.endswith("Acme-mac-4.0.tar.gz")
+
+    def test_cumulative_distances(self):
+        assert get_cumulative_distances(0) == []
+        assert get_cumulative_distances(3) == [2, 3, 4]
+        assert get_cumulative_distances(3, "geometric") == [2, 4, 8]
+
+    def test_remove_previous_versions_keep(self):
+        os.makedirs(self.files_dir)
+        for i in range(1, 5):
+            for plat in ["mac", "win"]:
+                filename = "Acme-{}-4.{}.tar.gz".format(plat, i)
+                with open(os.path.join(self.files_dir, filename), "w") as f:
+                    f.write("v{}".format(i))
+
+        remove_previous_versions(self.files_dir, "Acme-mac-4.4.tar.gz", keep=2)
+        assert sorted(os.listdir(self.files_dir)) == [
+            "Acme-mac-4.2.tar.gz",
+            "Acme-mac-4.3.tar.gz",
+            "Acme-mac-4.4.tar.gz",
+            "Acme-win-4.2.tar.gz",
+            "Acme-win-4.3.tar.gz",
+            "Acme-win-4.4.tar.gz",
+        ]
+
     def test_patch_fail(self):
         pass
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPatchWorkers(object):
+    def test_cpu_bound(self):
+        patches = [FakePatch(str(i), b"a" * 10, b"b" * 10) for i in range(8)]
+        assert get_patch_workers(patches, cpu_count=4, available_memory=10**9) == 4
+        assert (
+            get_patch_workers(patches[:2], cpu_count=4, available_memory=10**9) == 2
+        )
+
+    def test_memory_bound(self):
+        patches = [FakePatch(str(i), b"a" * 100, b"b" * 100) for i in range(8)]
+        assert get_patch_memory(patches[0]) == 2000
+        assert get_patch_workers(patches, cpu_count=8, available_memory=5000) == 2
+        # Always at least 1
+        assert get_patch_workers(patches, cpu_count=8, available_memory=10) == 1
+
+    def test_no_patches(self):
+        assert get_patch_workers([]) == 0
+
+    def test_memory_unknown(self, monkeypatch):
+        # Half the cpus instead of no bound at all
+        monkeypatch.setattr(patch_module, "get_available_memory", lambda: None)
+        patches = [FakePatch(str(i), b"a" * 10, b"b" * 10) for i in range(8)]
+        assert get_patch_workers(patches, cpu_count=8) == 4
+        assert get_patch_workers(patches, cpu_count=1) == 1
+
+    def test_make_patches(self):
+        src = os.urandom(4096)
+        patches = [FakePatch(str(i), src, src + os.urandom(i)) for i in range(3)]
+        output = PackageHandler._make_patches(patches)
+        assert [p.basename for p in output] == ["0", "1", "2"]
+        for p in output:
+            with open(p.patch_name, "rb") as f:
+                data = f.read()
+            assert p.hash == hashlib.sha256(data).hexdigest()
+            assert p.size == len(data)
+            assert p.ratio == len(data) / os.path.getsize(p.dst)
+            assert p.time >= 0
+
+    def test_patch_report(self, caplog):
+        src = os.urandom(4096)
+        patches = PackageHandler._make_patches([FakePatch("0", src, src + b"1")])
+        with caplog.at_level(logging.INFO):
+            log_patch_report(patches)
+        assert "0 -> 0.dst: {} bytes".format(patches[0].size) in caplog.text
+        assert "1 patches, {} bytes".format(patches[0].size) in caplog.text
+
+    def test_patches_not_read_again(self):
+        src = os.urandom(4096)
+        patches = PackageHandler._make_patches([FakePatch("0", src, src + b"1")])
+        cache = HashCache()
+        PackageHandler._add_patches_to_packages([], patches, True, cache)
+        assert cache.misses == 0
+        # Cached for when the patch is looked at again
+        assert cache.get_file_info("0") == (patches[0].hash, patches[0].size)
+        assert cache.hits == 1
+
+    def test_make_patches_failure(self):
+        patches = [FakePatch("good", b"a", b"b"), FakePatch("bad", b"a", b"b")]
+        # Can't be read as an archive
+        os.remove(patches[1].dst)
+        os.mkdir(patches[1].dst)
+        output = PackageHandler._make_patches(patches)
+        assert output[0].ok is True
+        assert output[1].ok is False
+        assert not os.path.exists("bad")
+
+    def test_make_payload_patches(self):
+        src = os.urandom(4096) * 4
+        dst = src + os.urandom(100)
+        patches = [
+            FakePatch("gzip", gzip.compress(src), gzip.compress(dst)),
+            # Can't be unpacked. The archive is diffed.
+            FakePatch("raw", src, dst),
+        ]
+        for p in patches:
+            p.payload = True
+        output = PackageHandler._make_patches(patches)
+
+        with open(output[0].patch_name, "rb") as f:
+            assert bsdiff4.patch(src, f.read()) == dst
+        with open(output[0].dst, "rb") as f:
+            assert pack(dst, output[0].pack_params) == f.read()
+        # Sized for the payloads
+        memory = get_patch_memory(output[0])
+        output[0].payload = False
+        assert memory > get_patch_memory(output[0])
+        assert output[1].pack_params is None
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestHashCache(object):
+    def test_file_info(self):
+        data = os.urandom(3000)
+        with open("archive", "wb") as f:
+            f.write(data)
+        info = get_file_info("archive", block_size=1024)
+        assert info == (hashlib.sha256(data).hexdigest(), 3000)
+
+    def test_cache(self):
+        with open("archive", "wb") as f:
+            f.write(b"v1")
+        cache = HashCache("hashes.pyu")
+        info = cache.get_file_info("archive")
+        assert cache.get_file_info("archive") == info
+        assert (cache.hits, cache.misses) == (1, 1)
+        cache.save()
+
+        cache = HashCache("hashes.pyu")
+        assert cache.get_file_info("archive") == info
+        assert cache.hits == 1
+
+        with open("archive", "wb") as f:
+            f.write(b"v2 is longer")
+        assert cache.get_file_info("archive")[1] == 12
+        assert cache.misses == 1
+
+    def test_move(self):
+        with open("archive", "wb") as f:
+            f.write(b"v1")
+        cache = HashCache("hashes.pyu")
+        info = cache.get_file_info("archive")
+        os.mkdir("files")
+        shutil.move("archive", "files")
+        cache.move("archive", os.path.join("files", "archive"))
+        cache.save()
+
+        cache = HashCache("hashes.pyu")
+        assert cache.get_file_info(os.path.join("files", "archive")) == info
+        assert cache.hits == 1
+
+    def test_removed_files_dropped(self):
+        with open("archive", "wb") as f:
+            f.write(b"v1")
+        cache = HashCache("hashes.pyu")
+        cache.get_file_info("archive")
+        os.remove("archive")
+        cache.save()
+        with open("hashes.pyu") as f:
+            assert json.load(f)["entries"] == {}
+
+    def test_corrupt(self):
+        with open("hashes.pyu", "w") as f:
+            f.write("{")
+        with open("archive", "wb") as f:
+            f.write(b"v1")
+        cache = HashCache("hashes.pyu")
+        cache.get_file_info("archive")
+        assert cache.misses == 1
+
+    def test_files_info(self, caplog):
+        files = {}
+        for i in range(8):
+            data = os.urandom(random.randint(1, 200000))
+            with open(str(i), "wb") as f:
+                f.write(data)
+            files[str(i)] = (hashlib.sha256(data).hexdigest(), len(data))
+        names = sorted(files, reverse=True)
+
+        cache = HashCache()
+        assert cache.get_files_info(names) == [files[n] for n in names]
+        assert cache.get_files_info([]) == []
+        assert cache.misses == 8
+
+        with caplog.at_level(logging.INFO):
+            cache.log_timings()
+        assert "Hashed 8 files, 0 from cache" in caplog.text
+
+
+class TestPatchEngineManifest(object):
+    def _make_package(self, engine):
+        patch = FakePatch.__new__(FakePatch)
+        patch.basename = "Acme-mac-stable-3"
+        patch.hash = "h"
+        patch.size = 10
+        patch.engine = engine
+        patch.pack_params = None
+        patch.src_version = "4.0.0.2.0"
+        package = Package.__new__(Package)
+        package.file_hash = "h"
+        package.file_size = 100
+        package.filename = "Acme-mac-4.2.tar.gz"
+        package.patch = patch
+        package.cumulative_patches = [patch]
+        return package
+
+    def test_default_engine(self):
+        package = self._make_package("bsdiff4")
+        info = PackageHandler._manifest_to_version_file_compat(package)
+        assert "patch_engine" not in info
+        assert "patch_engine" not in info["cumulative_patches"]["4.0.0.2.0"]
+
+    def test_engine(self):
+        package = self._make_package("zstd")
+        info = PackageHandler._manifest_to_version_file_compat(package)
+        assert info["patch_engine"] == "zstd"
+        assert info["cumulative_patches"]["4.0.0.2.0"]["patch_engine"] == "zstd"
+
+    def test_pack_params(self):
+        package = self._make_package("bsdiff4")
+        info = PackageHandler._manifest_to_version_file_compat(package)
+        assert "patch_payload" not in info
+
+        package.patch.pack_params = {"format": "gzip", "level": 9}
+        info = PackageHandler._manifest_to_version_file_compat(package)
+        assert info["patch_payload"] == {"format": "gzip", "level": 9}
+        assert info["cumulative_patches"]["4.0.0.2.0"]["patch_payload"]["level"] == 9
@@ -23,12 +23,23 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals, print_function
+import gzip
+import hashlib
 import json
 import os
+import random
+import time
 
+import bsdiff4
 import pytest
 
+from pyupdater.client.downloader import mirror_stats
 from pyupdater.client.patcher import Patcher
+from pyupdater.client import planner as planner_module
+from pyupdater.client.planner import UpdatePlan, UpdatePlanner
+from pyupdater.utils.archive_payload import get_pack_params
+from pyupdater.utils.patch_engines import get_engine, PatchEngine, register_engine
+from pyupdater.utils.manifest import build_patch_chains
 
 
 def cb1(status):
@@ -123,3 +134,470 @@ class TestExecution(object):
         data["progress_hooks"] = [cb]
         p = Patcher(**data)
         assert p.start() is True
+
+
+class MemoryDownloader(object):
+    # Serves patches from memory with a random delay so downloads
+    # finish out of order
+    patches = {}
+    requested = []
+
+    def __init__(self, filename, urls, hexdigest=None, download_dir=None):
+        self.filename = filename
+        self.hexdigest = hexdigest
+        self.download_dir = download_dir
+
+    def download_verify_return(self):
+        MemoryDownloader.requested.append(self.filename)
+        time.sleep(random.uniform(0, 0.05))
+        data = self.patches.get(self.filename)
+        if data is None or hashlib.sha256(data).hexdigest() != self.hexdigest:
+            return None
+        return data
+
+    def download_verify_write(self):
+        data = self.download_verify_return()
+        if data is None:
+            return False
+        with open(os.path.join(self.download_dir, self.filename), "wb") as f:
+            f.write(data)
+        return True
+
+
+@pytest.fixture
+def patch_repo(tmpdir):
+    # Builds a chain of archives & patches so patching works offline
+    update_folder = tmpdir.mkdir("update")
+    archive = bytearray(os.urandom(64 * 1024))
+    versions = {}
+    patches = {}
+    for i in range(1, 7):
+        if i > 1:
+            old = bytes(archive)
+            for _ in range(20):
+                archive[random.randrange(len(archive))] = random.randrange(256)
+            patch = bsdiff4.diff(old, bytes(archive))
+            patches["Acme-mac-{}".format(i)] = patch
+        filename = "Acme-mac-4.{}.tar.gz".format(i)
+        info = {
+            "file_hash": hashlib.sha256(archive).hexdigest(),
+            "file_size": len(archive) * 10,
+            "filename": filename,
+        }
+        if i > 1:
+            info["patch_name"] = "Acme-mac-{}".format(i)
+            info["patch_hash"] = hashlib.sha256(patch).hexdigest()
+            info["patch_size"] = len(patch)
+        versions["4.{}.0.2.0".format(i)] = {"mac": info}
+        if i == 1:
+            update_folder.join(filename).write_binary(bytes(archive))
+
+    MemoryDownloader.patches = patches
+    MemoryDownloader.requested = []
+    # Plan with the default download speed
+    mirror_stats.reset()
+    data = update_data.copy()
+    data["update_folder"] = str(update_folder)
+    data["json_data"] = {"updates": {"Acme": versions}}
+    data["channel"] = "stable"
+    data["latest_version"] = "4.6.0.2.0"
+    data["downloader"] = MemoryDownloader
+    data["progress_hooks"] = []
+    return data, bytes(archive)
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestConcurrentDownloads(object):
+    def test_apply_order(self, patch_repo):
+        data, latest = patch_repo
+        p = Patcher(**data)
+        assert p.start() is True
+        assert len(MemoryDownloader.requested) == 5
+        with open(
+            os.path.join(data["update_folder"], "Acme-mac-4.6.tar.gz"), "rb"
+        ) as f:
+            assert f.read() == latest
+
+    def test_progress(self, patch_repo):
+        data, _ = patch_repo
+        statuses = []
+        data["progress_hooks"] = [statuses.append]
+        data["max_patch_downloads"] = 2
+        p = Patcher(**data)
+        assert p.start() is True
+        downloaded = [s["downloaded"] for s in statuses]
+        assert downloaded == [1, 2, 3, 4, 5, 5]
+        assert statuses[-1]["status"] == "finished"
+        assert statuses[-1]["percent_complete"] == "100.0"
+
+    def test_failed_patch(self, patch_repo):
+        data, _ = patch_repo
+        MemoryDownloader.patches["Acme-mac-3"] = b"corrupt"
+        statuses = []
+        data["progress_hooks"] = [statuses.append]
+        p = Patcher(**data)
+        assert p.start() is False
+        assert statuses[-1]["status"] == "failed to download all patches"
+
+    @pytest.mark.parametrize("low_memory", [False, True])
+    def test_cwd_unchanged(self, patch_repo, low_memory):
+        data, _ = patch_repo
+        cwd = os.getcwd()
+        seen = []
+
+        class CwdDownloader(MemoryDownloader):
+            def download_verify_return(self):
+                seen.append(os.getcwd())
+                return MemoryDownloader.download_verify_return(self)
+
+        data["downloader"] = CwdDownloader
+        data["low_memory"] = low_memory
+        p = Patcher(**data)
+        assert p.start() is True
+        assert seen == [cwd] * 5
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPipeline(object):
+    def test_pipeline(self, patch_repo):
+        data, latest = patch_repo
+        statuses = []
+        data["progress_hooks"] = [statuses.append]
+        data["pipeline_patches"] = True
+        p = Patcher(**data)
+        assert p.start() is True
+        assert [s["downloaded"] for s in statuses] == [1, 2, 3, 4, 5, 5]
+        with open(
+            os.path.join(data["update_folder"], "Acme-mac-4.6.tar.gz"), "rb"
+        ) as f:
+            assert f.read() == latest
+
+    def test_pipeline_failed_download(self, patch_repo):
+        data, _ = patch_repo
+        del MemoryDownloader.patches["Acme-mac-5"]
+        data["pipeline_patches"] = True
+        p = Patcher(**data)
+        assert p.start() is False
+        assert not os.path.exists(
+            os.path.join(data["update_folder"], "Acme-mac-4.6.tar.gz")
+        )
+
+    def test_pipeline_bad_patch(self, patch_repo):
+        data, _ = patch_repo
+        # Valid hash but not a patch for this archive
+        bad = b"not a bsdiff patch"
+        MemoryDownloader.patches["Acme-mac-2"] = bad
+        versions = data["json_data"]["updates"]["Acme"]
+        versions["4.2.0.2.0"]["mac"]["patch_hash"] = hashlib.sha256(bad).hexdigest()
+        data["pipeline_patches"] = True
+        p = Patcher(**data)
+        assert p.start() is False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestLowMemory(object):
+    def test_low_memory(self, patch_repo):
+        data, latest = patch_repo
+        data["low_memory"] = True
+        p = Patcher(**data)
+        assert p.start() is True
+        assert p.og_binary is None
+        assert sorted(os.listdir(data["update_folder"])) == [
+            "Acme-mac-4.1.tar.gz",
+            "Acme-mac-4.6.tar.gz",
+        ]
+        with open(
+            os.path.join(data["update_folder"], "Acme-mac-4.6.tar.gz"), "rb"
+        ) as f:
+            assert f.read() == latest
+
+    def test_low_memory_bad_patch(self, patch_repo):
+        data, _ = patch_repo
+        bad = b"not a bsdiff patch"
+        MemoryDownloader.patches["Acme-mac-4"] = bad
+        versions = data["json_data"]["updates"]["Acme"]
+        versions["4.4.0.2.0"]["mac"]["patch_hash"] = hashlib.sha256(bad).hexdigest()
+        data["low_memory"] = True
+        p = Patcher(**data)
+        assert p.start() is False
+        assert os.listdir(data["update_folder"]) == ["Acme-mac-4.1.tar.gz"]
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPatchChains(object):
+    def test_precomputed_chain(self, patch_repo, monkeypatch):
+        data, latest = patch_repo
+        json_data = data["json_data"]
+        json_data["patch_chains"] = build_patch_chains(json_data)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("Patch chain computed on client")
+
+        monkeypatch.setattr(Patcher, "_get_required_patches", fail)
+        p = Patcher(**data)
+        assert p.start() is True
+        assert MemoryDownloader.requested == [
+            "Acme-mac-{}".format(i) for i in range(2, 7)
+        ]
+        with open(
+            os.path.join(data["update_folder"], "Acme-mac-4.6.tar.gz"), "rb"
+        ) as f:
+            assert f.read() == latest
+
+    def test_patches_too_large(self, patch_repo):
+        data, _ = patch_repo
+        json_data = data["json_data"]
+        for info in json_data["updates"]["Acme"].values():
+            info["mac"]["file_size"] = 1
+        json_data["patch_chains"] = build_patch_chains(json_data)
+        p = Patcher(**data)
+        assert p.start() is False
+        assert MemoryDownloader.requested == []
+
+    def test_stale_chain(self, patch_repo):
+        # Chains not ending at the latest version are ignored
+        data, _ = patch_repo
+        json_data = data["json_data"]
+        json_data["patch_chains"] = build_patch_chains(json_data)
+        chain = json_data["patch_chains"]["Acme"]["mac"]["stable"]
+        chain["versions"] = chain["versions"][:-1]
+        chain["sizes"] = chain["sizes"][:-1]
+        p = Patcher(**data)
+        assert p.start() is True
+        assert len(MemoryDownloader.requested) == 5
+
+    def test_cumulative_patch(self, patch_repo, tmpdir):
+        data, latest = patch_repo
+        _add_cumulative_patch(data, tmpdir, latest)
+        json_data = data["json_data"]
+        json_data["patch_chains"] = build_patch_chains(json_data)
+        p = Patcher(**data)
+        assert p.start() is True
+        assert MemoryDownloader.requested == ["Acme-mac-1-6"]
+        with open(
+            os.path.join(data["update_folder"], "Acme-mac-4.6.tar.gz"), "rb"
+        ) as f:
+            assert f.read() == latest
+
+
+def _add_cumulative_patch(data, tmpdir, latest, patch_size=None):
+    oldest = tmpdir.join("update", "Acme-mac-4.1.tar.gz").read_binary()
+    patch = bsdiff4.diff(oldest, latest)
+    MemoryDownloader.patches["Acme-mac-1-6"] = patch
+    info = data["json_data"]["updates"]["Acme"]["4.6.0.2.0"]["mac"]
+    info["cumulative_patches"] = {
+        "4.1.0.2.0": {
+            "patch_name": "Acme-mac-1-6",
+            "patch_hash": hashlib.sha256(patch).hexdigest(),
+            "patch_size": patch_size or len(patch),
+        }
+    }
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestUpdatePlanner(object):
+    def test_full_update_faster(self):
+        planner = UpdatePlanner(bandwidth=10**9, apply_rate=10**3)
+        full = planner.plan_full(1000)
+        patches = planner.plan_patches(1000, ["1.1"], [10], [1000])
+        assert planner.choose([full, patches]) is full
+
+    def test_patch_faster(self):
+        planner = UpdatePlanner(bandwidth=10**3, apply_rate=10**9)
+        full = planner.plan_full(1000)
+        patches = planner.plan_patches(1000, ["1.1"], [10], [1000])
+        assert planner.choose([full, patches]) is patches
+
+    def test_memory(self):
+        planner = UpdatePlanner(apply_rate=10**9, available_memory=1000)
+        plan = planner.plan_patches(400, ["1.1", "1.2"], [100, 100], [400, 400])
+        assert plan.memory == 1000
+        assert planner.estimate(plan) is None
+        assert planner.choose([plan]) is None
+
+        planner.low_memory = True
+        plan = planner.plan_patches(400, ["1.1", "1.2"], [100, 100], [400, 400])
+        assert plan.memory == 900
+        assert planner.choose([plan]) is None
+
+    def test_apply_rate(self, monkeypatch):
+        monkeypatch.setattr(planner_module, "_apply_rates", {})
+        assert UpdatePlanner().apply_rate == get_engine("bsdiff4").apply_rate
+        register_engine(ReverseEngine())
+        assert UpdatePlanner().get_apply_rate("test-reverse") == 16 * 1024 * 1024
+        assert UpdatePlanner().get_apply_rate("does-not-exist") is None
+
+    def test_apply_rate_measured(self, monkeypatch):
+        monkeypatch.setattr(planner_module, "_apply_rates", {})
+        # Too small to count
+        planner_module.add_apply_time("bsdiff4", 1024, 1.0)
+        assert planner_module._apply_rates == {}
+
+        size = planner_module.APPLY_RATE_MIN_SIZE
+        planner_module.add_apply_time("bsdiff4", size, 1.0)
+        assert UpdatePlanner().apply_rate == size
+        planner_module.add_apply_time("bsdiff4", size, 0.5)
+        assert UpdatePlanner().apply_rate == pytest.approx(size * 1.3)
+
+    def test_apply_rate_per_engine(self, monkeypatch):
+        # Slow bsdiff, fast engine. Each route is costed at the speed
+        # of its own engine.
+        monkeypatch.setattr(
+            planner_module, "_apply_rates", {"bsdiff4": 10**3, "test-fast": 10**9}
+        )
+        planner = UpdatePlanner(bandwidth=10**4, available_memory=10**9)
+        full = planner.plan_full(1000)
+        bsdiff = planner.plan_patches(1000, ["1.1"], [10], [1000])
+        fast = planner.plan_patches(1000, ["1.1"], [10], [1000], ["test-fast"])
+        assert fast.apply_sizes == {"test-fast": 1000}
+        assert planner.choose([full, bsdiff]) is full
+        assert planner.choose([full, fast]) is fast
+
+        unknown = planner.plan_patches(1000, ["1.1"], [10], [1000], ["missing"])
+        assert planner.estimate(unknown) is None
+
+    def test_fewer_patches(self, patch_repo, tmpdir):
+        # Slow to apply patches. The cumulative patch wins even though
+        # patching through every version downloads less.
+        data, latest = patch_repo
+        _add_cumulative_patch(data, tmpdir, latest, patch_size=20000)
+        json_data = data["json_data"]
+        json_data["patch_chains"] = build_patch_chains(json_data)
+        chain = json_data["patch_chains"]["Acme"]["mac"]["stable"]
+        assert chain["next"][0] == 1
+
+        data["planner"] = UpdatePlanner(bandwidth=10**4, apply_rate=10**5)
+        p = Patcher(**data)
+        assert p.start() is True
+        assert MemoryDownloader.requested == ["Acme-mac-1-6"]
+
+    def test_not_enough_memory(self, patch_repo):
+        data, _ = patch_repo
+        data["planner"] = UpdatePlanner(available_memory=1024)
+        p = Patcher(**data)
+        assert p.start() is False
+        assert MemoryDownloader.requested == []
+
+    def test_plan_str(self):
+        assert str(UpdatePlan("full", 10)) == "full update"
+        plan = UpdatePlan("patch", 10, versions=["1.1", "1.2"])
+        assert str(plan) == "2 patch(es) to 1.1 -> 1.2"
+
+
+class ReverseEngine(PatchEngine):
+    # The patch is the new file reversed
+    name = "test-reverse"
+
+    def diff(self, src, dst):
+        return dst[::-1]
+
+    def patch(self, src, patch):
+        return patch[::-1]
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPatchEngines(object):
+    def _use_engine(self, data, latest, name):
+        patch = latest[::-1]
+        MemoryDownloader.patches["Acme-mac-1-6"] = patch
+        info = data["json_data"]["updates"]["Acme"]["4.6.0.2.0"]["mac"]
+        info["cumulative_patches"] = {
+            "4.1.0.2.0": {
+                "patch_name": "Acme-mac-1-6",
+                "patch_hash": hashlib.sha256(patch).hexdigest(),
+                "patch_size": 1,
+                "patch_engine": name,
+            }
+        }
+
+    @pytest.mark.parametrize("low_memory", [False, True])
+    def test_engine(self, patch_repo, low_memory):
+        register_engine(ReverseEngine())
+        data, latest = patch_repo
+        self._use_engine(data, latest, "test-reverse")
+        data["low_memory"] = low_memory
+        p = Patcher(**data)
+        assert p.start() is True
+        assert MemoryDownloader.requested == ["Acme-mac-1-6"]
+        with open(
+            os.path.join(data["update_folder"], "Acme-mac-4.6.tar.gz"), "rb"
+        ) as f:
+            assert f.read() == latest
+
+    def test_unknown_engine(self, patch_repo):
+        # Patches the client can't apply aren't used
+        data, latest = patch_repo
+        self._use_engine(data, latest, "does-not-exist")
+        p = Patcher(**data)
+        assert p.start() is True
+        assert len(MemoryDownloader.requested) == 5
+
+
+@pytest.fixture
+def payload_repo(patch_repo):
+    # Same chain with gzip archives. Patch 4 is of the archive itself,
+    # the rest are of the uncompressed payload.
+    data, _ = patch_repo
+    versions = data["json_data"]["updates"]["Acme"]
+    payload = bytearray(os.urandom(32 * 1024) * 4)
+    patches = {}
+    for i in range(1, 7):
+        old_payload = bytes(payload)
+        old_archive = gzip.compress(old_payload, mtime=0)
+        if i > 1:
+            for _ in range(20):
+                payload[random.randrange(len(payload))] = random.randrange(256)
+        archive = gzip.compress(bytes(payload), mtime=0)
+
+        info = versions["4.{}.0.2.0".format(i)]["mac"]
+        info["file_hash"] = hashlib.sha256(archive).hexdigest()
+        info["file_size"] = len(archive) * 10
+        if i == 1:
+            with open(os.path.join(data["update_folder"], info["filename"]), "wb") as f:
+                f.write(archive)
+            continue
+
+        name = info["patch_name"]
+        if i == 4:
+            patches[name] = bsdiff4.diff(old_archive, archive)
+        else:
+            patches[name] = bsdiff4.diff(old_payload, bytes(payload))
+            info["patch_payload"] = get_pack_params(archive, bytes(payload))
+            assert info["patch_payload"]["level"] == 9
+        info["patch_hash"] = hashlib.sha256(patches[name]).hexdigest()
+        info["patch_size"] = len(patches[name])
+
+    MemoryDownloader.patches = patches
+    return data, archive
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPayloadPatches(object):
+    @pytest.mark.parametrize("mode", ["memory", "pipeline", "low_memory"])
+    def test_payload_patches(self, payload_repo, mode):
+        data, latest = payload_repo
+        data["pipeline_patches"] = mode == "pipeline"
+        data["low_memory"] = mode == "low_memory"
+        p = Patcher(**data)
+        assert p.start() is True
+        assert len(MemoryDownloader.requested) == 5
+        assert p.og_pack_params is None
+        assert sorted(os.listdir(data["update_folder"])) == [
+            "Acme-mac-4.1.tar.gz",
+            "Acme-mac-4.6.tar.gz",
+        ]
+        with open(
+            os.path.join(data["update_folder"], "Acme-mac-4.6.tar.gz"), "rb"
+        ) as f:
+            assert f.read() == latest
+
+    @pytest.mark.parametrize("low_memory", [False, True])
+    def test_rebuild_mismatch(self, payload_repo, low_memory):
+        # A zlib that compresses differently fails the hash check
+        data, _ = payload_repo
+        info = data["json_data"]["updates"]["Acme"]["4.6.0.2.0"]["mac"]
+        info["patch_payload"]["level"] = 1
+        data["low_memory"] = low_memory
+        p = Patcher(**data)
+        assert p.start() is False
+        assert os.listdir(data["update_folder"]) == ["Acme-mac-4.1.tar.gz"]
@@ -23,15 +23,39 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals
+import gzip
 import io
 import os
+import shutil
+import zipfile
 
 import pytest
 
+from pyupdater.utils.archive_payload import (
+    get_format,
+    get_pack_params,
+    get_payload_size,
+    pack,
+    pack_file,
+    unpack,
+    unpack_file,
+)
 from pyupdater.utils.config import Config
+from pyupdater.utils.exceptions import UtilsError
+from pyupdater.utils import patch_engines
+from pyupdater.utils.patch_engines import (
+    get_engine,
+    get_engine_names,
+    load_plugins,
+    PatchEngine,
+    register_engine,
+    zstandard,
+)
 from pyupdater.utils import (
+    _parse_vm_stat,
     check_repo,
     create_asset_archive,
+    get_available_memory,
     make_archive,
     PluginManager,
     remove_dot_files,
@@ -148,3 +172,195 @@ class TestUtils(object):
 
         p = pm.get_plugin("test", True)
         assert p.bucket == "test_bucket"
+
+
+class ReplaceEngine(PatchEngine):
+    # The patch is the whole new file
+    name = "test-replace"
+
+    def diff(self, src, dst):
+        return dst
+
+    def patch(self, src, patch):
+        return patch
+
+
+class MissingEngine(ReplaceEngine):
+    name = "test-missing"
+
+    def is_available(self):
+        return False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPatchEngines(object):
+    def test_default(self):
+        engine = get_engine()
+        assert engine.name == "bsdiff4"
+        assert get_engine("bsdiff4") is engine
+        assert "bsdiff4" in get_engine_names()
+
+    def test_round_trip(self):
+        src = os.urandom(10000)
+        dst = src[:5000] + os.urandom(100) + src[5000:]
+        engine = get_engine()
+        assert engine.patch(src, engine.diff(src, dst)) == dst
+
+    def test_file_patch(self):
+        register_engine(ReplaceEngine())
+        engine = get_engine("test-replace")
+        with open("src", "wb") as f:
+            f.write(b"old")
+        with open("patch", "wb") as f:
+            f.write(engine.diff(b"old", b"new"))
+        engine.file_patch("src", "dst", "patch")
+        with open("dst", "rb") as f:
+            assert f.read() == b"new"
+
+    def test_incomplete_engine(self):
+        class NoPatch(PatchEngine):
+            name = "test-no-patch"
+
+            def diff(self, src, dst):
+                return dst
+
+        with pytest.raises(TypeError):
+            NoPatch()
+        with pytest.raises(UtilsError):
+            register_engine(object())
+
+    def test_unknown(self):
+        register_engine(MissingEngine())
+        assert get_engine("test-missing") is None
+        assert get_engine("does-not-exist") is None
+        assert "test-missing" not in get_engine_names()
+
+    def test_plugins_not_loaded_by_lookup(self, monkeypatch):
+        def fail(*args, **kwargs):
+            raise AssertionError("Entry points scanned")
+
+        monkeypatch.setattr(patch_engines, "_plugins_loaded", False)
+        monkeypatch.setattr(patch_engines, "ExtensionManager", fail)
+        assert get_engine("bsdiff4") is not None
+        assert get_engine("test-plugin") is None
+        assert "bsdiff4" in get_engine_names()
+
+    def test_load_plugins(self, monkeypatch):
+        class PluginEngine(ReplaceEngine):
+            name = "test-plugin"
+
+        class Extension(object):
+            name = "test-plugin"
+            obj = PluginEngine()
+
+        loaded = []
+
+        class Manager(object):
+            def __init__(self, namespace, invoke_on_load=False):
+                # Not flagged as loaded until every engine is registered
+                assert patch_engines._plugins_loaded is False
+                loaded.append(namespace)
+                self.extensions = [Extension()]
+
+        monkeypatch.setattr(patch_engines, "_engines", dict(patch_engines._engines))
+        monkeypatch.setattr(patch_engines, "_plugins_loaded", False)
+        monkeypatch.setattr(patch_engines, "ExtensionManager", Manager)
+        load_plugins()
+        load_plugins()
+        assert loaded == [patch_engines.ENGINE_NAMESPACE]
+        assert patch_engines._plugins_loaded is True
+        assert get_engine("test-plugin") is Extension.obj
+
+    @pytest.mark.skipif(zstandard is None, reason="zstandard not installed")
+    def test_zstd(self):
+        src = os.urandom(100000)
+        dst = src[:50000] + os.urandom(100) + src[50000:]
+        engine = get_engine("zstd")
+        patch = engine.diff(src, dst)
+        assert len(patch) < 10000
+        assert engine.patch(src, patch) == dst
+
+
+class TestAvailableMemory(object):
+    def test_available_memory(self):
+        assert get_available_memory() > 0
+
+    def test_parse_vm_stat(self):
+        output = (
+            "Mach Virtual Memory Statistics: (page size of 16384 bytes)\n"
+            "Pages free:                               10.\n"
+            "Pages active:                            500.\n"
+            "Pages inactive:                           20.\n"
+            "Pages speculative:                         5.\n"
+        )
+        assert _parse_vm_stat(output) == 35 * 16384
+        assert _parse_vm_stat("vm_stat: command not found") is None
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestArchivePayload(object):
+    def _make_app(self):
+        os.mkdir("app")
+        for i in range(5):
+            with open(os.path.join("app", str(i)), "wb") as f:
+                f.write(os.urandom(1000) + b"lorem ipsum" * 1000 * i)
+
+    @pytest.mark.parametrize("archive_format", ["gztar", "zip"])
+    def test_round_trip(self, archive_format):
+        self._make_app()
+        filename = shutil.make_archive("app", archive_format, ".", "app")
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        fmt = get_format(data)
+        payload = unpack(data, fmt)
+        assert len(payload) > len(data)
+        params = get_pack_params(data, payload)
+        assert params["format"] == fmt
+        assert params["size"] == len(payload)
+        assert pack(payload, params) == data
+
+        unpack_file(filename, "payload", fmt)
+        pack_file("payload", "packed", params)
+        with open("packed", "rb") as f:
+            assert f.read() == data
+
+    def test_payload_size(self):
+        self._make_app()
+        for archive_format in ["gztar", "zip"]:
+            filename = shutil.make_archive("app", archive_format, ".", "app")
+            with open(filename, "rb") as f:
+                data = f.read()
+            assert get_payload_size(filename) == len(unpack(data, get_format(data)))
+
+    def test_levels(self):
+        payload = b"lorem ipsum dolor sit amet" * 10000
+        data = gzip.compress(payload, compresslevel=1, mtime=0)
+        assert pack(payload, get_pack_params(data, payload)) == data
+
+        with zipfile.ZipFile(
+            "app.zip", "w", zipfile.ZIP_DEFLATED, compresslevel=2
+        ) as zf:
+            zf.writestr("a", payload)
+            zf.writestr("b", b"stored", compress_type=zipfile.ZIP_STORED)
+        with open("app.zip", "rb") as f:
+            data = f.read()
+        payload = unpack(data, "zip")
+        assert pack(payload, get_pack_params(data, payload)) == data
+
+    def test_not_supported(self):
+        self._make_app()
+        filename = shutil.make_archive("app", "bztar", ".", "app")
+        with open(filename, "rb") as f:
+            assert get_format(f.read()) is None
+
+        # Only single member gzip archives can be rebuilt
+        data = gzip.compress(b"a") + gzip.compress(b"b")
+        with pytest.raises(UtilsError):
+            unpack(data, "gzip")
+
+        data = gzip.compress(b"a" * 1000)
+        with pytest.raises(UtilsError):
+            unpack(data[:-4], "gzip")
+        # Not made by zlib
+        assert get_pack_params(data[:12] + b"\x00" + data[13:], b"a" * 1000) is None
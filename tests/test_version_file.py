@@ -30,6 +30,7 @@ from nacl.signing import VerifyKey
 import pytest
 
 from pyupdater.utils.encoding import UnpaddedBase64Encoder
+from pyupdater.utils.manifest import build_patch_chains, compact_manifest
 
 
 @pytest.mark.usefixtures("cleandir")
@@ -50,3 +51,123 @@ class TestVersionFile(object):
 
         sig = UnpaddedBase64Encoder.decode(sig)
         public_key.verify(version_data, sig)
+
+
+def _make_version_data():
+    updates = {}
+    for i in range(5):
+        version = "1.{}".format(i)
+        info = {"filename": "Acme-{}.tar.gz".format(version), "file_size": 100}
+        updates[version] = {"mac": dict(info), "win": dict(info)}
+        if i > 0:
+            updates[version]["mac"].update(patch_name="p", patch_hash="h")
+            updates[version]["mac"]["patch_size"] = 10
+            if i != 2:
+                updates[version]["win"].update(patch_name="p", patch_hash="h")
+                updates[version]["win"]["patch_size"] = 10
+    return {
+        "latest": {"Acme": {"stable": {"mac": "1.4", "win": "1.4"}}},
+        "updates": {"Acme": updates},
+    }
+
+
+class TestCompactVersionFile(object):
+    def test_patch_chain(self):
+        data = _make_version_data()
+        updates = data["updates"]["Acme"]
+        removed = compact_manifest(data)
+
+        # Every mac version patches to latest. The win chain breaks at 1.2
+        assert sorted(removed) == [("Acme", "1.0", "win"), ("Acme", "1.1", "win")]
+        assert sorted(updates) == ["1.0", "1.1", "1.2", "1.3", "1.4"]
+        assert "patch_name" in updates["1.1"]["mac"]
+
+    def test_patch_size(self):
+        data = _make_version_data()
+        for info in data["updates"]["Acme"].values():
+            info["mac"]["file_size"] = 25
+        compact_manifest(data)
+        # Only 2 patches are smaller than the full update
+        assert sorted(data["updates"]["Acme"]) == ["1.2", "1.3", "1.4"]
+        assert sorted(data["updates"]["Acme"]["1.2"]) == ["mac", "win"]
+        # Nothing patches to 1.2 anymore
+        assert "patch_name" not in data["updates"]["Acme"]["1.2"]["mac"]
+        assert "patch_name" in data["updates"]["Acme"]["1.3"]["mac"]
+
+    def test_keep(self):
+        data = _make_version_data()
+        for info in data["updates"]["Acme"].values():
+            info["mac"]["file_size"] = 25
+            info["win"]["file_size"] = 25
+        compact_manifest(data, keep=4)
+        assert sorted(data["updates"]["Acme"]) == ["1.1", "1.2", "1.3", "1.4"]
+
+    def test_cumulative_kept(self):
+        data = _make_version_data()
+        updates = data["updates"]["Acme"]
+        for info in updates.values():
+            info["mac"]["file_size"] = 25
+        updates["1.4"]["mac"]["cumulative_patches"] = {
+            "1.0": {"patch_name": "c", "patch_hash": "h", "patch_size": 15}
+        }
+        compact_manifest(data)
+        # 1.1 is gone but 1.0 can still skip straight to latest
+        assert sorted(updates) == ["1.0", "1.2", "1.3", "1.4"]
+        assert "patch_name" not in updates["1.2"]["mac"]
+        assert "1.0" in updates["1.4"]["mac"]["cumulative_patches"]
+
+    def test_cumulative_source_removed(self):
+        data = _make_version_data()
+        updates = data["updates"]["Acme"]
+        for info in updates.values():
+            info["mac"]["file_size"] = 25
+        updates["1.4"]["mac"]["cumulative_patches"] = {
+            "1.0": {"patch_name": "c", "patch_hash": "h", "patch_size": 30}
+        }
+        compact_manifest(data)
+        assert sorted(updates) == ["1.2", "1.3", "1.4"]
+        assert "cumulative_patches" not in updates["1.4"]["mac"]
+
+    def test_latest_kept(self):
+        data = _make_version_data()
+        data["latest"]["Acme"]["stable"]["win"] = "1.0"
+        compact_manifest(data)
+        assert "win" in data["updates"]["Acme"]["1.0"]
+        assert "win" not in data["updates"]["Acme"]["1.1"]
+
+
+class TestPatchChains(object):
+    def test_build(self):
+        data = _make_version_data()
+        chains = build_patch_chains(data)
+        assert chains["Acme"]["mac"]["stable"] == {
+            "versions": ["1.0", "1.1", "1.2", "1.3", "1.4"],
+            "sizes": [40, 30, 20, 10, 0],
+            "next": [1, 2, 3, 4, -1],
+        }
+        # No patch to 1.2 on windows
+        assert chains["Acme"]["win"]["stable"] == {
+            "versions": ["1.2", "1.3", "1.4"],
+            "sizes": [20, 10, 0],
+            "next": [1, 2, -1],
+        }
+
+    def test_cumulative_route(self):
+        data = _make_version_data()
+        data["updates"]["Acme"]["1.3"]["mac"]["cumulative_patches"] = {
+            "1.0": {"patch_name": "c", "patch_hash": "h", "patch_size": 15}
+        }
+        chains = build_patch_chains(data)
+        # 1.0 -> 1.3 -> 1.4 beats patching through every version
+        assert chains["Acme"]["mac"]["stable"] == {
+            "versions": ["1.0", "1.1", "1.2", "1.3", "1.4"],
+            "sizes": [25, 30, 20, 10, 0],
+            "next": [3, 2, 3, 4, -1],
+        }
+
+    def test_no_patches(self):
+        data = _make_version_data()
+        for info in data["updates"]["Acme"].values():
+            info["mac"].pop("patch_size", None)
+            info["win"].pop("patch_name", None)
+        assert build_patch_chains(data) == {}